@@ -41,8 +41,18 @@ def __getattr__(name):
 
 
 from .asqlite3 import (
-    Cursor, Connection, connect,
+    Cursor, Connection, FetchBudgetError, OverloadedError, PreparedStatement, SpanHook,
+    StallReport, WorkerPool, connect,
 )
+from .advisor import Advice, IndexAdvisor, IndexCandidate
+from .blobstore import BlobStore, BlobUsage
+from .changefeed import Change, ChangeFeed
+from .kv import KVStore
+from .manager import DatabaseManager
+from .queue import Message, TaskQueue
+
+if _sys_version_info >= (3, 11):
+    from .templates import TemplateCache
 
 asqlite3_version_str = '0.7'
 asqlite3_version = tuple(int(part) for part in asqlite3_version_str.split('.'))
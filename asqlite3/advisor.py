@@ -0,0 +1,264 @@
+# Copyright (c) 2024 Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''An index advisor driven by the queries a connection executes.'''
+
+import collections
+import re
+import sqlite3
+import time
+
+from .asqlite3 import _normalize_sql, _quote
+
+
+Advice = collections.namedtuple('Advice', 'sql count total_time plan issues indexes')
+IndexCandidate = collections.namedtuple('IndexCandidate',
+                                        'table columns create_sql before_time after_time')
+
+_SQL_KEYWORDS = {'where', 'on', 'using', 'join', 'left', 'right', 'full', 'inner', 'outer',
+                 'cross', 'natural', 'group', 'order', 'limit', 'having', 'window', 'union',
+                 'except', 'intersect', 'set', 'values', 'as'}
+_TABLE_REF = re.compile(r'\b(?:FROM|JOIN|UPDATE|INTO)\s+("(?:[^"]|"")+"|\w+)'
+                        r'(?:\s+(?:AS\s+)?("(?:[^"]|"")+"|\w+))?', re.IGNORECASE)
+_PREDICATE = re.compile(r'(?:("(?:[^"]|"")+"|\w+)\.)?("(?:[^"]|"")+"|\w+)\s*'
+                        r'(==|=|IS\b|IN\b|<=|>=|<|>|BETWEEN\b|LIKE\b|GLOB\b)', re.IGNORECASE)
+_ORDER_BY = re.compile(r'\b(?:ORDER|GROUP)\s+BY\s+(.*?)(?:\bLIMIT\b|\bHAVING\b|\bWINDOW\b|'
+                       r'\bORDER\b|$)', re.IGNORECASE | re.DOTALL)
+_SCAN = re.compile(r'SCAN (?:TABLE )?(\S+)(?: AS (\S+))?$')
+_AUTOMATIC = re.compile(r'SEARCH (?:TABLE )?(\S+)(?: AS (\S+))? USING AUTOMATIC .*?\((.*)\)')
+_EQUALITY_OPS = {'=', '==', 'is', 'in'}
+
+
+def _unquote(name):
+    if name.startswith('"'):
+        return name[1:-1].replace('""', '"')
+    return name
+
+
+class _QueryRecorder:
+    '''Records the frequency and time of statements by normalized SQL, with a sample of
+    each for EXPLAIN QUERY PLAN.  Only accessed from the database thread.'''
+
+    def __init__(self):
+        # normalized sql -> [count, total time, sample sql, sample parameters]
+        self.queries = {}
+        self.start = None
+
+    def begin_job(self, tracker):
+        self.start = time.perf_counter() if tracker.sql is not None else None
+
+    def end_job(self, tracker):
+        if self.start is None or getattr(tracker.func, '__name__', '') == 'executescript':
+            return
+        elapsed = time.perf_counter() - self.start
+        key = _normalize_sql(tracker.sql)
+        entry = self.queries.get(key)
+        if entry is None:
+            entry = self.queries[key] = [0, 0.0, None, None]
+        # Time fetching rows counts towards the statement
+        entry[1] += elapsed
+        if tracker.new_statement:
+            entry[0] += 1
+            if entry[2] is None:
+                parameters = _sample_parameters(tracker.func, tracker.args)
+                if parameters is not None:
+                    entry[2] = tracker.sql
+                    entry[3] = parameters
+
+
+def _sample_parameters(func, args):
+    name = getattr(func, '__name__', '')
+    if name == 'execute':
+        return args[1] if len(args) > 1 else ()
+    if name == 'executemany':
+        parameters = args[1]
+        if isinstance(parameters, (list, tuple)) and parameters:
+            return parameters[0]
+        return None
+    # Helper functions taking (conn, sql, parameters)
+    return args[2] if len(args) > 2 else None
+
+
+class IndexAdvisor:
+    '''Records the statements a connection executes and proposes indexes for the most
+    expensive of them.'''
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._recorder = _QueryRecorder()
+
+    async def start(self):
+        '''Start recording statements.'''
+        await self.conn._add_statement_listener(self._recorder)
+
+    async def stop(self):
+        '''Stop recording statements.'''
+        await self.conn._remove_statement_listener(self._recorder)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.stop()
+
+    async def stats(self, top=None):
+        '''Return a list of dictionaries with keys sql, count, total_time and mean_time, for
+        the recorded statements with the most total time first.'''
+        return await self.conn.schedule(self._stats, top)
+
+    def _stats(self, top):
+        stats = [{'sql': sql, 'count': count, 'total_time': total_time,
+                  'mean_time': total_time / count if count else 0.0}
+                 for sql, (count, total_time, _, _) in self._recorder.queries.items()]
+        stats.sort(key=lambda item: item['total_time'], reverse=True)
+        return stats[:top] if top is not None else stats
+
+    async def analyze(self, top=10, *, min_rows=1000, verify=False):
+        '''Run EXPLAIN QUERY PLAN for the top statements by total time, and return a list of
+        Advice for those whose plan scans a table of at least min_rows rows, uses an
+        automatic index, or sorts with a temporary B-tree.  If verify is true and no
+        transaction is open, each candidate index is timed against an in-memory copy of the
+        database.'''
+        return await self.conn.schedule(self._analyze, self.conn._conn, top, min_rows, verify)
+
+    def _analyze(self, conn, top, min_rows, verify):
+        ranked = sorted(self._recorder.queries.values(), key=lambda entry: entry[1],
+                        reverse=True)[:top]
+        row_counts = {}
+        result = []
+        for count, total_time, sql, parameters in ranked:
+            if sql is None:
+                continue
+            try:
+                plan = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}',
+                                                       parameters)]
+            except sqlite3.Error:
+                continue
+            issues, indexes = self._diagnose(conn, sql, plan, min_rows, row_counts)
+            if not issues:
+                continue
+            # A backup cannot be taken with a transaction open
+            if verify and indexes and not conn.in_transaction:
+                indexes = _verify(conn, sql, parameters, indexes)
+            result.append(Advice(sql, count, total_time, plan, issues, indexes))
+        return result
+
+    def _diagnose(self, conn, sql, plan, min_rows, row_counts):
+        aliases = {}
+        for match in _TABLE_REF.finditer(sql):
+            table = _unquote(match.group(1))
+            aliases[table.lower()] = table
+            alias = match.group(2)
+            if alias and alias.lower() not in _SQL_KEYWORDS:
+                aliases[_unquote(alias).lower()] = table
+        issues = []
+        columns = {}    # table -> list of candidate columns
+        for detail in plan:
+            match = _SCAN.match(detail)
+            if match:
+                name = match.group(2) or match.group(1)
+                table = aliases.get(name.lower(), match.group(1))
+                if table not in row_counts:
+                    try:
+                        row_counts[table] = conn.execute(
+                            f'SELECT COUNT(*) FROM {_quote(table)}').fetchone()[0]
+                    except sqlite3.Error:
+                        row_counts[table] = 0
+                if row_counts[table] >= min_rows:
+                    issues.append(detail)
+                    columns.setdefault(table, _predicate_columns(conn, sql, table, aliases))
+                continue
+            match = _AUTOMATIC.match(detail)
+            if match:
+                table = aliases.get((match.group(2) or match.group(1)).lower(), match.group(1))
+                issues.append(detail)
+                columns[table] = [term.split('=')[0].strip()
+                                  for term in match.group(3).split(' AND ')]
+                continue
+            if detail.startswith('USE TEMP B-TREE'):
+                issues.append(detail)
+                for table in set(aliases.values()):
+                    order_columns = _order_columns(conn, sql, table, aliases)
+                    if order_columns:
+                        existing = columns.setdefault(table, [])
+                        existing.extend(column for column in order_columns
+                                        if column not in existing)
+        indexes = []
+        for table, index_columns in columns.items():
+            if index_columns:
+                name = _quote('_'.join(['idx', table] + index_columns))
+                create_sql = (f'CREATE INDEX {name} ON {_quote(table)}'
+                              f'({", ".join(_quote(column) for column in index_columns)})')
+                indexes.append(IndexCandidate(table, index_columns, create_sql, None, None))
+        return issues, indexes
+
+
+def _table_columns(conn, table):
+    return {row[1].lower(): row[1] for row in conn.execute(f'PRAGMA table_info({_quote(table)})')}
+
+
+def _qualifies(qualifier, table, aliases):
+    return qualifier is None or aliases.get(_unquote(qualifier).lower()) == table
+
+
+def _predicate_columns(conn, sql, table, aliases):
+    '''Columns of table compared in sql: equality comparisons first, then one range.'''
+    table_columns = _table_columns(conn, table)
+    equalities, ranges = [], []
+    for match in _PREDICATE.finditer(sql):
+        qualifier, column, op = match.groups()
+        column = table_columns.get(_unquote(column).lower())
+        if column is None or not _qualifies(qualifier, table, aliases):
+            continue
+        target = equalities if op.lower() in _EQUALITY_OPS else ranges
+        if column not in equalities and column not in target:
+            target.append(column)
+    return equalities + ranges[:1]
+
+
+def _order_columns(conn, sql, table, aliases):
+    match = _ORDER_BY.search(sql)
+    if not match:
+        return []
+    table_columns = _table_columns(conn, table)
+    result = []
+    for term in match.group(1).split(','):
+        parts = term.strip().split()
+        if not parts:
+            continue
+        qualifier, _, column = parts[0].rpartition('.')
+        column = table_columns.get(_unquote(column).lower())
+        if column is None or not _qualifies(qualifier or None, table, aliases):
+            return result
+        result.append(column)
+    return result
+
+
+def _timed_query(conn, sql, parameters):
+    start = time.perf_counter()
+    conn.execute(sql, parameters).fetchall()
+    return time.perf_counter() - start
+
+
+def _verify(conn, sql, parameters, indexes):
+    '''Time sql with and without each candidate index on in-memory copies of conn.'''
+    result = []
+    for index in indexes:
+        copy = sqlite3.connect(':memory:')
+        try:
+            conn.backup(copy)
+            before = _timed_query(copy, sql, parameters)
+            copy.execute(index.create_sql)
+            after = _timed_query(copy, sql, parameters)
+        except sqlite3.Error:
+            result.append(index)
+            continue
+        finally:
+            copy.close()
+        result.append(index._replace(before_time=before, after_time=after))
+    return result
@@ -8,10 +8,643 @@
 '''An asyncio version of sqlite3.'''
 
 import asyncio
+import collections
+import contextvars
+import functools
+import itertools
+import json
+import logging
 import queue
+import re
 import sqlite3
 import sys
 import threading
+import time
+import traceback
+import weakref
+
+
+logger = logging.getLogger('asqlite3')
+
+
+class OverloadedError(RuntimeError):
+    '''Raised when a job is rejected, or shed, because the job queue of a connection is
+    overloaded.'''
+
+
+class SpanHook:
+    '''A hook for tracing the jobs of a connection.  Subclass and override its methods.  Both
+    are called in the database thread, in the context of the caller of schedule().'''
+
+    def start_span(self, sql, queue_wait):
+        '''Called before a job runs.  sql is the SQL statement the job executes, or None, and
+        queue_wait the time in seconds the job was queued.  The return value is passed to
+        end_span().'''
+        return None
+
+    def end_span(self, span, elapsed, rows, exc):
+        '''Called after a job runs.  elapsed is its execution time in seconds, rows the
+        number of rows it returned or changed if known, otherwise None, and exc the
+        exception it raised, or None.'''
+
+
+StallReport = collections.namedtuple('StallReport', 'sql elapsed queue_depth stack')
+
+
+class FetchBudgetError(RuntimeError):
+    '''Raised when fetching rows exceeds a byte budget.  rows holds the rows fetched, which
+    are no longer available from the cursor, and size their estimated size in bytes.'''
+
+    def __init__(self, message, rows, size):
+        super().__init__(message)
+        self.rows = rows
+        self.size = size
+
+
+async def _executemany_stream(schedule, cursor, sql, parameters, chunk_size, commit_every):
+    iterator = parameters.__aiter__()
+    pending = None
+    uncommitted = 0
+    try:
+        done = False
+        while not done:
+            chunk = []
+            try:
+                while len(chunk) < chunk_size:
+                    chunk.append(await iterator.__anext__())
+            except StopAsyncIteration:
+                done = True
+            # Wait for the previous chunk only once the next one is ready
+            if pending is not None:
+                await pending
+                pending = None
+            if chunk:
+                uncommitted += len(chunk)
+                commit = commit_every is not None and (done or uncommitted >= commit_every)
+                if commit:
+                    uncommitted = 0
+                pending = schedule(_executemany_chunk, cursor, sql, chunk, commit)
+            elif commit_every is not None and uncommitted:
+                pending = schedule(cursor.connection.commit)
+        if pending is not None:
+            await pending
+            pending = None
+    finally:
+        # If the producer failed, let the chunk being inserted finish
+        if pending is not None:
+            await asyncio.wait((pending, ))
+            if not pending.cancelled():
+                pending.exception()
+
+
+def _executemany_chunk(cursor, sql, chunk, commit):
+    cursor.executemany(sql, chunk)
+    if commit:
+        cursor.connection.commit()
+
+
+_SLICE_SAVEPOINT = 'asqlite3_slices'
+
+# Authorizer actions of read-only statements
+_READ_ACTIONS = {sqlite3.SQLITE_READ, sqlite3.SQLITE_SELECT, sqlite3.SQLITE_FUNCTION,
+                 sqlite3.SQLITE_RECURSIVE}
+
+
+class _SliceGuard:
+    '''The authorizer of a connection with slice_time set, chaining to the user's
+    authorizer.  While a sliced operation holds a savepoint or transaction open between
+    its slices, Connection holds back jobs that might write or change the transaction,
+    before they start, until the slices finish.  Jobs that only read before executing a
+    statement may start; the guard denies that statement when it is compiled, before it
+    runs, if it would write.  Only accessed in the database thread.'''
+
+    def __init__(self):
+        self.authorizer = None
+        self.active = False
+        # The slicer whose slices are running
+        self.slicer = None
+        self.in_slice = False
+        # True if a statement was denied since the flag was last cleared
+        self.denied = False
+        # Held jobs in the order they were queued
+        self.held_jobs = []
+
+    def __call__(self, action, arg1, arg2, db_name, trigger):
+        if self.active and not self.in_slice and action not in _READ_ACTIONS:
+            # A PRAGMA without a value only reads
+            if not (action == sqlite3.SQLITE_PRAGMA and arg2 is None):
+                self.denied = True
+                return sqlite3.SQLITE_DENY
+        if self.authorizer is None:
+            return sqlite3.SQLITE_OK
+        return self.authorizer(action, arg1, arg2, db_name, trigger)
+
+    def set_authorizer(self, conn, authorizer):
+        self.authorizer = authorizer
+        if self.active:
+            conn.set_authorizer(self)
+        else:
+            self._restore(conn)
+
+    def activate(self, conn, slicer):
+        self.active = True
+        self.slicer = slicer
+        # This also expires compiled statements, so they are authorized again
+        conn.set_authorizer(self)
+
+    def deactivate(self, conn):
+        self.active = False
+        self.slicer = None
+        self._restore(conn)
+
+    def _restore(self, conn):
+        # Before Python 3.9 an authorizer cannot be removed, but the inactive guard allows
+        # everything the user's authorizer does
+        if self.authorizer is None and sys.version_info < (3, 9):
+            conn.set_authorizer(self)
+        else:
+            conn.set_authorizer(self.authorizer)
+
+
+class _ManySlicer:
+    '''Runs executemany() in slices of adaptively-sized numbers of rows.  Once there is
+    more than one slice they run inside a savepoint, so the rows are inserted atomically,
+    and guard holds back jobs that would write or change the transaction between slices.
+    The methods run in the database thread.'''
+
+    def __init__(self, cursor, sql, parameters, slice_time, rows, guard):
+        self.cursor = cursor
+        self.sql = sql
+        self.iterator = iter(parameters)
+        self.slice_time = slice_time
+        self.rows = rows
+        self.guard = guard
+        self.savepoint = False
+
+    def run_slice(self):
+        '''Run a slice.  Returns True when done.'''
+        self.guard.in_slice = True
+        try:
+            try:
+                chunk = list(itertools.islice(self.iterator, self.rows))
+                done = len(chunk) < self.rows
+                if not self.savepoint:
+                    if done:
+                        self.cursor.executemany(self.sql, chunk)
+                        return True
+                    _begin_savepoint(self.cursor.connection)
+                    self.savepoint = True
+                    self.guard.activate(self.cursor.connection, self)
+                start = time.monotonic()
+                self.cursor.executemany(self.sql, chunk)
+                elapsed = max(time.monotonic() - start, 1e-6)
+            except BaseException:
+                self.abort()
+                raise
+            self.rows = max(1, min(self.rows * 2, int(self.rows * self.slice_time / elapsed)))
+            if done:
+                self.savepoint = False
+                self.guard.deactivate(self.cursor.connection)
+                self.cursor.connection.execute(f'RELEASE {_SLICE_SAVEPOINT}')
+            return done
+        finally:
+            self.guard.in_slice = False
+
+    def abort(self):
+        if self.savepoint:
+            self.savepoint = False
+            conn = self.cursor.connection
+            self.guard.deactivate(conn)
+            conn.execute(f'ROLLBACK TO {_SLICE_SAVEPOINT}')
+            conn.execute(f'RELEASE {_SLICE_SAVEPOINT}')
+
+
+class _ScriptSlicer:
+    '''Runs executescript() a statement at a time, in slices taking about slice_time.  While
+    a slice leaves a transaction open, guard holds back jobs that would write or change the
+    transaction, so the script's transactions stay atomic.  The methods run in the database
+    thread.'''
+
+    def __init__(self, cursor, sql_script, slice_time, guard):
+        self.cursor = cursor
+        self.statements = collections.deque(_split_script(sql_script))
+        self.slice_time = slice_time
+        self.guard = guard
+        self.first = True
+
+    def run_slice(self):
+        '''Run a slice.  Returns True when done.'''
+        cursor = self.cursor
+        conn = cursor.connection
+        guard = self.guard
+        guard.in_slice = True
+        try:
+            if self.first:
+                self.first = False
+                # As executescript() does, commit any pending transaction first
+                if conn.in_transaction and _legacy_transaction_control(conn):
+                    conn.commit()
+            deadline = time.monotonic() + self.slice_time
+            statements = self.statements
+            try:
+                while statements:
+                    statement = statements.popleft()
+                    # execute() would implicitly begin a transaction outside one
+                    if conn.in_transaction:
+                        cursor.execute(statement)
+                    else:
+                        cursor.executescript(statement)
+                    if time.monotonic() >= deadline:
+                        break
+            except BaseException:
+                self.abort()
+                raise
+            done = not statements
+            if done or not conn.in_transaction:
+                if guard.active:
+                    guard.deactivate(conn)
+            elif not guard.active:
+                guard.activate(conn, self)
+            return done
+        finally:
+            guard.in_slice = False
+
+    def abort(self):
+        # Like executescript(), leave the transaction as the failed statement left it
+        if self.guard.active:
+            self.guard.deactivate(self.cursor.connection)
+
+
+def _split_script(sql_script):
+    statements = []
+    parts = sql_script.split(';')
+    current = ''
+    for n, part in enumerate(parts):
+        current += part
+        if n != len(parts) - 1:
+            current += ';'
+        if sqlite3.complete_statement(current):
+            statements.append(current)
+            current = ''
+    if current.strip():
+        statements.append(current)
+    return statements
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _quote_string(text):
+    return "'" + text.replace("'", "''") + "'"
+
+
+def _insert_sql(table, columns):
+    return (f'INSERT INTO {_quote(table)} ({", ".join(_quote(column) for column in columns)}) '
+            f'VALUES ({", ".join("?" * len(columns))})')
+
+
+# Buffer formats whose memoryview items are Python ints, floats or bools
+_SCALAR_FORMATS = set('bBhHiIlLqQnNfd?')
+
+
+def _iter_column(values):
+    '''Return an iterator over a column of values.  Buffers of native numbers, such as
+    array.array and NumPy arrays, are iterated through a memoryview so that their items are
+    Python scalars sqlite3 can bind.'''
+    try:
+        view = memoryview(values)
+    except TypeError:
+        return iter(values)
+    if view.ndim == 1 and view.format.lstrip('@') in _SCALAR_FORMATS:
+        return iter(view)
+    return iter(values)
+
+
+def _bulk_load(conn, table, rows, columns, batch_size, cache_size):
+    if columns is None:
+        columns = [info[1] for info in conn.execute(f'PRAGMA table_info({_quote(table)})')]
+        if not columns:
+            raise sqlite3.OperationalError(f'no such table: {table}')
+    sql = _insert_sql(table, columns)
+    # The synchronous pragma cannot be changed inside a transaction
+    bulk_pragmas = {'cache_size': int(cache_size)}
+    if not conn.in_transaction:
+        bulk_pragmas['synchronous'] = 0
+    pragmas = {name: conn.execute(f'PRAGMA {name}').fetchone()[0] for name in bulk_pragmas}
+    for name, value in bulk_pragmas.items():
+        conn.execute(f'PRAGMA {name}={value}')
+    try:
+        conn.execute('SAVEPOINT asqlite3_bulk_load')
+        try:
+            # Indexes created implicitly for constraints have no SQL and cannot be dropped
+            schema = conn.execute("SELECT type, name, sql FROM sqlite_master "
+                                  "WHERE type IN ('index', 'trigger') AND tbl_name = ? "
+                                  "AND sql IS NOT NULL", (table, )).fetchall()
+            for kind, name, _ in schema:
+                conn.execute(f'DROP {kind.upper()} {_quote(name)}')
+            count = 0
+            iterator = iter(rows)
+            while True:
+                batch = list(itertools.islice(iterator, batch_size))
+                if not batch:
+                    break
+                conn.executemany(sql, batch)
+                count += len(batch)
+            for _, _, create_sql in schema:
+                conn.execute(create_sql)
+        except BaseException:
+            conn.execute('ROLLBACK TO asqlite3_bulk_load')
+            raise
+        finally:
+            conn.execute('RELEASE asqlite3_bulk_load')
+    finally:
+        for name, value in pragmas.items():
+            conn.execute(f'PRAGMA {name}={value}')
+    return count
+
+
+def _legacy_transaction_control(conn):
+    # The autocommit attribute is new in Python 3.12
+    return getattr(conn, 'autocommit', None) == getattr(sqlite3, 'LEGACY_TRANSACTION_CONTROL',
+                                                        None)
+
+
+def _begin_savepoint(conn):
+    # Begin the transaction that executemany() would have implicitly begun, so that
+    # releasing the savepoint leaves it open
+    if (not conn.in_transaction and conn.isolation_level is not None
+            and _legacy_transaction_control(conn)):
+        conn.execute(f'BEGIN {conn.isolation_level}')
+    conn.execute(f'SAVEPOINT {_SLICE_SAVEPOINT}')
+
+
+class _MemoizedFunction:
+    '''Wraps a deterministic SQL function with a bounded LRU of its results.  Only called
+    in the database thread.'''
+
+    def __init__(self, func, maxsize):
+        self.func = func
+        self.maxsize = maxsize
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.call_time = 0.0
+
+    def __call__(self, *args):
+        # Argument types are part of the key as 1 == 1.0 but typeof() differs
+        key = (args, tuple(type(arg) for arg in args))
+        cache = self.cache
+        try:
+            result = cache[key]
+        except KeyError:
+            start = time.perf_counter()
+            result = self.func(*args)
+            self.call_time += time.perf_counter() - start
+            self.misses += 1
+            cache[key] = result
+            if len(cache) > self.maxsize:
+                cache.popitem(last=False)
+            return result
+        cache.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def stats(self):
+        calls = self.hits + self.misses
+        mean_time = self.call_time / self.misses if self.misses else 0.0
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / calls if calls else 0.0,
+            'time_saved': self.hits * mean_time,
+            'size': len(self.cache),
+        }
+
+
+# Methods of sqlite3 connections and cursors taking SQL as their first argument
+_EXECUTE_METHODS = {'execute', 'executemany', 'executescript'}
+
+
+def _job_sql(func, args):
+    '''Return the SQL a job executes, or None.'''
+    if func in _QUERY_HELPERS:
+        return args[1]
+    if args and getattr(func, '__name__', None) in _EXECUTE_METHODS:
+        return args[0]
+    return None
+
+
+class _StatementTracker:
+    '''Tracks the SQL statement each job runs, remembering the statement of each cursor so
+    that jobs fetching from it are attributed to it.  Only accessed from the database
+    thread.'''
+
+    def __init__(self):
+        # The SQL of the running job, or None.  new_statement is True if the job executes
+        # it rather than fetching from a cursor.  cursor is the job's sqlite3 cursor if known.
+        self.sql = None
+        self.new_statement = False
+        self.cursor = None
+        self.func = None
+        self.args = None
+        self.cursor_sql = weakref.WeakKeyDictionary()
+        # Objects with begin_job() and end_job() methods taking the tracker
+        self.listeners = []
+
+    def begin_job(self, func, args):
+        sql = _job_sql(func, args)
+        if func in _CURSOR_HELPERS:
+            owner = args[0]
+        else:
+            owner = getattr(func, '__self__', None)
+        cursor = owner if isinstance(owner, sqlite3.Cursor) else None
+        self.new_statement = sql is not None
+        if sql is None and cursor is not None:
+            sql = self.cursor_sql.get(cursor)
+        self.sql = sql
+        self.cursor = cursor
+        self.func = func
+        self.args = args
+        for listener in self.listeners:
+            listener.begin_job(self)
+
+    def end_job(self, result):
+        if self.new_statement and isinstance(result, sqlite3.Cursor):
+            self.cursor_sql[result] = self.sql
+            self.cursor = result
+        for listener in self.listeners:
+            listener.end_job(self)
+        self.sql = None
+        self.cursor = None
+        self.func = None
+        self.args = None
+
+
+class _CallbackStats:
+    '''Counts calls of, and times, instrumented callbacks, attributing them to the statement
+    being run.  Only accessed from the database thread.'''
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+        # (callback name, sql) -> [calls, total time, max time]
+        self.totals = {}
+
+    def call(self, name, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            key = (name, self.tracker.sql)
+            totals = self.totals.get(key)
+            if totals is None:
+                self.totals[key] = [1, elapsed, elapsed]
+            else:
+                totals[0] += 1
+                totals[1] += elapsed
+                if elapsed > totals[2]:
+                    totals[2] = elapsed
+
+    def snapshot(self):
+        result = {}
+        for (name, sql), (calls, total_time, max_time) in self.totals.items():
+            stats = result.get(name)
+            if stats is None:
+                stats = result[name] = {'calls': 0, 'total_time': 0.0, 'max_time': 0.0,
+                                        'statements': {}}
+            stats['calls'] += calls
+            stats['total_time'] += total_time
+            stats['max_time'] = max(stats['max_time'], max_time)
+            stats['statements'][sql] = {'calls': calls, 'total_time': total_time,
+                                        'max_time': max_time}
+        return result
+
+    def reset(self):
+        self.totals.clear()
+
+
+_SQL_LITERAL = re.compile(r"[xX]'[0-9a-fA-F]*'|'(?:[^']|'')*'"
+                          r"|\b\d+(?:\.\d*)?(?:[eE][-+]?\d+)?\b")
+_SQL_SPACE = re.compile(r'\s+')
+
+
+@functools.lru_cache(maxsize=1024)
+def _normalize_sql(sql):
+    '''Return sql with literals replaced by ? and whitespace collapsed, so statements
+    differing only in their constants are grouped together.'''
+    return _SQL_SPACE.sub(' ', _SQL_LITERAL.sub('?', sql)).strip()
+
+
+class _StepMeter:
+    '''Counts SQLite VM steps per statement via the progress handler, which SQLite calls
+    every granularity steps.  Only accessed from the database thread.'''
+
+    def __init__(self, granularity):
+        self.granularity = granularity
+        self.default_budget = None
+        # Keyed by normalized SQL
+        self.budgets = {}
+        self.totals = {}
+        # The running statement's normalized SQL, its steps so far and its budget
+        self.key = None
+        self.steps = 0
+        self.job_start_steps = 0
+        self.budget = None
+        self.cursor_steps = weakref.WeakKeyDictionary()
+        self.user_handler = None
+        self.user_n = 0
+        self.user_steps = 0
+
+    def begin_job(self, tracker):
+        if tracker.sql is None:
+            self.key = None
+            self.budget = None
+            return
+        self.key = _normalize_sql(tracker.sql)
+        if tracker.new_statement or tracker.cursor is None:
+            self.steps = 0
+        else:
+            self.steps = self.cursor_steps.get(tracker.cursor, 0)
+        self.job_start_steps = self.steps
+        self.budget = self.budgets.get(self.key, self.default_budget)
+
+    def end_job(self, tracker):
+        key = self.key
+        if key is None:
+            return
+        totals = self.totals.get(key)
+        if totals is None:
+            totals = self.totals[key] = [0, 0, 0, 0]
+        totals[0] += tracker.new_statement
+        totals[1] += self.steps - self.job_start_steps
+        totals[2] = max(totals[2], self.steps)
+        if tracker.cursor is not None:
+            self.cursor_steps[tracker.cursor] = self.steps
+        self.key = None
+        self.budget = None
+
+    def handler(self):
+        self.steps += self.granularity
+        if self.user_handler is not None:
+            self.user_steps += self.granularity
+            if self.user_steps >= self.user_n:
+                self.user_steps = 0
+                if self.user_handler():
+                    return 1
+        if self.budget is not None and self.steps > self.budget:
+            self.budget = None
+            totals = self.totals.get(self.key)
+            if totals is None:
+                totals = self.totals[self.key] = [0, 0, 0, 0]
+            totals[3] += 1
+            return 1
+        return 0
+
+    def set_user_handler(self, handler, n):
+        self.user_handler = handler
+        self.user_n = n
+        self.user_steps = 0
+
+    def set_budget(self, steps, sql):
+        if sql is None:
+            self.default_budget = steps
+        elif steps is None:
+            self.budgets.pop(_normalize_sql(sql), None)
+        else:
+            self.budgets[_normalize_sql(sql)] = steps
+
+    def snapshot(self, top):
+        stats = [{'sql': sql, 'executions': executions, 'steps': steps, 'max_steps': max_steps,
+                  'aborted': aborted}
+                 for sql, (executions, steps, max_steps, aborted) in self.totals.items()]
+        stats.sort(key=lambda item: item['steps'], reverse=True)
+        return stats[:top] if top is not None else stats
+
+
+def _instrumented_aggregate(stats, name, aggregate_class):
+    '''Return a class wrapping aggregate_class whose methods are timed by stats.'''
+    call = stats.call
+
+    class Instrumented:
+
+        def __init__(self):
+            self.aggregate = call(name, aggregate_class)
+
+        def step(self, *args):
+            return call(name, self.aggregate.step, *args)
+
+        def finalize(self):
+            return call(name, self.aggregate.finalize)
+
+        # Only called for window functions
+        def value(self):
+            return call(name, self.aggregate.value)
+
+        def inverse(self, *args):
+            return call(name, self.aggregate.inverse, *args)
+
+    return Instrumented
 
 
 class Cursor:
@@ -20,11 +653,16 @@ class Cursor:
     def __init__(self, schedule, cursor):
         self.schedule = schedule
         self._cursor = cursor
+        # True if the last budgeted fetch stopped at its byte budget with rows unread
+        self.truncated = False
+        # A row read from the cursor but not yet returned, found after a truncated fetch
+        self._pending = []
 
     def __aiter__(self):
         async def iterate_rows():
             while True:
-                rows = await self.schedule(self._cursor.fetchmany)
+                # Batches stay within any byte budget
+                rows = await self.fetchmany(partial=True)
                 if not rows:
                     break
                 for row in rows:
@@ -45,20 +683,90 @@ class Cursor:
         return self
 
     async def executemany(self, sql, parameters, /):
-        await self.schedule(self._cursor.executemany, sql, parameters)
+        conn = self.connection
+        if conn._slice_time is None:
+            await self.schedule(self._cursor.executemany, sql, parameters)
+        else:
+            await conn._run_sliced(_ManySlicer(self._cursor, sql, parameters, conn._slice_time,
+                                               conn._slice_rows, conn._slice_guard))
         return self
 
     async def executescript(self, sql_script, /):
-        await self.schedule(self._cursor.executescript, sql_script)
+        conn = self.connection
+        if conn._slice_time is None:
+            await self.schedule(self._cursor.executescript, sql_script)
+        else:
+            await conn._run_sliced(_ScriptSlicer(self._cursor, sql_script, conn._slice_time,
+                                                 conn._slice_guard))
         return self
 
-    async def fetchall(self):
-        return await self.schedule(self._cursor.fetchall)
+    async def executemany_stream(self, sql, parameters, /, *, chunk_size=1000,
+                                 commit_every=None):
+        '''Like executemany() but parameters is an asynchronous iterable.  It is consumed
+        in chunks of chunk_size rows, the next chunk being produced while the previous one
+        is inserted.  If commit_every is not None, commit after every chunk that takes the
+        rows inserted since the last commit to at least that many, and at the end.'''
+        await _executemany_stream(self.schedule, self._cursor, sql, parameters, chunk_size,
+                                  commit_every)
+        return self
 
-    async def fetchmany(self, size=None):
-        return await self.schedule(self._cursor.fetchmany, size)
+    async def fetchall(self, *, max_bytes=None, partial=False):
+        '''Fetch the remaining rows.  max_bytes defaults to the connection's max_fetch_bytes;
+        if not None rows are fetched within that budget, see _fetch_within_budget().'''
+        if max_bytes is None:
+            max_bytes = self.connection._max_fetch_bytes
+        if max_bytes is None:
+            pending, self._pending = self._pending, []
+            slice_rows = self.connection._fetch_slice_rows
+            if slice_rows:
+                rows = await self.schedule(_fetch_sliced, self._cursor, None, slice_rows)
+            else:
+                rows = await self.schedule(self._cursor.fetchall)
+            return pending + rows if pending else rows
+        return await self._fetch_within_budget(None, max_bytes, partial)
+
+    async def fetchmany(self, size=None, *, max_bytes=None, partial=False):
+        if max_bytes is None:
+            max_bytes = self.connection._max_fetch_bytes
+        if max_bytes is None:
+            if size is None:
+                size = self._cursor.arraysize
+            pending = []
+            if self._pending and size > 0:
+                pending, self._pending = self._pending, []
+                size -= 1
+                if not size:
+                    return pending
+            slice_rows = self.connection._fetch_slice_rows
+            if slice_rows and size > slice_rows:
+                rows = await self.schedule(_fetch_sliced, self._cursor, size, slice_rows)
+            else:
+                rows = await self.schedule(self._cursor.fetchmany, size)
+            return pending + rows if pending else rows
+        if size is None:
+            size = self._cursor.arraysize
+        return await self._fetch_within_budget(size, max_bytes, partial)
+
+    async def _fetch_within_budget(self, size, max_bytes, partial):
+        '''Fetch up to size rows, or all rows if size is None, stopping once their estimated
+        size would exceed max_bytes.  Then if partial is true the rows fetched are returned,
+        and truncated is set if rows remain; they can be fetched by further calls.
+        Otherwise FetchBudgetError is raised.'''
+        conn = self.connection
+        pending, self._pending = self._pending, []
+        try:
+            rows, size, self._pending = await self.schedule(
+                _fetch_budgeted, self._cursor, pending, size, max_bytes, partial)
+        except FetchBudgetError as e:
+            conn._record_fetch(len(e.rows), e.size, True)
+            raise
+        self.truncated = bool(self._pending)
+        conn._record_fetch(len(rows), size, self.truncated)
+        return rows
 
     async def fetchone(self):
+        if self._pending:
+            return self._pending.pop()
         return await self.schedule(self._cursor.fetchone)
 
     async def setinputsizes(self, sizes):
@@ -104,50 +812,446 @@ class Cursor:
         self._cursor.row_factory = value
 
 
+class PreparedStatement:
+    '''A statement returned by Connection.prepare().  Its SQL was validated when prepared
+    and compiled into the connection's statement cache, so executions reuse the compiled
+    statement while it remains cached.  execution_count counts its executions.'''
+
+    def __init__(self, conn, sql):
+        self.connection = conn
+        self.sql = sql
+        self.execution_count = 0
+
+    def __repr__(self):
+        return f'<PreparedStatement {self.sql!r} executions={self.execution_count:,d}>'
+
+    async def execute(self, parameters=(), /):
+        self.execution_count += 1
+        return await self.connection.execute(self.sql, parameters)
+
+    async def executemany(self, parameters, /):
+        self.execution_count += 1
+        return await self.connection.executemany(self.sql, parameters)
+
+    async def fetch_all(self, parameters=(), /):
+        self.execution_count += 1
+        return await self.connection.fetch_all(self.sql, parameters)
+
+    async def fetch_one(self, parameters=(), /):
+        self.execution_count += 1
+        return await self.connection.fetch_one(self.sql, parameters)
+
+    async def fetch_value(self, parameters=(), /, default=None):
+        self.execution_count += 1
+        return await self.connection.fetch_value(self.sql, parameters, default)
+
+    async def fetch_column(self, parameters=(), /):
+        self.execution_count += 1
+        return await self.connection.fetch_column(self.sql, parameters)
+
+    async def exists(self, parameters=(), /):
+        self.execution_count += 1
+        return await self.connection.exists(self.sql, parameters)
+
+
 class Connection:
     '''An asynchronous wrapper around an sqlite3.Connection object.'''
 
-    def __init__(self):
+    def __init__(self, *, max_queue_size=0, max_queue_wait=None, pool=None, slice_time=None,
+                 callback_stats=False, meter_steps=0, max_fetch_bytes=None, span_hook=None,
+                 stall_timeout=None, interrupt_stalled=False, on_stall=None,
+                 fetch_slice_rows=0, write_behind_interval=0.05, write_behind_rows=1000,
+                 on_write_error=None, warm_statements=()):
         self._jobs = queue.Queue()
         self._closed = True
         self._conn = None
         self._loop = asyncio.get_running_loop()
         self._thread = None
+        # If a WorkerPool is given its threads run our jobs, otherwise we have our own thread.
+        # _serving is True while the connection is on the pool's ready queue or being served.
+        self._pool = pool
+        self._serving = False
+        self._serving_lock = threading.Lock()
+        # Queue bounds.  A max_queue_size of zero means unbounded; a max_queue_wait of None
+        # means jobs are never rejected or shed.
+        self._max_queue_size = max_queue_size
+        self._max_queue_wait = max_queue_wait
+        # Jobs in _jobs or running, jobs waiting for space, of which there are at most
+        # max_queue_size, and futures of wait_for_space() callers.  Only accessed from the
+        # event loop thread.
+        self._queue_depth = 0
+        self._waiting = collections.deque()
+        self._space_waiters = collections.deque()
+        # Moving average of job execution time, used to estimate the queue wait
+        self._job_time = 0.0
+        self.rejected_count = 0
+        self.shed_count = 0
+        # If slice_time is not None, executemany() and executescript() are split into jobs
+        # taking about that long.  _slice_rows is the current estimate of rows per slice.
+        self._slice_time = slice_time
+        self._slice_rows = 256
+        self._slice_lock = asyncio.Lock()
+        self._slice_guard = None if slice_time is None else _SliceGuard()
+        # Statement tracking, needed by callback statistics and step metering
+        self._tracker = None
+        self._callback_stats = None
+        self._step_meter = None
+        if callback_stats or meter_steps:
+            self._tracker = _StatementTracker()
+            if callback_stats:
+                self._callback_stats = _CallbackStats(self._tracker)
+            if meter_steps:
+                self._step_meter = _StepMeter(meter_steps)
+                self._tracker.listeners.append(self._step_meter)
+        # Called in the event loop thread after a job commits changes
+        self._commit_listeners = []
+        self._committed_changes = 0
+        # total_changes when a transaction last ended, if there are commit listeners.  Only
+        # accessed from the database thread.
+        self._settled_changes = 0
+        # Memoized SQL functions keyed by (lower-case name, narg)
+        self._memoized = {}
+        # Single-flight reads: (sql, parameters) -> future of the job running the query
+        self._in_flight = {}
+        self.shared_read_count = 0
+        self.deduplicated_read_count = 0
+        # The default byte budget of cursor fetches, and the high-water marks of budgeted
+        # fetches
+        self._max_fetch_bytes = max_fetch_bytes
+        self.fetch_high_water_rows = 0
+        self.fetch_high_water_bytes = 0
+        self.fetch_budget_exceeded_count = 0
+        # If non-zero, fetches build rows this many at a time, releasing the GIL in between
+        self._fetch_slice_rows = fetch_slice_rows
+        # A SpanHook or None
+        self.span_hook = span_hook
+        # The running job as (func, args, start time, thread ident), or None.  Set in the
+        # database thread and read by health() and the stall watchdog.
+        self._running = None
+        self._stall_timeout = stall_timeout
+        self._interrupt_stalled = interrupt_stalled
+        self._on_stall = on_stall
+        self._watchdog = None
+        self._stalled_job = None
+        self.stall_count = 0
+        # Write-behind buffer: a list of [sql, parameter rows] runs, flushed by a timer or
+        # when it reaches write_behind_rows rows.  Only accessed from the event loop thread.
+        self._write_behind_interval = write_behind_interval
+        self._write_behind_rows = write_behind_rows
+        self._on_write_error = on_write_error
+        self._write_buffer = []
+        self._buffered_writes = 0
+        self._write_buffer_start = None
+        self._write_timer = None
+        self.flushed_write_count = 0
+        self.write_flush_count = 0
+        self.write_error_count = 0
+        self.last_flush_lag = 0.0
+        self.max_flush_lag = 0.0
+        # Flushes not yet known to be committed, by id: (count, start) for the event loop
+        # thread, and the ids of flushes that joined an open transaction for the database
+        # thread
+        self._flush_ids = itertools.count()
+        self._unconfirmed_flushes = {}
+        self._joined_flushes = set()
+        # Prepared statements keyed by SQL, and the SQL to prepare on connecting
+        self._prepared = {}
+        self._warm_statements = list(warm_statements)
 
     async def _connect(self, database, kwargs):
-        self._thread = threading.Thread(target=asyncio.run, args=(self._thread_loop(), ))
-        self._thread.start()
+        if self._pool is None:
+            self._thread = threading.Thread(target=asyncio.run, args=(self._thread_loop(), ))
+            self._thread.start()
         self._closed = False
+        if self._stall_timeout is not None:
+            self._watchdog = self._loop.create_task(self._watch())
         self._conn = await self.schedule(sqlite3.connect, database, **kwargs)
+        if self._step_meter:
+            await self.schedule(self._conn.set_progress_handler, self._step_meter.handler,
+                                self._step_meter.granularity)
+        if self._warm_statements:
+            await self._prepare(self._warm_statements)
 
     async def _thread_loop(self):
-        def set_result(future, value):
-            if not future.done():
-                future.set_result(value)
-
-        def set_exception(future, exc):
-            if not future.done():
-                future.set_exception(exc)
-
-        call_soon = self._loop.call_soon_threadsafe
+        jobs = self._jobs
+        run_job = self._run_job
         while True:
-            item = self._jobs.get()
+            item = jobs.get()
             if item is None:
                 break
-
-            future, func, args, kwargs = item
+            run_job(item)
+
+    def _run_pending(self, count):
+        '''Called in a pool thread to run up to count queued jobs.  Returns True if jobs
+        remain, in which case the caller must serve the connection again.'''
+        for _ in range(count):
+            with self._serving_lock:
+                try:
+                    item = self._jobs.get_nowait()
+                except queue.Empty:
+                    self._serving = False
+                    return False
+            self._run_job(item)
+        return True
+
+    def _run_job(self, item):
+        future, func, args, kwargs, deadline, context, queued = item
+        guard = self._slice_guard
+        if guard is not None:
+            if guard.active and not self._may_run_while_slicing(func):
+                guard.held_jobs.append(item)
+                return
+            guard.denied = False
+        call_soon = self._loop.call_soon_threadsafe
+        start = time.monotonic()
+        if deadline is not None and start > deadline:
+            call_soon(self._job_shed, future)
+            return
+        tracker = self._tracker
+        span_hook = self.span_hook
+        self._running = (func, args, start, threading.get_ident())
+        try:
+            if tracker is not None:
+                tracker.begin_job(func, args)
             try:
-                call_soon(set_result, future, func(*args, **kwargs))
-            except BaseException as e:
-                call_soon(set_exception, future, e)
+                if span_hook is None:
+                    result = context.run(func, *args, **kwargs)
+                else:
+                    result = context.run(_run_in_span, span_hook, start - queued, func, args,
+                                         kwargs)
+            except BaseException:
+                if tracker is not None:
+                    tracker.end_job(None)
+                raise
+            if tracker is not None:
+                tracker.end_job(result)
+            self._running = None
+            self._job_ran(func)
+            call_soon(self._job_done, future, time.monotonic() - start, result, None)
+        except BaseException as e:
+            self._running = None
+            if guard is not None and guard.denied:
+                # The denied statement was not run, and the job only read before it, so
+                # it can run again from the start once the slices finish
+                guard.held_jobs.append(item)
+                return
+            self._job_ran(func)
+            call_soon(self._job_done, future, time.monotonic() - start, None, e)
+        if guard is not None and guard.held_jobs and not guard.active:
+            held_jobs, guard.held_jobs = guard.held_jobs, []
+            for held_job in held_jobs:
+                self._run_job(held_job)
+
+    def _may_run_while_slicing(self, func):
+        '''Return True if a job calling func may start between the slices of a sliced
+        operation.'''
+        guard = self._slice_guard
+        if getattr(func, '__self__', None) is guard.slicer or func == self._end_slicing:
+            return True
+        # Jobs run in order, so once one is held all later ones are
+        return not guard.held_jobs and _reads_first(func)
+
+    def _job_ran(self, func):
+        '''Called in the database thread after a job has run, before its result is reported.
+        If it ended a transaction, tells commit listeners and write-behind flushes that
+        joined the transaction.'''
+        conn = self._conn
+        if conn is None or not (self._joined_flushes or self._commit_listeners):
+            return
+        if func == conn.close:
+            # Closing rolls back an open transaction
+            if self._joined_flushes:
+                self._confirm_flushes(True)
+            return
+        if conn.in_transaction and not (
+                # With autocommit False, committing or rolling back opens a new transaction
+                getattr(conn, 'autocommit', None) is False
+                and (func == conn.commit or func == conn.rollback)):
+            return
+        if self._joined_flushes:
+            self._confirm_flushes(False)
+        if self._commit_listeners:
+            self._settled_changes = conn.total_changes
+            self._loop.call_soon_threadsafe(self._check_commit, self._settled_changes)
+
+    def _confirm_flushes(self, closed):
+        '''Report whether the transaction that write-behind flushes joined committed them.
+        closed is True if closing the connection rolled it back.'''
+        conn = self._conn
+        if closed:
+            committed = set()
+        else:
+            try:
+                committed = {row[0] for row in
+                             conn.execute('SELECT id FROM temp.asqlite3_write_behind')}
+            except sqlite3.OperationalError:
+                # Creating the table was rolled back too
+                committed = set()
+            if committed:
+                in_transaction = conn.in_transaction
+                conn.execute('DELETE FROM temp.asqlite3_write_behind')
+                if not in_transaction:
+                    conn.commit()
+        flush_ids, self._joined_flushes = self._joined_flushes, set()
+        call_soon = self._loop.call_soon_threadsafe
+        for flush_id in flush_ids:
+            if flush_id in committed:
+                call_soon(self._report_flush, flush_id, None)
+            else:
+                call_soon(self._report_flush, flush_id,
+                          RuntimeError('the transaction a write-behind flush joined was '
+                                       'rolled back'))
+
+    def _job_done(self, future, elapsed, result, exc):
+        '''Called in the event loop thread when a job has run.'''
+        self._job_time += (elapsed - self._job_time) * 0.125
+        self._job_finished()
+        if not future.done():
+            if exc is None:
+                future.set_result(result)
+            else:
+                future.set_exception(exc)
+
+    def _check_commit(self, changes):
+        '''Called in the event loop thread after a job ends a transaction, with the
+        connection's total_changes.'''
+        if self._closed:
+            return
+        # Rolled back changes are counted too, so listeners can be called spuriously
+        if changes != self._committed_changes:
+            self._committed_changes = changes
+            for listener in list(self._commit_listeners):
+                listener()
+
+    def _job_shed(self, future):
+        '''Called in the event loop thread when a job has waited longer than max_queue_wait.'''
+        self.shed_count += 1
+        self._job_finished()
+        if not future.done():
+            future.set_exception(OverloadedError('job shed after exceeding the maximum '
+                                                 'queue wait'))
+
+    def _job_finished(self):
+        self._queue_depth -= 1
+        if self._waiting and not self._closed:
+            self._put_job(self._waiting.popleft())
+        if self._space_waiters and self.queue_depth < self._max_queue_size:
+            self._wake_space_waiter()
+
+    def _wake_space_waiter(self):
+        while self._space_waiters:
+            waiter = self._space_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def _put_job(self, job):
+        self._queue_depth += 1
+        if self._pool is None:
+            self._jobs.put(job)
+        else:
+            with self._serving_lock:
+                self._jobs.put(job)
+                if self._serving:
+                    return
+                self._serving = True
+            self._pool._ready.put(self)
 
     def schedule(self, func, *args, **kwargs):
         if self._closed:
             raise RuntimeError('DB connection is closed')
+        queued = time.monotonic()
+        deadline = None
+        if self._max_queue_wait is not None:
+            depth = self._queue_depth + len(self._waiting)
+            if depth * self._job_time > self._max_queue_wait:
+                self.rejected_count += 1
+                raise OverloadedError(f'expected queue wait exceeds {self._max_queue_wait}s')
+            deadline = queued + self._max_queue_wait
         future = self._loop.create_future()
-        self._jobs.put((future, func, args, kwargs))
+        # The job runs in a copy of the caller's context so context variables propagate
+        job = (future, func, args, kwargs, deadline, contextvars.copy_context(), queued)
+        if self._max_queue_size and self._queue_depth >= self._max_queue_size:
+            if len(self._waiting) >= self._max_queue_size:
+                self.rejected_count += 1
+                raise OverloadedError(f'more than {self._max_queue_size} jobs are waiting '
+                                      'for space in the queue')
+            # Wait for space; the job is queued when an earlier job finishes
+            self._waiting.append(job)
+        else:
+            self._put_job(job)
         return future
 
+    async def wait_for_space(self):
+        '''Wait until a job can be scheduled without waiting for space in the queue.  Producers
+        can call this before schedule() to feel backpressure.'''
+        while not self._closed and self._max_queue_size and (self.queue_depth
+                                                             >= self._max_queue_size):
+            waiter = self._loop.create_future()
+            self._space_waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Pass the wakeup on if it came as we were cancelled
+                if waiter.done() and not waiter.cancelled():
+                    self._wake_space_waiter()
+                raise
+
+    async def _watch(self):
+        '''Report a job running longer than the stall timeout, once.'''
+        stall_timeout = self._stall_timeout
+        while True:
+            await asyncio.sleep(stall_timeout / 4)
+            running = self._running
+            if running is None or running is self._stalled_job:
+                continue
+            elapsed = time.monotonic() - running[2]
+            if elapsed >= stall_timeout:
+                self._stalled_job = running
+                # The watchdog must survive a failing report
+                try:
+                    self._report_stall(running, elapsed)
+                except Exception:
+                    logger.exception('error reporting a stalled database job')
+
+    def _report_stall(self, running, elapsed):
+        func, args, _, ident = running
+        frame = sys._current_frames().get(ident)
+        stack = ''.join(traceback.format_stack(frame)) if frame else ''
+        report = StallReport(_job_sql(func, args), elapsed, self.queue_depth, stack)
+        self.stall_count += 1
+        if self._interrupt_stalled:
+            self._conn.interrupt()
+        if self._on_stall is None:
+            logger.warning(f'database job stalled for {elapsed:.1f}s running {report.sql!r} '
+                           f'with {report.queue_depth} jobs queued:\n{stack}')
+        else:
+            self._on_stall(report)
+
+    def health(self):
+        '''Return a dictionary describing the health of the connection, for example for a
+        readiness probe.'''
+        running = self._running
+        elapsed = time.monotonic() - running[2] if running else None
+        stalled = (elapsed is not None and self._stall_timeout is not None
+                   and elapsed >= self._stall_timeout)
+        return {
+            'healthy': not self._closed and not stalled,
+            'closed': self._closed,
+            'queue_depth': self.queue_depth,
+            'running_sql': _job_sql(running[0], running[1]) if running else None,
+            'running_time': elapsed,
+            'stalled': stalled,
+            'stall_count': self.stall_count,
+            'rejected_count': self.rejected_count,
+            'shed_count': self.shed_count,
+        }
+
+    @property
+    def queue_depth(self):
+        '''The number of jobs queued, running or waiting for space in the queue.'''
+        return self._queue_depth + len(self._waiting)
+
     async def __aenter__(self):
         return self
 
@@ -169,44 +1273,411 @@ class Connection:
 
     async def close(self):
         if not self._closed:
-            if self._conn:
-                self.schedule(self._conn.close)  # No need to await this
+            # Buffered writes are written before closing
+            flush = self._flush_writes()
             # Prevent new jobs being added to the queue, and wait for existing jobs to complete
             self._closed = True
-            self._jobs.put(None)
-            self._thread.join()
+            if self._watchdog:
+                self._watchdog.cancel()
+            # Jobs waiting for space are queued regardless of the bound, and are never shed
+            while self._waiting:
+                self._put_job(self._waiting.popleft())
+            while self._space_waiters:
+                self._wake_space_waiter()
+            if self._slice_guard and self._conn:
+                self._put_job(_close_job(self._loop.create_future(), self._end_slicing))
+            if self._pool is None:
+                if self._conn:
+                    # No need to await this
+                    self._put_job(_close_job(self._loop.create_future(), self._conn.close))
+                self._jobs.put(None)
+                self._thread.join()
+            else:
+                # Pool threads are shared, so wait for the final job instead of a thread
+                future = self._loop.create_future()
+                self._put_job(_close_job(future, self._conn.close if self._conn else _no_op))
+                await asyncio.wait((future, ))
+            if flush is not None:
+                await asyncio.wait((flush, ))
+
+    def _end_slicing(self):
+        '''Stop guarding a sliced operation abandoned on closing, so held jobs run.'''
+        if self._slice_guard.active:
+            self._slice_guard.deactivate(self._conn)
+
+    def submit_write(self, sql, parameters=(), /):
+        '''Buffer a write statement to be executed later with others in one transaction, and
+        return immediately.  Errors are reported to the on_write_error callback.  Note this
+        method is synchronous.'''
+        if self._closed:
+            raise RuntimeError('DB connection is closed')
+        buffer = self._write_buffer
+        if buffer and buffer[-1][0] == sql:
+            buffer[-1][1].append(parameters)
+        else:
+            buffer.append([sql, [parameters]])
+        self._buffered_writes += 1
+        if self._buffered_writes >= self._write_behind_rows:
+            self._flush_writes()
+        elif self._write_timer is None:
+            self._write_buffer_start = self._loop.time()
+            self._write_timer = self._loop.call_later(self._write_behind_interval,
+                                                      self._flush_writes)
+
+    def _flush_writes(self):
+        if self._write_timer is not None:
+            self._write_timer.cancel()
+            self._write_timer = None
+        buffer, self._write_buffer = self._write_buffer, []
+        count, self._buffered_writes = self._buffered_writes, 0
+        start, self._write_buffer_start = self._write_buffer_start, None
+        if not buffer:
+            return None
+        flush_id = next(self._flush_ids)
+        self._unconfirmed_flushes[flush_id] = (count, start or self._loop.time())
+        try:
+            future = self.schedule(_write_runs, self._conn, buffer, flush_id,
+                                   self._joined_flushes)
+        except Exception as e:
+            future = self._loop.create_future()
+            future.set_exception(e)
+        future.add_done_callback(functools.partial(self._writes_flushed, flush_id))
+        return future
+
+    def _writes_flushed(self, flush_id, future):
+        if future.cancelled():
+            self._unconfirmed_flushes.pop(flush_id, None)
+            return
+        exc = future.exception()
+        # Writes that joined an open transaction are reported once it ends
+        if exc is not None or future.result():
+            self._report_flush(flush_id, exc)
+
+    def _report_flush(self, flush_id, exc):
+        try:
+            count, start = self._unconfirmed_flushes.pop(flush_id)
+        except KeyError:
+            return
+        if exc is None:
+            self.flushed_write_count += count
+            self.write_flush_count += 1
+            self.last_flush_lag = self._loop.time() - start
+            self.max_flush_lag = max(self.max_flush_lag, self.last_flush_lag)
+        else:
+            self.write_error_count += count
+            if self._on_write_error is None:
+                logger.error(f'write-behind flush of {count:,d} writes failed: {exc!r}')
+            else:
+                self._on_write_error(exc, count)
+
+    async def flush_writes(self):
+        '''Flush buffered writes now, and wait until they are written.  Writes joining an open
+        transaction are only reported as flushed once it commits.'''
+        future = self._flush_writes()
+        if future is not None:
+            await asyncio.wait((future, ))
+
+    @property
+    def buffered_writes(self):
+        '''The number of writes buffered by submit_write() not yet passed to a job.'''
+        return self._buffered_writes
 
     async def execute(self, sql, parameters=(), /):
         cursor = await self.schedule(self._conn.execute, sql, parameters)
         return Cursor(self.schedule, cursor)
 
     async def executemany(self, sql, parameters, /):
+        if self._slice_time is not None:
+            return await (await self.cursor()).executemany(sql, parameters)
         cursor = await self.schedule(self._conn.executemany, sql, parameters)
         return Cursor(self.schedule, cursor)
 
     async def executescript(self, sql_script, /):
+        if self._slice_time is not None:
+            return await (await self.cursor()).executescript(sql_script)
         cursor = await self.schedule(self._conn.executescript, sql_script)
         return Cursor(self.schedule, cursor)
 
-    async def create_function(self, name, narg, func, /, *, deterministic=False):
+    async def _run_sliced(self, slicer):
+        '''Run the slices of slicer as separate jobs so other jobs can run between them.'''
+        # Savepoints of concurrent sliced operations must not interleave
+        async with self._slice_lock:
+            try:
+                while not await self.schedule(slicer.run_slice):
+                    pass
+            except BaseException:
+                if not self._closed:
+                    await asyncio.shield(self.schedule(slicer.abort))
+                raise
+            if isinstance(slicer, _ManySlicer):
+                self._slice_rows = slicer.rows
+
+    async def executemany_stream(self, sql, parameters, /, *, chunk_size=1000,
+                                 commit_every=None):
+        cursor = await self.cursor()
+        return await cursor.executemany_stream(sql, parameters, chunk_size=chunk_size,
+                                               commit_every=commit_every)
+
+    async def bulk_load(self, table, rows, /, *, columns=None, batch_size=10000,
+                        cache_size=-65536):
+        '''Insert rows into table quickly.  Returns the number of rows inserted.
+
+        The table's indexes and triggers are dropped, the rows inserted in batches with a
+        larger page cache and, outside a transaction, synchronous=OFF.  Then the indexes and
+        triggers are recreated and the pragmas restored.  It all happens inside a
+        savepoint, so if anything fails the table is left as it was.
+        '''
+        return await self.schedule(_bulk_load, self._conn, table, rows, columns, batch_size,
+                                   cache_size)
+
+    async def insert_columns(self, table, columns, /):
+        '''Insert rows into table from columns, a mapping of column name to a sequence of
+        values such as a list, an array.array, a memoryview or a NumPy array.  The columns
+        are iterated lazily, in the database thread, so no list of rows is built.  Returns
+        the number of rows inserted.'''
+        names = list(columns)
+        lengths = {len(columns[name]) for name in names}
+        if len(lengths) != 1:
+            raise ValueError('columns must be non-empty and of equal length')
+        rows = zip(*(_iter_column(columns[name]) for name in names))
+        await self.executemany(_insert_sql(table, names), rows)
+        return lengths.pop()
+
+    async def fetch_shared(self, sql, parameters=(), /):
+        '''Execute the read statement sql and return all its rows as a tuple.  If an
+        identical query with identical parameters is already queued or running, its result
+        is shared instead of scheduling another job.'''
+        key = _single_flight_key(sql, parameters)
+        future = self._in_flight.get(key) if key is not None else None
+        if future is None:
+            future = self._schedule_fetch(sql, parameters, 'tuple')
+            self.shared_read_count += 1
+            if key is not None:
+                self._in_flight[key] = future
+                future.add_done_callback(functools.partial(self._single_flight_done, key))
+        else:
+            self.deduplicated_read_count += 1
+        # Cancelling one caller must not cancel the query for the others
+        rows, _ = await asyncio.shield(future)
+        return rows
+
+    async def fetch_all(self, sql, parameters=(), /):
+        '''Execute sql and return a list of all its rows, in a single job.'''
+        rows, _ = await self._schedule_fetch(sql, parameters)
+        return rows
+
+    async def fetch_one(self, sql, parameters=(), /):
+        '''Execute sql and return its first row, or None, in a single job.'''
+        return await self.schedule(_fetch_one, self._conn, sql, parameters)
+
+    async def fetch_value(self, sql, parameters=(), /, default=None):
+        '''Execute sql and return the first column of its first row, or default if there
+        are no rows, in a single job.'''
+        row = await self.schedule(_fetch_one, self._conn, sql, parameters)
+        return default if row is None else row[0]
+
+    async def fetch_column(self, sql, parameters=(), /):
+        '''Execute sql and return a list of the first column of each row, in a single
+        job.'''
+        rows, _ = await self._schedule_fetch(sql, parameters, 'column')
+        return rows
+
+    def _schedule_fetch(self, sql, parameters, shape='list'):
+        '''Schedule fetching all the rows of sql, within the connection's max_fetch_bytes
+        budget and fetch_slice_rows slice size.'''
+        future = self.schedule(_fetch_rows, self._conn, sql, parameters, self._max_fetch_bytes,
+                               self._fetch_slice_rows, shape)
+        if self._max_fetch_bytes is not None:
+            future.add_done_callback(self._rows_fetched)
+        return future
+
+    def _rows_fetched(self, future):
+        if future.cancelled():
+            return
+        exc = future.exception()
+        if exc is None:
+            rows, size = future.result()
+            self._record_fetch(len(rows), size, False)
+        elif isinstance(exc, FetchBudgetError):
+            self._record_fetch(len(exc.rows), exc.size, True)
+
+    async def exists(self, sql, parameters=(), /):
+        '''Execute sql and return True if it returns a row, in a single job.'''
+        return await self.schedule(_fetch_one, self._conn, sql, parameters) is not None
+
+    async def fetch_json(self, sql, parameters=(), /, *, as_bytes=False):
+        '''Execute the query sql and return its rows serialized by SQLite as a JSON array of
+        objects keyed by column name, as a str, or UTF-8 encoded bytes if as_bytes is
+        true.'''
+        return await self.schedule(_fetch_json, self._conn, sql, parameters, as_bytes)
+
+    async def fetch_json_stream(self, sql, parameters=(), /, *, batch_size=1000,
+                                as_bytes=False):
+        '''Like fetch_json() but an asynchronous iterator of pieces of the JSON array,
+        serializing batch_size rows per piece.  Their concatenation is the JSON array.'''
+        cursor = await self.schedule(_open_json_cursor, self._conn, sql, parameters)
+        try:
+            prefix = '['
+            while True:
+                chunk = await self.schedule(_fetch_json_chunk, cursor, batch_size, prefix,
+                                            as_bytes)
+                if chunk is None:
+                    break
+                yield chunk
+                prefix = ','
+            end = '[]' if prefix == '[' else ']'
+            yield end.encode() if as_bytes else end
+        finally:
+            if not self._closed:
+                await self.schedule(cursor.close)
+
+    async def prepare(self, sql, /):
+        '''Validate the statement sql, compiling it into the statement cache without
+        executing it, and return a PreparedStatement to execute it.  Preparing the same SQL
+        again returns the same PreparedStatement.'''
+        return (await self._prepare([sql]))[0]
+
+    async def _prepare(self, statements):
+        new = [sql for sql in dict.fromkeys(statements) if sql not in self._prepared]
+        if new:
+            await self.schedule(_prepare_statements, self._conn, new)
+            for sql in new:
+                self._prepared.setdefault(sql, PreparedStatement(self, sql))
+        return [self._prepared[sql] for sql in statements]
+
+    def hot_statements(self, top=None):
+        '''Return the SQL of prepared statements, most executed first, limited to top if it
+        is not None.  Suitable for recording and passing as warm_statements to connect().'''
+        handles = sorted(self._prepared.values(), key=lambda handle: handle.execution_count,
+                         reverse=True)
+        return [handle.sql for handle in handles[:top]]
+
+    def statement_stats(self):
+        '''Return a dictionary mapping the SQL of each prepared statement to its execution
+        count.'''
+        return {sql: handle.execution_count for sql, handle in self._prepared.items()}
+
+    def _record_fetch(self, rows, size, exceeded):
+        self.fetch_high_water_rows = max(self.fetch_high_water_rows, rows)
+        self.fetch_high_water_bytes = max(self.fetch_high_water_bytes, size)
+        self.fetch_budget_exceeded_count += exceeded
+
+    def _single_flight_done(self, key, future):
+        if self._in_flight.get(key) is future:
+            del self._in_flight[key]
+
+    async def create_function(self, name, narg, func, /, *, deterministic=False, memoize=0):
+        '''If memoize is non-zero the deterministic function's results are cached in an LRU
+        of that size, keyed by its arguments.'''
+        memoized = None
+        if memoize and func is not None:
+            if not deterministic:
+                raise ValueError('only deterministic functions can be memoized')
+            func = memoized = _MemoizedFunction(func, memoize)
+        func = self._instrument(f'function:{name}', func)
         await self.schedule(self._conn.create_function, name, narg, func,
                             deterministic=deterministic)
+        # Re-registration replaces the function and so discards its cache
+        key = (name.lower(), narg)
+        if memoized:
+            self._memoized[key] = memoized
+        else:
+            self._memoized.pop(key, None)
+
+    def memoize_stats(self):
+        '''Return a dictionary of statistics for each memoized function, keyed by
+        (name, narg).'''
+        return {key: func.stats() for key, func in self._memoized.items()}
 
     async def create_aggregate(self, name, narg, aggregate_class, /):
+        aggregate_class = self._instrument_aggregate(f'aggregate:{name}', aggregate_class)
         await self.schedule(self._conn.create_aggregate, name, narg, aggregate_class)
 
     async def create_collation(self, name, callable, /):
+        callable = self._instrument(f'collation:{name}', callable)
         await self.schedule(self._conn.create_collation, name, callable)
 
     async def set_authorizer(self, authorizer_callback, /):
-        await self.schedule(self._conn.set_authorizer, authorizer_callback)
+        authorizer_callback = self._instrument('authorizer', authorizer_callback)
+        if self._slice_guard:
+            await self.schedule(self._slice_guard.set_authorizer, self._conn,
+                                authorizer_callback)
+        else:
+            await self.schedule(self._conn.set_authorizer, authorizer_callback)
 
     async def set_progress_handler(self, handler, /, n):
-        await self.schedule(self._conn.set_progress_handler, handler, n)
+        if self._step_meter:
+            # SQLite has a single progress handler, which the step meter chains to
+            await self.schedule(self._step_meter.set_user_handler, handler, n)
+        else:
+            await self.schedule(self._conn.set_progress_handler, handler, n)
+
+    async def step_stats(self, top=None):
+        '''Return the VM steps of statements, most expensive first.  See the meter_steps
+        argument of connect().'''
+        if self._step_meter is None:
+            raise RuntimeError('step metering is not enabled')
+        return await self.schedule(self._step_meter.snapshot, top)
+
+    async def reset_step_stats(self):
+        if self._step_meter is None:
+            raise RuntimeError('step metering is not enabled')
+        await self.schedule(self._step_meter.totals.clear)
+
+    async def set_step_budget(self, steps, /, sql=None):
+        '''Abort statements running more than steps VM steps.  If sql is given the budget
+        applies to statements with its normalized form, otherwise it is the default.  A
+        steps of None removes the budget.'''
+        if self._step_meter is None:
+            raise RuntimeError('step metering is not enabled')
+        await self.schedule(self._step_meter.set_budget, steps, sql)
 
     async def set_trace_callback(self, trace_callback, /):
+        trace_callback = self._instrument('trace', trace_callback)
         await self.schedule(self._conn.set_trace_callback, trace_callback)
 
+    async def _add_statement_listener(self, listener):
+        '''Add an object whose begin_job() and end_job() methods are called in the database
+        thread with the statement tracker around each job.'''
+        await self.schedule(self._attach_statement_listener, listener)
+
+    async def _remove_statement_listener(self, listener):
+        await self.schedule(self._detach_statement_listener, listener)
+
+    def _attach_statement_listener(self, listener):
+        if self._tracker is None:
+            self._tracker = _StatementTracker()
+        self._tracker.listeners.append(listener)
+
+    def _detach_statement_listener(self, listener):
+        tracker = self._tracker
+        tracker.listeners.remove(listener)
+        # Stop tracking statements if only listeners needed it
+        if not tracker.listeners and self._callback_stats is None:
+            self._tracker = None
+
+    def _instrument(self, name, callable):
+        if self._callback_stats is None or callable is None:
+            return callable
+        return functools.partial(self._callback_stats.call, name, callable)
+
+    def _instrument_aggregate(self, name, aggregate_class):
+        if self._callback_stats is None or aggregate_class is None:
+            return aggregate_class
+        return _instrumented_aggregate(self._callback_stats, name, aggregate_class)
+
+    async def callback_stats(self):
+        '''Return the statistics of instrumented callbacks.  See the callback_stats argument
+        of connect().'''
+        if self._callback_stats is None:
+            raise RuntimeError('callback statistics are not enabled')
+        return await self.schedule(self._callback_stats.snapshot)
+
+    async def reset_callback_stats(self):
+        if self._callback_stats is None:
+            raise RuntimeError('callback statistics are not enabled')
+        await self.schedule(self._callback_stats.reset)
+
     if hasattr(sqlite3.Connection, 'enable_load_extension'):
         async def enable_load_extension(self, enable):
             await self.schedule(self._conn.enable_load_extension, enable)
@@ -214,6 +1685,45 @@ class Connection:
         async def load_extension(self, path):
             await self.schedule(self._conn.load_extension, path)
 
+    async def paginate(self, sql, key_columns, page_size=100, /, *, parameters=(),
+                       descending=False):
+        '''An async iterator over the rows of the query sql in pages, lists of at most
+        page_size rows, ordered by key_columns.  Each page is a short statement seeking past
+        the last key of the previous page, so no locks are held between pages.'''
+        if isinstance(key_columns, str):
+            key_columns = [key_columns]
+        keys = ', '.join(_quote(column) for column in key_columns)
+        direction = ' DESC' if descending else ''
+        order_by = ', '.join(f'{_quote(column)}{direction}' for column in key_columns)
+        named = isinstance(parameters, dict)
+        if named:
+            markers = ', '.join(f':_asqlite3_key{n}' for n in range(len(key_columns)))
+            limit = ':_asqlite3_limit'
+        else:
+            markers = ', '.join('?' * len(key_columns))
+            limit = '?'
+        first_sql = f'SELECT * FROM ({sql}) ORDER BY {order_by} LIMIT {limit}'
+        next_sql = (f'SELECT * FROM ({sql}) WHERE ({keys}) {"<" if descending else ">"} '
+                    f'({markers}) ORDER BY {order_by} LIMIT {limit}')
+        key = None
+        while True:
+            if named:
+                page_parameters = dict(parameters, _asqlite3_limit=page_size)
+                if key is not None:
+                    page_parameters.update((f'_asqlite3_key{n}', value)
+                                           for n, value in enumerate(key))
+            else:
+                page_parameters = (*parameters, *(key or ()), page_size)
+            rows, description = await self.schedule(
+                _fetch_page, self._conn, first_sql if key is None else next_sql,
+                page_parameters)
+            if rows:
+                yield rows
+            if len(rows) < page_size:
+                break
+            names = [column[0] for column in description]
+            key = [rows[-1][names.index(column)] for column in key_columns]
+
     async def iterdump(self):
         '''Returns an asynchronous iterator.'''
         # Need to read the lines from iterdump in the DB thread
@@ -244,8 +1754,18 @@ class Connection:
         await self.schedule(self._conn.backup, target, pages=pages, progress=progress,
                             name=name, sleep=sleep)
 
+    async def clone_to(self, target):
+        '''Copy the main database to target, a Connection or a filename, replacing its
+        contents.'''
+        if isinstance(target, Connection):
+            await self.backup(target)
+        else:
+            _check_clone_filename(target)
+            await self.schedule(_backup_to_file, self._conn, target)
+
     if sys.version_info >= (3, 11):
         async def create_window_function(self, name, num_params, aggregate_class, /):
+            aggregate_class = self._instrument_aggregate(f'window:{name}', aggregate_class)
             await self.schedule(self._conn.create_window_function, name,
                                 num_params, aggregate_class)
 
@@ -314,18 +1834,375 @@ class Connection:
         return self._conn.total_changes
 
 
+def _no_op():
+    pass
+
+
+def _close_job(future, func):
+    '''A job bypassing schedule(), which refuses jobs once closed.'''
+    return (future, func, (), {}, None, contextvars.copy_context(), time.monotonic())
+
+
+def _result_rows(result):
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    if isinstance(result, sqlite3.Cursor) and result.rowcount >= 0:
+        return result.rowcount
+    return None
+
+
+def _run_in_span(span_hook, queue_wait, func, args, kwargs):
+    # Errors in the hook are logged so they never change the outcome of the job
+    try:
+        span = span_hook.start_span(_job_sql(func, args), queue_wait)
+    except Exception:
+        logger.exception('span hook start_span() failed')
+        return func(*args, **kwargs)
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    except BaseException as e:
+        _end_span(span_hook, span, time.perf_counter() - start, None, e)
+        raise
+    _end_span(span_hook, span, time.perf_counter() - start, _result_rows(result), None)
+    return result
+
+
+def _end_span(span_hook, span, elapsed, rows, exc):
+    try:
+        span_hook.end_span(span, elapsed, rows, exc)
+    except Exception:
+        logger.exception('span hook end_span() failed')
+
+
+def _fetch_rows(conn, sql, parameters, max_bytes=None, slice_rows=0, shape='list'):
+    '''Execute sql and return (its rows, and their estimated size if max_bytes is not None,
+    otherwise None).  The rows are fetched as by Cursor.fetchall() with the given budget and
+    slice size, and returned as a list, a tuple, or a list of their first columns if shape
+    is 'column'.'''
+    cursor = conn.execute(sql, parameters)
+    try:
+        size = None
+        if max_bytes is not None:
+            rows, size, _ = _fetch_budgeted(cursor, (), None, max_bytes, False)
+        elif slice_rows:
+            rows = _fetch_sliced(cursor, None, slice_rows)
+        elif shape == 'column':
+            return [row[0] for row in cursor], None
+        else:
+            rows = cursor.fetchall()
+        if shape == 'column':
+            rows = [row[0] for row in rows]
+        elif shape == 'tuple':
+            rows = tuple(rows)
+        return rows, size
+    finally:
+        cursor.close()
+
+
+def _row_size(row):
+    '''Estimate the memory used by a row in bytes.'''
+    if isinstance(row, dict):
+        values = row.values()
+    elif isinstance(row, (tuple, list, sqlite3.Row)):
+        values = row
+    else:
+        return sys.getsizeof(row)
+    return sys.getsizeof(row) + sum(map(sys.getsizeof, values))
+
+
+def _fetch_sliced(cursor, size, slice_rows):
+    '''Fetch up to size rows, or all if size is None, slice_rows at a time.  Building rows
+    holds the GIL, so it is released between slices to let the event loop thread run.'''
+    rows = []
+    while size is None or len(rows) < size:
+        count = slice_rows if size is None else min(slice_rows, size - len(rows))
+        batch = cursor.fetchmany(count)
+        rows.extend(batch)
+        if len(batch) < count:
+            break
+        time.sleep(0)
+    return rows
+
+
+def _fetch_budgeted(cursor, pending, size, max_bytes, partial):
+    '''Return (rows, their estimated size, a list of the unread row that would have exceeded
+    the budget, or an empty list).  Rows in pending are returned first.  At least one row
+    is returned if there is one.  See Cursor._fetch_within_budget().'''
+    rows = []
+    total = 0
+    iterator = itertools.chain(pending, cursor)
+    for row in (iterator if size is None else itertools.islice(iterator, size)):
+        row_size = _row_size(row)
+        if total + row_size > max_bytes:
+            if not partial:
+                rows.append(row)
+                raise FetchBudgetError(f'fetched rows exceed the budget of {max_bytes:,d} bytes',
+                                       rows, total + row_size)
+            if rows:
+                return rows, total, [row]
+        rows.append(row)
+        total += row_size
+    return rows, total, []
+
+
+def _write_runs(conn, runs, flush_id, joined_flushes):
+    '''Execute runs of [sql, parameter rows] in a savepoint, so a failure leaves any open
+    transaction as it was.  Returns True if the writes were committed.  If a transaction was
+    already open they join it instead: flush_id is recorded in a temporary table, to learn
+    whether the transaction commits, and added to joined_flushes.'''
+    in_transaction = conn.in_transaction
+    # Outside a transaction the savepoint begins one, and releasing it commits
+    conn.execute('SAVEPOINT asqlite3_write_behind')
+    try:
+        for sql, rows in runs:
+            conn.executemany(sql, rows)
+        if in_transaction:
+            conn.execute('CREATE TEMP TABLE IF NOT EXISTS asqlite3_write_behind '
+                         '(id INTEGER PRIMARY KEY)')
+            conn.execute('INSERT INTO temp.asqlite3_write_behind VALUES (?)', (flush_id, ))
+    except BaseException:
+        conn.execute('ROLLBACK TO asqlite3_write_behind')
+        raise
+    finally:
+        conn.execute('RELEASE asqlite3_write_behind')
+    if in_transaction:
+        joined_flushes.add(flush_id)
+    return not in_transaction
+
+
+def _fetch_one(conn, sql, parameters):
+    cursor = conn.execute(sql, parameters)
+    try:
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+
+
+def _prepare_statements(conn, statements):
+    '''Compile statements into conn's statement cache without executing them, raising any
+    error in their SQL.'''
+    in_transaction = conn.in_transaction
+    for sql in statements:
+        try:
+            # With no parameter rows the statement is compiled and cached but not run
+            conn.executemany(sql, [])
+        except sqlite3.ProgrammingError as e:
+            # Raised, after compiling, by Python 3.9 onwards for statements other than DML
+            if 'DML' not in str(e):
+                raise
+    # Compiling DML can implicitly begin a transaction
+    if not in_transaction and conn.in_transaction:
+        conn.commit()
+
+
+def _fetch_page(conn, sql, parameters):
+    cursor = conn.execute(sql, parameters)
+    try:
+        return cursor.fetchall(), cursor.description
+    finally:
+        cursor.close()
+
+
+# Before SQLite 3.43 JSON functions write REALs with 15 significant digits, losing
+# precision, so rows are serialized by Python in the database thread instead
+_SQLITE_JSON = sqlite3.sqlite_version_info >= (3, 43)
+# Names given to duplicate columns of a subquery, e.g. "a:1"
+_DUPLICATE_NAME = re.compile(r'(.*):\d+$')
+
+
+def _json_names(cursor):
+    '''Return the column names of cursor, which must be distinct.'''
+    names = [column[0] for column in cursor.description]
+    for name in names:
+        match = _DUPLICATE_NAME.match(name)
+        if names.count(name) > 1 or (match and match.group(1) in names):
+            raise ValueError(f'duplicate column name {name!r} in JSON query')
+    return names
+
+
+def _json_sql(conn, sql, parameters, aggregate):
+    '''Return SQL selecting each row of the query sql as a JSON object keyed by column name,
+    or if aggregate is true a single JSON array of them.'''
+    sql = sql.strip().rstrip(';')
+    cursor = conn.execute(f'SELECT * FROM ({sql}) LIMIT 0', parameters)
+    try:
+        names = _json_names(cursor)
+    finally:
+        cursor.close()
+    expr = 'json_object(' + ', '.join(f'{_quote_string(name)}, {_quote(name)}'
+                                      for name in names) + ')'
+    if aggregate:
+        expr = f'json_group_array({expr})'
+    return f'SELECT {expr} FROM ({sql})'
+
+
+def _json_array(cursor, rows):
+    names = _json_names(cursor)
+    return json.dumps([dict(zip(names, row)) for row in rows], separators=(',', ':'))
+
+
+def _fetch_json(conn, sql, parameters, as_bytes):
+    if _SQLITE_JSON:
+        cursor = conn.execute(_json_sql(conn, sql, parameters, True), parameters)
+        try:
+            text = cursor.fetchone()[0]
+        finally:
+            cursor.close()
+    else:
+        cursor = conn.execute(sql, parameters)
+        try:
+            text = _json_array(cursor, cursor)
+        finally:
+            cursor.close()
+    return text.encode() if as_bytes else text
+
+
+def _open_json_cursor(conn, sql, parameters):
+    if _SQLITE_JSON:
+        return conn.execute(_json_sql(conn, sql, parameters, False), parameters)
+    cursor = conn.execute(sql, parameters)
+    try:
+        _json_names(cursor)
+    except BaseException:
+        cursor.close()
+        raise
+    return cursor
+
+
+def _fetch_json_chunk(cursor, size, prefix, as_bytes):
+    '''Return prefix followed by up to size JSON objects from cursor separated by commas, or
+    None if the cursor is exhausted.'''
+    rows = cursor.fetchmany(size)
+    if not rows:
+        return None
+    if _SQLITE_JSON:
+        text = prefix + ','.join([row[0] for row in rows])
+    else:
+        # Without the brackets
+        text = prefix + _json_array(cursor, rows)[1:-1]
+    return text.encode() if as_bytes else text
+
+
+# Helper jobs whose first two arguments are a connection and the SQL they execute
+_QUERY_HELPERS = (_fetch_rows, _fetch_page, _fetch_json, _open_json_cursor, _fetch_one)
+# Helper jobs whose first argument is the cursor they fetch from
+_CURSOR_HELPERS = (_fetch_budgeted, _fetch_sliced, _fetch_json_chunk)
+# sqlite3.Cursor methods that only fetch
+_FETCH_METHODS = {'fetchone', 'fetchmany', 'fetchall', 'close'}
+
+
+def _reads_first(func):
+    '''Return True if a job calling func fetches from a cursor, or only reads before
+    executing a statement that might write.'''
+    if func in _QUERY_HELPERS or func in _CURSOR_HELPERS:
+        return True
+    owner = getattr(func, '__self__', None)
+    name = getattr(func, '__name__', None)
+    if isinstance(owner, sqlite3.Cursor):
+        return name == 'execute' or name in _FETCH_METHODS
+    return isinstance(owner, sqlite3.Connection) and name == 'execute'
+
+
+def _single_flight_key(sql, parameters):
+    '''Return a hashable key for the query, or None if its parameters are unhashable.'''
+    if isinstance(parameters, dict):
+        parameters = tuple(sorted(parameters.items()))
+        values = (value for _, value in parameters)
+    else:
+        parameters = values = tuple(parameters)
+    # Parameter types are part of the key as 1 == 1.0 == True but typeof() differs
+    key = (sql, parameters, tuple(type(value) for value in values))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def _check_clone_filename(filename):
+    # A new connection to these would be a private database, discarded on closing
+    if filename in (':memory:', ''):
+        raise ValueError(f'cannot clone to {filename!r}; pass a Connection to clone to a '
+                         'temporary database')
+
+
+def _backup_to_file(conn, filename):
+    target = sqlite3.connect(filename)
+    try:
+        conn.backup(target)
+    finally:
+        target.close()
+
+
+class WorkerPool:
+    '''A bounded pool of threads shared by many connections.  The jobs of each connection
+    still run one at a time and in order, but on whichever pool thread serves it.  The
+    underlying sqlite3 connections must be opened with check_same_thread=False.'''
+
+    def __init__(self, max_workers=4, *, batch_size=16):
+        # Connections with queued jobs
+        self._ready = queue.Queue()
+        self._batch_size = batch_size
+        self._threads = [threading.Thread(target=self._serve, name=f'asqlite3-pool-{n}')
+                         for n in range(max_workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def _serve(self):
+        ready = self._ready
+        batch_size = self._batch_size
+        while True:
+            conn = ready.get()
+            if conn is None:
+                break
+            # Serve other connections fairly by requeuing after a batch of jobs
+            if conn._run_pending(batch_size):
+                ready.put(conn)
+
+    @property
+    def max_workers(self):
+        return len(self._threads)
+
+    def close(self):
+        '''Stop the pool threads once queued work is done.  Connections using the pool
+        should be closed first.  Idempotent.'''
+        for _ in self._threads:
+            self._ready.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+
+
 class Connector:
 
     def __init__(self, database, *, timeout=5.0, detect_types=0, isolation_level='DEFERRED',
                  check_same_thread=True, factory=sqlite3.Connection, cached_statements=128,
-                 uri=False, autocommit=None):
+                 uri=False, autocommit=None, max_queue_size=0, max_queue_wait=None,
+                 pool=None, slice_time=None, callback_stats=False, meter_steps=0,
+                 max_fetch_bytes=None, span_hook=None, stall_timeout=None,
+                 interrupt_stalled=False, on_stall=None, fetch_slice_rows=0,
+                 write_behind_interval=0.05, write_behind_rows=1000, on_write_error=None,
+                 warm_statements=()):
         self._database = database
         self._kwargs = {'timeout': timeout, 'detect_types': detect_types,
                         'isolation_level': isolation_level, 'check_same_thread': check_same_thread,
                         'factory': factory, 'cached_statements': cached_statements, 'uri': uri}
         if autocommit is not None:
             self._kwargs['autocommit'] = autocommit
-        self._conn = Connection()
+        if pool is not None:
+            self._kwargs['check_same_thread'] = False
+        self._conn = Connection(max_queue_size=max_queue_size, max_queue_wait=max_queue_wait,
+                                pool=pool, slice_time=slice_time,
+                                callback_stats=callback_stats, meter_steps=meter_steps,
+                                max_fetch_bytes=max_fetch_bytes, span_hook=span_hook,
+                                stall_timeout=stall_timeout,
+                                interrupt_stalled=interrupt_stalled, on_stall=on_stall,
+                                fetch_slice_rows=fetch_slice_rows,
+                                write_behind_interval=write_behind_interval,
+                                write_behind_rows=write_behind_rows,
+                                on_write_error=on_write_error,
+                                warm_statements=warm_statements)
 
     async def __aenter__(self):
         failed = True
@@ -0,0 +1,313 @@
+# Copyright (c) 2024 Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''A content-addressed store of files split into deduplicated chunks.'''
+
+import collections
+import hashlib
+import itertools
+import re
+import time
+import uuid
+import zlib
+
+from .asqlite3 import _quote
+
+# Content-defined boundaries are considered after these bytes, and taken where the CRC of
+# the preceding window of bytes is divisible by a divisor chosen to give the desired
+# average chunk size.  Both tests run in C so chunking is fast.
+_ANCHOR = re.compile(b'[\x00\n]')
+_ANCHOR_SPACING = 128
+_WINDOW = 48
+# Chunks of a file being put are mapped under a staging name holding the time the put
+# began.  Staged chunks older than this many seconds were left by a crash and are removed.
+_STAGING = '\0staging:'
+_STALE_STAGING = 24 * 3600
+
+BlobUsage = collections.namedtuple('BlobUsage', 'files file_bytes chunks stored_bytes')
+
+
+class _Chunker:
+    '''Splits a stream of bytes into chunks of chunk_size bytes, or if content_defined into
+    chunks averaging about chunk_size bytes, of between a quarter and four times that,
+    whose boundaries depend on their content so an insertion only changes nearby chunks.'''
+
+    def __init__(self, chunk_size, content_defined):
+        self.buffer = bytearray()
+        self.content_defined = content_defined
+        if content_defined:
+            self.min_size = max(chunk_size // 4, _WINDOW)
+            self.max_size = chunk_size * 4
+            self.divisor = max(1, (chunk_size - self.min_size) // _ANCHOR_SPACING)
+        else:
+            self.min_size = self.max_size = chunk_size
+        # Where in the buffer the search for a boundary resumes
+        self.scanned = self.min_size
+
+    def feed(self, data):
+        '''Add data and return a list of the chunks completed.'''
+        self.buffer += data
+        chunks = []
+        while True:
+            cut = self._boundary()
+            if cut is None:
+                return chunks
+            chunks.append(bytes(self.buffer[:cut]))
+            del self.buffer[:cut]
+            self.scanned = self.min_size
+
+    def finish(self):
+        '''Return the final chunks.'''
+        chunks = self.feed(b'')
+        if self.buffer:
+            chunks.append(bytes(self.buffer))
+            self.buffer.clear()
+        return chunks
+
+    def _boundary(self):
+        buffer = self.buffer
+        end = min(len(buffer), self.max_size)
+        if self.content_defined:
+            for match in _ANCHOR.finditer(buffer, self.scanned, end):
+                pos = match.end()
+                if zlib.crc32(buffer[pos - _WINDOW: pos]) % self.divisor == 0:
+                    return pos
+            self.scanned = max(self.scanned, end)
+        return self.max_size if len(buffer) >= self.max_size else None
+
+
+def _read_chunk(conn, table, chunk_id, digest, start, length):
+    '''Read part of a chunk, checking it still has the hash digest: a chunk deleted since
+    the read was planned may have had its ID reused.'''
+    in_transaction = conn.in_transaction
+    # Check and read in one snapshot
+    if not in_transaction:
+        conn.execute('BEGIN')
+    try:
+        row = conn.execute(f'SELECT hash FROM {_quote(table)} WHERE id = ?',
+                           (chunk_id, )).fetchone()
+        if row is None or row[0] != digest:
+            raise RuntimeError('file changed while being read')
+        if hasattr(conn, 'blobopen'):
+            with conn.blobopen(table, 'data', chunk_id, readonly=True) as blob:
+                blob.seek(start)
+                return blob.read(length)
+        # Python < 3.11
+        return conn.execute(f'SELECT substr(data, ?, ?) FROM {_quote(table)} WHERE id = ?',
+                            (start + 1, length, chunk_id)).fetchone()[0]
+    finally:
+        # Not commit(), which does nothing if autocommit is True
+        if not in_transaction:
+            conn.execute('COMMIT')
+
+
+async def _aiter(data):
+    if hasattr(data, '__aiter__'):
+        async for piece in data:
+            yield piece
+    else:
+        for piece in data:
+            yield piece
+
+
+class BlobStore:
+    '''Stores files as chunks kept once per distinct content, keyed by SHA-256 hash, so
+    duplicated content is stored once.  Files are split into fixed-size chunks, or with
+    content_defined into chunks whose boundaries depend on their content.  Chunks are read
+    with incremental blob I/O in the database thread, supporting range reads and streaming
+    with several chunk reads in flight.  Reads are spread over conn and any reader
+    connections to the same database.
+    '''
+
+    def __init__(self, conn, *, prefix='asqlite3_blob', chunk_size=256 * 1024,
+                 content_defined=False, readers=(), max_parallel=4):
+        self.conn = conn
+        self.chunk_size = chunk_size
+        self.content_defined = content_defined
+        self.max_parallel = max_parallel
+        self._readers = itertools.cycle([conn, *readers])
+        self._chunks = f'{prefix}_chunks'
+        self._files = f'{prefix}_files'
+        self._map = f'{prefix}_map'
+        self._setup_done = False
+
+    async def _setup(self):
+        if not self._setup_done:
+            await self.conn.executescript(f'''
+                CREATE TABLE IF NOT EXISTS {_quote(self._chunks)}(
+                    id INTEGER PRIMARY KEY, hash BLOB NOT NULL UNIQUE,
+                    refs INTEGER NOT NULL, data BLOB NOT NULL);
+                CREATE TABLE IF NOT EXISTS {_quote(self._files)}(
+                    name TEXT PRIMARY KEY, size INTEGER NOT NULL) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS {_quote(self._map)}(
+                    name TEXT NOT NULL, offset INTEGER NOT NULL, chunk_id INTEGER NOT NULL,
+                    size INTEGER NOT NULL, PRIMARY KEY(name, offset)) WITHOUT ROWID;
+            ''')
+            await self.conn.schedule(self._sweep_staging, self.conn._conn,
+                                     int(time.time()) - _STALE_STAGING)
+            self._setup_done = True
+
+    def _sweep_staging(self, conn, cutoff):
+        '''Delete staged chunks of puts begun before cutoff, left by a crash.'''
+        in_transaction = conn.in_transaction
+        names = conn.execute(f'SELECT DISTINCT name FROM {_quote(self._map)} '
+                             'WHERE name >= ? AND name < ?',
+                             (_STAGING, f'{_STAGING}{cutoff:012d}')).fetchall()
+        for name, in names:
+            self._delete(conn, name, commit=False)
+        if not in_transaction:
+            conn.commit()
+
+    async def put(self, name, data):
+        '''Store data, bytes or a sync or async iterable of bytes, as the file name,
+        replacing any existing file of that name.  Returns the file's size.'''
+        await self._setup()
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = [data]
+        conn = self.conn
+        chunker = _Chunker(self.chunk_size, self.content_defined)
+        # Chunks are added under a unique staging name, and renamed once all are written.
+        # Chunking and hashing are done in the database thread.
+        staging = f'{_STAGING}{int(time.time()):012d}:{uuid.uuid4().hex}'
+        offset = 0
+        try:
+            async for piece in _aiter(data):
+                offset = await conn.schedule(self._write_piece, conn._conn, staging, offset,
+                                             chunker, piece)
+            return await conn.schedule(self._finish, conn._conn, staging, name, offset,
+                                       chunker)
+        except BaseException:
+            if not conn._closed:
+                await conn.schedule(self._delete, conn._conn, staging)
+            raise
+
+    def _write_piece(self, conn, name, offset, chunker, piece):
+        return self._write_chunks(conn, name, offset, chunker.feed(piece))
+
+    def _write_chunks(self, conn, name, offset, chunks, commit=True):
+        chunks_table = _quote(self._chunks)
+        in_transaction = conn.in_transaction
+        for chunk in chunks:
+            digest = hashlib.sha256(chunk).digest()
+            row = conn.execute(f'SELECT id FROM {chunks_table} WHERE hash = ?',
+                               (digest, )).fetchone()
+            if row:
+                chunk_id = row[0]
+                conn.execute(f'UPDATE {chunks_table} SET refs = refs + 1 WHERE id = ?',
+                             (chunk_id, ))
+            else:
+                chunk_id = conn.execute(f'INSERT INTO {chunks_table}(hash, refs, data) '
+                                        'VALUES(?, 1, ?)', (digest, chunk)).lastrowid
+            conn.execute(f'INSERT INTO {_quote(self._map)} VALUES(?, ?, ?, ?)',
+                         (name, offset, chunk_id, len(chunk)))
+            offset += len(chunk)
+        if commit and not in_transaction:
+            conn.commit()
+        return offset
+
+    def _finish(self, conn, staging, name, offset, chunker):
+        in_transaction = conn.in_transaction
+        size = self._write_chunks(conn, staging, offset, chunker.finish(), commit=False)
+        staged = conn.execute(f'SELECT COALESCE(SUM(size), 0) FROM {_quote(self._map)} '
+                              'WHERE name = ?', (staging, )).fetchone()[0]
+        if staged != size:
+            raise RuntimeError('staged chunks were removed during the put')
+        self._delete(conn, name, commit=False)
+        conn.execute(f'UPDATE {_quote(self._map)} SET name = ? WHERE name = ?', (name, staging))
+        conn.execute(f'INSERT INTO {_quote(self._files)} VALUES(?, ?)', (name, size))
+        if not in_transaction:
+            conn.commit()
+        return size
+
+    async def delete(self, name):
+        '''Delete the file name.  Returns True if it existed.'''
+        await self._setup()
+        return await self.conn.schedule(self._delete, self.conn._conn, name)
+
+    def _delete(self, conn, name, commit=True):
+        chunks_table = _quote(self._chunks)
+        in_transaction = conn.in_transaction
+        chunk_ids = conn.execute(f'SELECT chunk_id FROM {_quote(self._map)} WHERE name = ?',
+                                 (name, )).fetchall()
+        conn.executemany(f'UPDATE {chunks_table} SET refs = refs - 1 WHERE id = ?', chunk_ids)
+        conn.executemany(f'DELETE FROM {chunks_table} WHERE id = ? AND refs <= 0', chunk_ids)
+        conn.execute(f'DELETE FROM {_quote(self._map)} WHERE name = ?', (name, ))
+        existed = conn.execute(f'DELETE FROM {_quote(self._files)} WHERE name = ?',
+                               (name, )).rowcount > 0
+        if commit and not in_transaction:
+            conn.commit()
+        return existed
+
+    async def size(self, name):
+        '''Return the size of the file name, or None if there is no such file.'''
+        await self._setup()
+        cursor = await self.conn.execute(f'SELECT size FROM {_quote(self._files)} '
+                                         'WHERE name = ?', (name, ))
+        row = await cursor.fetchone()
+        return row[0] if row else None
+
+    async def get(self, name, offset=0, size=None):
+        '''Return size bytes of the file name from offset, or all bytes to the end if size
+        is None.  Raises KeyError if there is no such file.'''
+        return b''.join([piece async for piece in self.stream(name, offset, size)])
+
+    async def stream(self, name, offset=0, size=None):
+        '''An async iterator of the bytes of the file name from offset, one chunk at a time,
+        up to size bytes or to the end if size is None.  Up to max_parallel chunks are read
+        ahead.  Raises KeyError if there is no such file.'''
+        await self._setup()
+        plan = await self.conn.schedule(self._plan, self.conn._conn, name, offset, size)
+        if plan is None:
+            raise KeyError(name)
+        pending = collections.deque()
+        try:
+            for item in plan:
+                reader = next(self._readers)
+                pending.append(reader.schedule(_read_chunk, reader._conn, self._chunks, *item))
+                if len(pending) >= self.max_parallel:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _plan(self, conn, name, offset, size):
+        '''Return a list of (chunk_id, hash, start, length) reads of the requested range, or
+        None if there is no such file.'''
+        row = conn.execute(f'SELECT size FROM {_quote(self._files)} WHERE name = ?',
+                           (name, )).fetchone()
+        if row is None:
+            return None
+        end = row[0] if size is None else min(row[0], offset + size)
+        if offset >= end:
+            return []
+        rows = conn.execute(f'SELECT m.offset, m.chunk_id, c.hash, m.size '
+                            f'FROM {_quote(self._map)} AS m JOIN {_quote(self._chunks)} AS c '
+                            'ON c.id = m.chunk_id WHERE m.name = ? AND m.offset >= '
+                            f'(SELECT MAX(offset) FROM {_quote(self._map)} WHERE name = ? AND '
+                            'offset <= ?) AND m.offset < ? ORDER BY m.offset',
+                            (name, name, offset, end)).fetchall()
+        plan = []
+        for chunk_offset, chunk_id, digest, chunk_size in rows:
+            start = max(offset - chunk_offset, 0)
+            length = min(chunk_size, end - chunk_offset) - start
+            plan.append((chunk_id, digest, start, length))
+        return plan
+
+    async def usage(self):
+        '''Return a BlobUsage of the number of files and their total size, and the number
+        of distinct chunks and their total size.'''
+        await self._setup()
+        return await self.conn.schedule(self._usage, self.conn._conn)
+
+    def _usage(self, conn):
+        files, file_bytes = conn.execute(f'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM '
+                                         f'{_quote(self._files)}').fetchone()
+        chunks, stored_bytes = conn.execute(f'SELECT COUNT(*), COALESCE(SUM(length(data)), 0) '
+                                            f'FROM {_quote(self._chunks)}').fetchone()
+        return BlobUsage(files, file_bytes, chunks, stored_bytes)
@@ -0,0 +1,168 @@
+# Copyright (c) 2024 Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''A change feed of table modifications, recorded by triggers, with async subscribers.'''
+
+import asyncio
+import collections
+
+from .asqlite3 import _quote, _quote_string
+
+
+Change = collections.namedtuple('Change', 'seq table op rowid')
+
+_OPS = (('INSERT', 'I', 'new'), ('UPDATE', 'U', 'new'), ('DELETE', 'D', 'old'))
+
+
+class ChangeFeed:
+    '''Records inserts, updates and deletes of watched tables in a log table, and delivers
+    them to subscribers once committed.
+
+    Triggers on each watched table append a compact record - sequence number, table name,
+    operation and rowid - to the log table.  Subscribers iterate over changes with
+    changes(), and are woken when a job on the connection commits.  Named subscribers
+    have a cursor, their position in the log, stored in the database.
+    '''
+
+    def __init__(self, conn, *, log_table='asqlite3_changes', retention=None):
+        self.conn = conn
+        self.log_table = log_table
+        self.cursor_table = f'{log_table}_cursors'
+        self.retention = retention
+        self._setup_done = False
+        # The highest sequence number known to be committed.  Only accessed from the
+        # database thread.
+        self._committed_seq = 0
+        self._wakeup = conn._loop.create_future()
+        self._closed = False
+        conn._commit_listeners.append(self._on_commit)
+
+    def _on_commit(self):
+        self._wakeup.set_result(None)
+        self._wakeup = self.conn._loop.create_future()
+
+    async def _setup(self):
+        if not self._setup_done:
+            await self.conn.executescript(f'''
+                CREATE TABLE IF NOT EXISTS {_quote(self.log_table)}(
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT, tbl TEXT NOT NULL,
+                    op TEXT NOT NULL, row_id INTEGER,
+                    ts REAL NOT NULL DEFAULT (julianday('now')));
+                CREATE TABLE IF NOT EXISTS {_quote(self.cursor_table)}(
+                    name TEXT PRIMARY KEY, seq INTEGER NOT NULL);
+            ''')
+            self._setup_done = True
+
+    def _trigger_name(self, table, op):
+        return _quote(f'{self.log_table}_{table}_{op.lower()}')
+
+    async def watch(self, table):
+        '''Install triggers recording changes to table, which must be a rowid table.
+        Idempotent.'''
+        await self._setup()
+        for op, code, row in _OPS:
+            await self.conn.execute(
+                f'CREATE TRIGGER IF NOT EXISTS {self._trigger_name(table, op)} '
+                f'AFTER {op} ON {_quote(table)} BEGIN '
+                f'INSERT INTO {_quote(self.log_table)}(tbl, op, row_id) '
+                f'VALUES({_quote_string(table)}, {_quote_string(code)}, {row}.rowid); END')
+
+    async def unwatch(self, table):
+        '''Remove the triggers of table.  Idempotent.'''
+        for op, _, _ in _OPS:
+            await self.conn.execute(f'DROP TRIGGER IF EXISTS {self._trigger_name(table, op)}')
+
+    async def changes(self, name=None, *, since=None, batch_size=100):
+        '''An async iterator of committed changes as Change objects.
+
+        Iteration starts after sequence number since if given, otherwise after the named
+        cursor's position, otherwise with the next change.  If name is given the cursor is
+        advanced once each batch of changes has been consumed, so a restarted subscriber
+        resumes where it left off; a change may be delivered again if the subscriber stops
+        mid-batch.  Iteration ends when the feed is closed.
+        '''
+        await self._setup()
+        conn = self.conn
+        position = await conn.schedule(self._start_position, conn._conn, name, since)
+        acked = position
+        while not self._closed:
+            # Take the wakeup future before reading so no commit can be missed
+            wakeup = self._wakeup
+            rows = await conn.schedule(self._read, conn._conn, name, acked, position,
+                                       batch_size)
+            acked = position
+            if not rows:
+                await asyncio.shield(wakeup)
+                continue
+            for row in rows:
+                yield Change(*row)
+            position = rows[-1][0]
+
+    def _start_position(self, conn, name, since):
+        if since is not None:
+            return since
+        if name is not None:
+            row = conn.execute(f'SELECT seq FROM {_quote(self.cursor_table)} WHERE name = ?',
+                               (name, )).fetchone()
+            if row:
+                return row[0]
+        return conn.execute(f'SELECT COALESCE(MAX(seq), 0) FROM {_quote(self.log_table)}'
+                            ).fetchone()[0]
+
+    def _read(self, conn, name, acked, position, limit):
+        '''Store the position of a named cursor if it has advanced, and return up to limit
+        committed changes after position.'''
+        in_transaction = conn.in_transaction
+        # With autocommit False a transaction is always open, but has made no changes if
+        # none were made since one last ended
+        settled = not in_transaction or conn.total_changes == self.conn._settled_changes
+        if name is not None and position != acked:
+            conn.execute(f'INSERT OR REPLACE INTO {_quote(self.cursor_table)} VALUES(?, ?)',
+                         (name, position))
+            if not in_transaction:
+                conn.commit()
+        if settled:
+            # Outside a transaction everything in the log is committed
+            self._committed_seq = conn.execute(
+                f'SELECT COALESCE(MAX(seq), 0) FROM {_quote(self.log_table)}').fetchone()[0]
+        return conn.execute(f'SELECT seq, tbl, op, row_id FROM {_quote(self.log_table)} '
+                            'WHERE seq > ? AND seq <= ? ORDER BY seq LIMIT ?',
+                            (position, self._committed_seq, limit)).fetchall()
+
+    async def cursors(self):
+        '''Return a dictionary mapping cursor names to their positions.'''
+        await self._setup()
+        cursor = await self.conn.execute(f'SELECT name, seq FROM {_quote(self.cursor_table)}')
+        return dict(await cursor.fetchall())
+
+    async def prune(self, max_age=None):
+        '''Delete changes consumed by all named cursors, and changes older than max_age
+        seconds whether consumed or not.  max_age defaults to the feed's retention.  Returns
+        the number of changes deleted.  Commits unless a transaction is open.'''
+        await self._setup()
+        if max_age is None:
+            max_age = self.retention
+        return await self.conn.schedule(self._prune, self.conn._conn, max_age)
+
+    def _prune(self, conn, max_age):
+        in_transaction = conn.in_transaction
+        log_table = _quote(self.log_table)
+        count = conn.execute(f'DELETE FROM {log_table} WHERE seq <= '
+                             f'(SELECT MIN(seq) FROM {_quote(self.cursor_table)})').rowcount
+        if max_age is not None:
+            count += conn.execute(f"DELETE FROM {log_table} WHERE ts < julianday('now') - ?",
+                                  (max_age / 86400, )).rowcount
+        if not in_transaction:
+            conn.commit()
+        return count
+
+    def close(self):
+        '''Stop delivering changes; iterations of changes() end.  The triggers remain.'''
+        if not self._closed:
+            self._closed = True
+            self.conn._commit_listeners.remove(self._on_commit)
+            self._wakeup.set_result(None)
@@ -0,0 +1,275 @@
+# Copyright (c) 2024 Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''A key-value store on a connection, with TTLs, batched writes and a read cache.'''
+
+import asyncio
+import collections
+import collections.abc
+import contextlib
+import time
+
+from .asqlite3 import _quote, logger
+
+# A pending or cached entry is (value, expires); _DELETED marks a pending deletion
+_DELETED = object()
+_MISSING = (_DELETED, None)
+_IN_CHUNK = 500
+
+
+def _prefix_upper(prefix):
+    '''Return the least string greater than all strings starting with prefix, or None.'''
+    while prefix:
+        last = ord(prefix[-1])
+        if last < 0x10ffff:
+            return prefix[:-1] + chr(last + 1)
+        prefix = prefix[:-1]
+    return None
+
+
+def _live(entry, now):
+    return entry[0] is not _DELETED and (entry[1] is None or entry[1] > now)
+
+
+class KVStore:
+    '''A key-value store in a WITHOUT ROWID table.  Keys are strings; values are anything
+    SQLite can store.
+
+    Writes are buffered and coalesced: writes made while an earlier batch is being written
+    are written together in the next batch, in one transaction, and each write returns once
+    its batch is written.  Reads consult the pending writes and then an LRU of up to
+    cache_size entries, kept coherent with the store's own writes but not with other
+    writers of the table.  Expired entries are invisible, and deleted every sweep_interval
+    seconds by a background task.
+    '''
+
+    def __init__(self, conn, *, table='asqlite3_kv', cache_size=1024, sweep_interval=60.0):
+        self.conn = conn
+        self.table = table
+        self.cache_size = cache_size
+        self.sweep_interval = sweep_interval
+        self._setup_done = False
+        # key -> (value, expires) of unwritten writes, and the future of their batch
+        self._pending = {}
+        self._batch_done = conn._loop.create_future()
+        self._flusher = None
+        self._cache = collections.OrderedDict()
+        # Incremented on every write, so reads racing a write do not fill the cache
+        self._writes = 0
+        self._sweeper = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.expired_count = 0
+
+    async def __aenter__(self):
+        await self._setup()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def _setup(self):
+        if not self._setup_done:
+            table = _quote(self.table)
+            await self.conn.executescript(f'''
+                CREATE TABLE IF NOT EXISTS {table}(
+                    key TEXT PRIMARY KEY NOT NULL, value, expires REAL) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS {_quote(self.table + '_expires')}
+                    ON {table}(expires) WHERE expires IS NOT NULL;
+            ''')
+            self._setup_done = True
+            if self.sweep_interval is not None and self._sweeper is None:
+                self._sweeper = self.conn._loop.create_task(self._sweep())
+
+    async def get(self, key, default=None):
+        '''Return the value of key, or default if it is missing or expired.'''
+        entry = (await self._get_entries([key])).get(key, _MISSING)
+        return entry[0] if _live(entry, time.time()) else default
+
+    async def get_many(self, keys):
+        '''Return a dictionary mapping those of keys present, and not expired, to their
+        values.'''
+        entries = await self._get_entries(keys)
+        now = time.time()
+        return {key: entry[0] for key, entry in entries.items() if _live(entry, now)}
+
+    async def _get_entries(self, keys):
+        await self._setup()
+        pending = self._pending
+        cache = self._cache
+        result = {}
+        missing = []
+        for key in keys:
+            entry = pending.get(key)
+            if entry is None:
+                entry = cache.get(key)
+                if entry is None:
+                    missing.append(key)
+                    self.cache_misses += 1
+                    continue
+                cache.move_to_end(key)
+                self.cache_hits += 1
+            result[key] = entry
+        if missing:
+            writes = self._writes
+            rows = await self.conn.schedule(self._read, self.conn._conn, missing)
+            found = {key: (value, expires) for key, value, expires in rows}
+            for key in missing:
+                entry = found.get(key, _MISSING)
+                result[key] = entry
+                if writes == self._writes:
+                    self._cache_put(key, entry)
+        return result
+
+    def _read(self, conn, keys):
+        rows = []
+        sql = f'SELECT key, value, expires FROM {_quote(self.table)} WHERE key IN '
+        for n in range(0, len(keys), _IN_CHUNK):
+            chunk = keys[n: n + _IN_CHUNK]
+            rows.extend(conn.execute(sql + f'({", ".join("?" * len(chunk))})', chunk))
+        return rows
+
+    def _cache_put(self, key, entry):
+        if self.cache_size:
+            cache = self._cache
+            cache[key] = entry
+            cache.move_to_end(key)
+            if len(cache) > self.cache_size:
+                cache.popitem(last=False)
+
+    async def scan(self, prefix='', *, batch_size=500):
+        '''An async iterator of (key, value) pairs of unexpired keys starting with prefix, in
+        key order.  Pending writes are written first.'''
+        await self.flush()
+        upper = _prefix_upper(prefix)
+        after = None
+        while True:
+            rows = await self.conn.schedule(self._scan, self.conn._conn, prefix, upper, after,
+                                            time.time(), batch_size)
+            for row in rows:
+                yield row
+            if len(rows) < batch_size:
+                break
+            after = rows[-1][0]
+
+    def _scan(self, conn, prefix, upper, after, now, limit):
+        sql = [f'SELECT key, value FROM {_quote(self.table)} WHERE key >= ?']
+        parameters = [prefix]
+        if upper is not None:
+            sql.append('AND key < ?')
+            parameters.append(upper)
+        if after is not None:
+            sql.append('AND key > ?')
+            parameters.append(after)
+        sql.append('AND (expires IS NULL OR expires > ?) ORDER BY key LIMIT ?')
+        parameters.extend((now, limit))
+        return conn.execute(' '.join(sql), parameters).fetchall()
+
+    async def set(self, key, value, *, ttl=None):
+        '''Set the value of key, expiring after ttl seconds if ttl is not None.'''
+        await self._write({key: (value, None if ttl is None else time.time() + ttl)})
+
+    async def set_many(self, items, *, ttl=None):
+        '''Set the values of the keys of items, a mapping or iterable of (key, value) pairs,
+        in one batch.'''
+        if isinstance(items, collections.abc.Mapping):
+            items = items.items()
+        expires = None if ttl is None else time.time() + ttl
+        await self._write({key: (value, expires) for key, value in items})
+
+    async def delete(self, key):
+        '''Delete key if present.'''
+        await self._write({key: _MISSING})
+
+    async def _write(self, entries):
+        await self._setup()
+        self._pending.update(entries)
+        self._writes += 1
+        for key, entry in entries.items():
+            self._cache_put(key, entry)
+        batch_done = self._batch_done
+        if self._flusher is None:
+            self._flusher = self.conn._loop.create_task(self._flush())
+        await asyncio.shield(batch_done)
+
+    async def _flush(self):
+        loop = self.conn._loop
+        try:
+            while self._pending:
+                pending, self._pending = self._pending, {}
+                batch_done, self._batch_done = self._batch_done, loop.create_future()
+                try:
+                    await self.conn.schedule(self._write_batch, self.conn._conn, pending)
+                except Exception as e:
+                    # Cached entries of the failed writes may be wrong
+                    for key in pending:
+                        self._cache.pop(key, None)
+                    batch_done.set_exception(e)
+                else:
+                    batch_done.set_result(None)
+        finally:
+            self._flusher = None
+
+    def _write_batch(self, conn, pending):
+        table = _quote(self.table)
+        upserts = [(key, value, expires) for key, (value, expires) in pending.items()
+                   if value is not _DELETED]
+        deletions = [(key, ) for key, (value, _) in pending.items() if value is _DELETED]
+        in_transaction = conn.in_transaction
+        try:
+            if upserts:
+                conn.executemany(f'INSERT OR REPLACE INTO {table} VALUES(?, ?, ?)', upserts)
+            if deletions:
+                conn.executemany(f'DELETE FROM {table} WHERE key = ?', deletions)
+        except BaseException:
+            if not in_transaction:
+                conn.rollback()
+            raise
+        if not in_transaction:
+            conn.commit()
+
+    async def flush(self):
+        '''Wait until pending writes are written.'''
+        if self._flusher:
+            await asyncio.shield(self._flusher)
+
+    async def expire(self):
+        '''Delete expired entries now, and return the number deleted.'''
+        await self._setup()
+        count = await self.conn.schedule(self._expire, self.conn._conn, time.time())
+        self.expired_count += count
+        return count
+
+    def _expire(self, conn, now):
+        in_transaction = conn.in_transaction
+        count = conn.execute(f'DELETE FROM {_quote(self.table)} WHERE expires <= ?',
+                             (now, )).rowcount
+        if not in_transaction:
+            conn.commit()
+        return count
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            # Stop with a connection closed without closing the store
+            if self.conn._closed:
+                self._sweeper = None
+                return
+            try:
+                await self.expire()
+            except Exception:
+                logger.exception(f'error sweeping expired keys from {self.table!r}')
+
+    async def close(self):
+        '''Write pending writes and stop the background sweeper.  Idempotent.'''
+        if self._sweeper:
+            self._sweeper.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._sweeper
+            self._sweeper = None
+        with contextlib.suppress(Exception):
+            await self.flush()
@@ -0,0 +1,173 @@
+# Copyright (c) 2024 Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''Lazily-opened, idle-reaped connections to many databases.'''
+
+import asyncio
+import collections
+import contextlib
+
+from .asqlite3 import Connection, WorkerPool, logger
+
+
+class _Entry:
+
+    __slots__ = ('conn', 'users', 'last_used', 'opening')
+
+    def __init__(self, conn, now):
+        self.conn = conn
+        self.users = 0
+        self.last_used = now
+        self.opening = None
+
+
+class DatabaseManager:
+    '''Manages connections to many databases, for example one per tenant.
+
+    Connections are opened on first use and kept in an LRU.  At most max_open connections
+    are open at once; the limit is max_connections, further capped by max_fds divided by
+    fds_per_connection if max_fds is given.  Connections unused for idle_timeout seconds
+    are closed, and are reopened transparently when next used.  The jobs of all
+    connections run on a shared WorkerPool of max_workers threads.
+
+    Other keyword arguments are passed to sqlite3.connect() when opening a connection.
+    '''
+
+    def __init__(self, *, max_connections=64, max_fds=None, fds_per_connection=3,
+                 idle_timeout=60.0, max_workers=4, **kwargs):
+        max_open = max_connections
+        if max_fds is not None:
+            max_open = min(max_open, max(1, max_fds // fds_per_connection))
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        self._kwargs = dict(kwargs, check_same_thread=False)
+        self._pool = WorkerPool(max_workers)
+        self._loop = asyncio.get_running_loop()
+        # Keyed by database, least-recently used first
+        self._entries = collections.OrderedDict()
+        self._released = asyncio.Condition()
+        self._reaper = None
+        self._closed = False
+        self.open_count = 0
+        self.evicted_count = 0
+        self.reaped_count = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    @contextlib.asynccontextmanager
+    async def connection(self, database):
+        '''An asynchronous context manager returning an open Connection to database.  The
+        connection is not closed by the manager while in use.'''
+        entry = await self._acquire(database)
+        try:
+            yield entry.conn
+        finally:
+            await self._release(entry)
+
+    async def _acquire(self, database):
+        if self._reaper is None:
+            self._reaper = self._loop.create_task(self._reap())
+        while True:
+            if self._closed:
+                raise RuntimeError('database manager is closed')
+            entry = self._entries.get(database)
+            if entry is None and (len(self._entries) < self.max_open or await self._evict()):
+                # _evict() may have yielded; another task may have opened the database
+                if database in self._entries:
+                    continue
+                entry = _Entry(Connection(pool=self._pool), self._loop.time())
+                entry.opening = self._loop.create_task(self._open(database, entry))
+                self._entries[database] = entry
+            if entry is not None:
+                self._entries.move_to_end(database)
+                entry.users += 1
+                try:
+                    await asyncio.shield(entry.opening)
+                except BaseException:
+                    entry.users -= 1
+                    raise
+                return entry
+            async with self._released:
+                await self._released.wait()
+
+    async def _open(self, database, entry):
+        try:
+            await entry.conn._connect(database, self._kwargs)
+            self.open_count += 1
+        except BaseException:
+            if self._entries.get(database) is entry:
+                del self._entries[database]
+            await entry.conn.close()
+            # A slot is free
+            await self._notify_released()
+            raise
+
+    async def _release(self, entry):
+        entry.users -= 1
+        entry.last_used = self._loop.time()
+        await self._notify_released()
+
+    async def _notify_released(self):
+        async with self._released:
+            self._released.notify_all()
+
+    async def _evict(self):
+        '''Close the least-recently used connection not in use.  Returns True on success.'''
+        for database, entry in self._entries.items():
+            if not entry.users and entry.opening.done():
+                del self._entries[database]
+                self.evicted_count += 1
+                await entry.conn.close()
+                return True
+        return False
+
+    async def _reap(self):
+        while True:
+            await asyncio.sleep(max(self.idle_timeout / 2, 0.01))
+            cutoff = self._loop.time() - self.idle_timeout
+            idle = [(database, entry) for database, entry in self._entries.items()
+                    if not entry.users and entry.opening.done() and entry.last_used <= cutoff]
+            for database, entry in idle:
+                # An earlier close() may have yielded to a task using or evicting the entry
+                if self._entries.get(database) is not entry or entry.users:
+                    continue
+                del self._entries[database]
+                self.reaped_count += 1
+                try:
+                    await entry.conn.close()
+                except Exception:
+                    logger.exception(f'error closing idle connection to {database!r}')
+            if idle:
+                await self._notify_released()
+
+    @property
+    def open_databases(self):
+        '''A list of databases with an open connection, least-recently used first.'''
+        return list(self._entries)
+
+    async def close(self):
+        '''Close all connections and stop the worker pool.  Idempotent.'''
+        if self._closed:
+            return
+        self._closed = True
+        if self._reaper:
+            self._reaper.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._reaper
+        entries = list(self._entries.values())
+        self._entries.clear()
+        for entry in entries:
+            with contextlib.suppress(Exception):
+                await entry.opening
+            await entry.conn.close()
+        self._pool.close()
+        async with self._released:
+            self._released.notify_all()
@@ -0,0 +1,208 @@
+# Copyright (c) 2024 Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''A durable work queue on a connection, with priorities and visibility timeouts.'''
+
+import asyncio
+import collections
+import time
+
+from .asqlite3 import _quote
+
+
+Message = collections.namedtuple('Message', 'id payload priority attempts')
+
+
+class TaskQueue:
+    '''A persistent work queue in a table.
+
+    get() claims the available message of highest priority, oldest first, for
+    visibility_timeout seconds.  A message not acknowledged with ack() within that time, or
+    returned with nack(), becomes available again.  Available and claimed messages are kept
+    in separate partial indexes so claiming a message costs O(log n) however large the
+    backlog.  Acknowledgements are coalesced into batches like KVStore writes.  Waiting
+    consumers are woken by puts and nacks through this object, and when a claim expires;
+    set poll_interval to also notice messages put by other processes.
+    '''
+
+    def __init__(self, conn, *, table='asqlite3_queue', poll_interval=None):
+        self.conn = conn
+        self.table = table
+        self.poll_interval = poll_interval
+        self._setup_done = False
+        self._wakeup = conn._loop.create_future()
+        # (id, attempts) pairs of unwritten acks, and the future of their batch
+        self._acks = []
+        self._batch_done = conn._loop.create_future()
+        self._flusher = None
+        self.put_count = 0
+        self.ack_count = 0
+        self.nack_count = 0
+
+    async def _setup(self):
+        if not self._setup_done:
+            table = _quote(self.table)
+            await self.conn.executescript(f'''
+                CREATE TABLE IF NOT EXISTS {table}(
+                    id INTEGER PRIMARY KEY, payload, priority INTEGER NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0, claimed_until REAL);
+                CREATE INDEX IF NOT EXISTS {_quote(self.table + '_available')}
+                    ON {table}(priority DESC, id) WHERE claimed_until IS NULL;
+                CREATE INDEX IF NOT EXISTS {_quote(self.table + '_claimed')}
+                    ON {table}(claimed_until) WHERE claimed_until IS NOT NULL;
+            ''')
+            self._setup_done = True
+
+    def _notify(self):
+        self._wakeup.set_result(None)
+        self._wakeup = self.conn._loop.create_future()
+
+    async def put(self, payload, *, priority=0):
+        '''Add a message with the given payload, any value SQLite can store, and priority.
+        Higher priorities are got first.  Returns the message ID.'''
+        await self._setup()
+        message_id = await self.conn.schedule(self._put, self.conn._conn, payload, priority)
+        self.put_count += 1
+        self._notify()
+        return message_id
+
+    def _put(self, conn, payload, priority):
+        in_transaction = conn.in_transaction
+        message_id = conn.execute(f'INSERT INTO {_quote(self.table)}(payload, priority) '
+                                  'VALUES(?, ?)', (payload, priority)).lastrowid
+        if not in_transaction:
+            conn.commit()
+        return message_id
+
+    async def put_many(self, payloads, *, priority=0):
+        '''Add a message for each of payloads, in one transaction.  Returns the number
+        added.'''
+        await self._setup()
+        count = await self.conn.schedule(self._put_many, self.conn._conn, payloads, priority)
+        self.put_count += count
+        self._notify()
+        return count
+
+    def _put_many(self, conn, payloads, priority):
+        in_transaction = conn.in_transaction
+        count = conn.executemany(f'INSERT INTO {_quote(self.table)}(payload, priority) '
+                                 'VALUES(?, ?)',
+                                 ((payload, priority) for payload in payloads)).rowcount
+        if not in_transaction:
+            conn.commit()
+        return count
+
+    async def get(self, *, visibility_timeout=30.0, timeout=None):
+        '''Claim and return the next available Message, waiting for one if necessary.  If
+        timeout is not None, return None if none is available within that many seconds.'''
+        await self._setup()
+        loop = self.conn._loop
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            # Take the wakeup future before claiming so no put can be missed
+            wakeup = self._wakeup
+            message, next_expiry = await self.conn.schedule(
+                self._claim, self.conn._conn, time.time(), visibility_timeout)
+            if message is not None:
+                return message
+            waits = [self.poll_interval]
+            if deadline is not None:
+                waits.append(deadline - loop.time())
+                if waits[-1] <= 0:
+                    return None
+            if next_expiry is not None:
+                waits.append(max(next_expiry - time.time(), 0))
+            waits = [wait for wait in waits if wait is not None]
+            try:
+                await asyncio.wait_for(asyncio.shield(wakeup), min(waits) if waits else None)
+            except asyncio.TimeoutError:
+                pass
+
+    def _claim(self, conn, now, visibility_timeout):
+        '''Return (message, None) having claimed a message, otherwise (None, the earliest
+        expiry of a claim or None).'''
+        table = _quote(self.table)
+        in_transaction = conn.in_transaction
+        # Make messages with expired claims available
+        conn.execute(f'UPDATE {table} SET claimed_until = NULL WHERE claimed_until <= ?',
+                     (now, ))
+        message = next_expiry = None
+        row = conn.execute(f'SELECT id, payload, priority, attempts FROM {table} '
+                           'WHERE claimed_until IS NULL ORDER BY priority DESC, id LIMIT 1'
+                           ).fetchone()
+        # The claimed_until test guards against a concurrent claim by another process
+        if row and conn.execute(f'UPDATE {table} SET claimed_until = ?, attempts = ? '
+                                'WHERE id = ? AND claimed_until IS NULL',
+                                (now + visibility_timeout, row[3] + 1, row[0])).rowcount:
+            message = Message(row[0], row[1], row[2], row[3] + 1)
+        else:
+            next_expiry = conn.execute(f'SELECT MIN(claimed_until) FROM {table} '
+                                       'WHERE claimed_until IS NOT NULL').fetchone()[0]
+        if not in_transaction:
+            conn.commit()
+        return message, next_expiry
+
+    async def ack(self, message):
+        '''Acknowledge a message got with get(), deleting it.  Ignored if its claim has
+        expired and it has since been claimed again.'''
+        self._acks.append((message.id, message.attempts))
+        batch_done = self._batch_done
+        if self._flusher is None:
+            self._flusher = self.conn._loop.create_task(self._flush())
+        await asyncio.shield(batch_done)
+
+    async def _flush(self):
+        loop = self.conn._loop
+        try:
+            while self._acks:
+                acks, self._acks = self._acks, []
+                batch_done, self._batch_done = self._batch_done, loop.create_future()
+                try:
+                    self.ack_count += await self.conn.schedule(self._ack, self.conn._conn,
+                                                               acks)
+                except Exception as e:
+                    batch_done.set_exception(e)
+                else:
+                    batch_done.set_result(None)
+        finally:
+            self._flusher = None
+
+    def _ack(self, conn, acks):
+        in_transaction = conn.in_transaction
+        count = conn.executemany(f'DELETE FROM {_quote(self.table)} '
+                                 'WHERE id = ? AND attempts = ?', acks).rowcount
+        if not in_transaction:
+            conn.commit()
+        return count
+
+    async def nack(self, message):
+        '''Return a message got with get() to the queue, making it available immediately.
+        Ignored if its claim has expired and it has since been claimed again.'''
+        if await self.conn.schedule(self._nack, self.conn._conn, message.id,
+                                    message.attempts):
+            self.nack_count += 1
+            self._notify()
+
+    def _nack(self, conn, message_id, attempts):
+        in_transaction = conn.in_transaction
+        count = conn.execute(f'UPDATE {_quote(self.table)} SET claimed_until = NULL '
+                             'WHERE id = ? AND attempts = ? AND claimed_until IS NOT NULL',
+                             (message_id, attempts)).rowcount
+        if not in_transaction:
+            conn.commit()
+        return count
+
+    async def qsize(self):
+        '''Return the number of messages not yet acknowledged, whether claimed or not.'''
+        await self._setup()
+        cursor = await self.conn.execute(f'SELECT COUNT(*) FROM {_quote(self.table)}')
+        return (await cursor.fetchone())[0]
+
+    async def flush(self):
+        '''Wait until pending acknowledgements are written.'''
+        if self._flusher:
+            await asyncio.shield(self._flusher)
@@ -0,0 +1,81 @@
+# Copyright (c) 2024 Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''Template databases built once and cloned many times.  Requires Python 3.11.'''
+
+import asyncio
+import sqlite3
+
+from .asqlite3 import Connection, connect, _check_clone_filename
+
+
+def _restore_image(target, image):
+    '''Replace the main database of the sqlite3 connection target with image.'''
+    source = sqlite3.connect(':memory:')
+    try:
+        source.deserialize(image)
+        source.backup(target)
+    finally:
+        source.close()
+
+
+def _restore_image_to_file(filename, image):
+    target = sqlite3.connect(filename)
+    try:
+        _restore_image(target, image)
+    finally:
+        target.close()
+
+
+class TemplateCache:
+    '''Builds each named template database once, in memory, and keeps its serialized image.
+    New databases are stamped out from the image rather than by rerunning the schema and
+    seed statements.
+    '''
+
+    def __init__(self):
+        self._builders = {}
+        self._images = {}
+
+    def add(self, name, build):
+        '''Register a template.  build is an async callable passed an in-memory Connection
+        that it should populate.  Replaces any existing template and its image.'''
+        self._builders[name] = build
+        self._images.pop(name, None)
+
+    async def image(self, name):
+        '''Return the serialized image of the named template, building it if necessary.
+        Concurrent callers share a single build.'''
+        task = self._images.get(name)
+        if task is None:
+            task = self._images[name] = asyncio.ensure_future(self._build(name))
+        try:
+            return await asyncio.shield(task)
+        except BaseException:
+            if self._images.get(name) is task and task.done():
+                del self._images[name]
+            raise
+
+    async def _build(self, name):
+        build = self._builders[name]
+        async with connect(':memory:') as conn:
+            await build(conn)
+            if conn.in_transaction:
+                await conn.commit()
+            return await conn.serialize()
+
+    async def clone_to(self, name, target):
+        '''Replace the contents of target, a Connection or a filename, with the named
+        template.'''
+        if not isinstance(target, Connection):
+            _check_clone_filename(target)
+        image = await self.image(name)
+        if isinstance(target, Connection):
+            await target.schedule(_restore_image, target._conn, image)
+        else:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, _restore_image_to_file, target, image)
@@ -0,0 +1,56 @@
+# Copyright (c) 2024 Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''Compare Connection.bulk_load() with plain executemany() into an indexed table.'''
+
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+import asqlite3
+
+SCHEMA = '''
+CREATE TABLE T(id INTEGER PRIMARY KEY, a, b, c);
+CREATE INDEX TA ON T(a);
+CREATE INDEX TB ON T(b, c);
+'''
+
+
+def rows(count):
+    rand = random.Random(0)
+    for n in range(count):
+        yield (n, rand.random(), rand.randrange(1_000_000), str(rand.random()))
+
+
+async def plain(filename, count):
+    async with asqlite3.connect(filename) as conn:
+        await conn.executescript(SCHEMA)
+        await conn.executemany('INSERT INTO T VALUES(?, ?, ?, ?)', rows(count))
+        await conn.commit()
+
+
+async def bulk(filename, count):
+    async with asqlite3.connect(filename) as conn:
+        await conn.executescript(SCHEMA)
+        await conn.bulk_load('T', rows(count))
+
+
+async def main(count=500_000):
+    with tempfile.TemporaryDirectory() as dirname:
+        for func in (plain, bulk):
+            filename = os.path.join(dirname, f'{func.__name__}.sqlite')
+            start = time.perf_counter()
+            await func(filename, count)
+            elapsed = time.perf_counter() - start
+            print(f'{func.__name__:>6}: {count:,d} rows in {elapsed:.2f}s '
+                  f'({count / elapsed:,.0f} rows/s)')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
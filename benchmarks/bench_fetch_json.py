@@ -0,0 +1,53 @@
+# Copyright (c) 2024 Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''Compare Connection.fetch_json() and fetch_json_stream() with fetching rows and calling
+json.dumps() on the event loop.  Loop CPU is the CPU time of the event loop thread.'''
+
+import asyncio
+import json
+import time
+
+import asqlite3
+
+SQL = 'SELECT id, name, price, qty FROM T WHERE id < ?'
+
+
+async def python_path(conn, count):
+    cursor = await conn.execute(SQL, (count, ))
+    names = [column[0] for column in cursor.description]
+    rows = await cursor.fetchall()
+    return json.dumps([dict(zip(names, row)) for row in rows], separators=(',', ':'))
+
+
+async def fetch_json(conn, count):
+    return await conn.fetch_json(SQL, (count, ))
+
+
+async def fetch_json_stream(conn, count):
+    return ''.join([chunk async for chunk in conn.fetch_json_stream(SQL, (count, ))])
+
+
+async def main(count=200_000, repeat=5):
+    async with asqlite3.connect(':memory:') as conn:
+        await conn.execute('CREATE TABLE T(id INTEGER PRIMARY KEY, name, price, qty)')
+        await conn.bulk_load('T', ((n, f'item {n}', n * 0.25, n % 100) for n in range(count)))
+        for func in (python_path, fetch_json, fetch_json_stream):
+            # Warm up, and check the results agree
+            assert json.loads(await func(conn, 10)) == json.loads(await python_path(conn, 10))
+            start = time.perf_counter()
+            cpu_start = time.thread_time()
+            for _ in range(repeat):
+                await func(conn, count)
+            cpu = (time.thread_time() - cpu_start) / repeat
+            elapsed = (time.perf_counter() - start) / repeat
+            print(f'{func.__name__:>17}: {count:,d} rows in {elapsed * 1000:.0f}ms, '
+                  f'loop CPU {cpu * 1000:.0f}ms')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,82 @@
+# Copyright (c) 2024 Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''Throughput of asqlite3.kv.KVStore, compared with a naive wrapper committing each write
+and querying each read.'''
+
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+import asqlite3
+from asqlite3.kv import KVStore
+
+
+class NaiveStore:
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def setup(self):
+        await self.conn.execute('CREATE TABLE naive(key TEXT PRIMARY KEY, value)')
+
+    async def set(self, key, value):
+        await self.conn.execute('INSERT OR REPLACE INTO naive VALUES(?, ?)', (key, value))
+        await self.conn.commit()
+
+    async def get(self, key):
+        cursor = await self.conn.execute('SELECT value FROM naive WHERE key = ?', (key, ))
+        row = await cursor.fetchone()
+        return row[0] if row else None
+
+
+def report(label, count, elapsed):
+    print(f'{label:>32}: {count:,d} ops in {elapsed:.2f}s ({count / elapsed:,.0f} ops/s)')
+
+
+async def run(store, label, count, concurrency):
+    keys = [f'key:{n:08d}' for n in range(count)]
+    rand = random.Random(0)
+
+    async def writer(part):
+        for key in part:
+            await store.set(key, 'v' * 100)
+
+    async def reader(part):
+        for _ in part:
+            await store.get(rand.choice(keys))
+
+    for func in (writer, reader):
+        parts = [keys[n::concurrency] for n in range(concurrency)]
+        start = time.perf_counter()
+        await asyncio.gather(*(func(part) for part in parts))
+        report(f'{label} {func.__name__}s x{concurrency}', count, time.perf_counter() - start)
+
+
+async def main(count=5_000):
+    with tempfile.TemporaryDirectory() as dirname:
+        for concurrency in (1, 50):
+            filename = os.path.join(dirname, f'kv{concurrency}.sqlite')
+            async with asqlite3.connect(filename) as conn:
+                naive = NaiveStore(conn)
+                await naive.setup()
+                await run(naive, 'naive', count, concurrency)
+                async with KVStore(conn) as store:
+                    await run(store, 'KVStore', count, concurrency)
+                    start = time.perf_counter()
+                    await store.set_many((f'many:{n}', n) for n in range(count * 10))
+                    report('KVStore set_many', count * 10, time.perf_counter() - start)
+                    store._cache.clear()
+                    start = time.perf_counter()
+                    await store.get_many([f'many:{n}' for n in range(count * 10)])
+                    report('KVStore get_many', count * 10, time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
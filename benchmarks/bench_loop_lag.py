@@ -0,0 +1,60 @@
+# Copyright (c) 2024 Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''Measure event loop lag while large results are fetched through Cursor, with and without
+the fetch_slice_rows option.'''
+
+import asyncio
+import statistics
+import time
+
+import asqlite3
+
+TICK = 0.001
+
+
+async def ticker(lags, stop):
+    '''Record how late a callback scheduled every TICK seconds runs.'''
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - start - TICK)
+
+
+async def scan(count, fetch_slice_rows, repeat=5):
+    async with asqlite3.connect(':memory:', fetch_slice_rows=fetch_slice_rows) as conn:
+        await conn.execute('CREATE TABLE T(id INTEGER PRIMARY KEY, a, b, c)')
+        await conn.bulk_load('T', ((n, n * 0.5, str(n) * 3, b'x' * 20) for n in range(count)))
+        lags = []
+        # Freeing a large result also stalls the loop, so results are kept until the end
+        results = []
+        stop = asyncio.Event()
+        task = asyncio.ensure_future(ticker(lags, stop))
+        await asyncio.sleep(0.05)
+        lags.clear()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            cursor = await conn.execute('SELECT * FROM T')
+            results.append(await cursor.fetchall())
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await task
+    assert all(len(rows) == count for rows in results)
+    lags.sort()
+    return elapsed / repeat, lags[len(lags) * 99 // 100], lags[-1], statistics.mean(lags)
+
+
+async def main(count=200_000):
+    for fetch_slice_rows in (0, 5000, 1000, 250):
+        elapsed, p99, worst, mean = await scan(count, fetch_slice_rows)
+        label = f'slices of {fetch_slice_rows}' if fetch_slice_rows else 'plain'
+        print(f'{label:>15}: fetchall of {count:,d} rows in {elapsed:.2f}s; loop lag mean '
+              f'{mean * 1000:.2f}ms, p99 {p99 * 1000:.2f}ms, max {worst * 1000:.2f}ms')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
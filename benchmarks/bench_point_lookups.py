@@ -0,0 +1,60 @@
+# Copyright (c) 2024 Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''Compare point lookups with execute() then fetchone(), two jobs, against fetch_one() and
+fetch_value(), one job each.  Memory is the traced peak during a burst of concurrent
+lookups.'''
+
+import asyncio
+import time
+import tracemalloc
+
+import asqlite3
+
+SQL = 'SELECT value FROM T WHERE id = ?'
+
+
+async def execute_fetchone(conn, key):
+    cursor = await conn.execute(SQL, (key, ))
+    return (await cursor.fetchone())[0]
+
+
+async def fetch_one(conn, key):
+    return (await conn.fetch_one(SQL, (key, )))[0]
+
+
+async def fetch_value(conn, key):
+    return await conn.fetch_value(SQL, (key, ))
+
+
+async def main(rows=100_000, count=20_000, burst=200):
+    async with asqlite3.connect(':memory:') as conn:
+        await conn.execute('CREATE TABLE T(id INTEGER PRIMARY KEY, value)')
+        await conn.bulk_load('T', ((n, f'value {n}') for n in range(rows)))
+        for func in (execute_fetchone, fetch_one, fetch_value):
+            assert await func(conn, 7) == 'value 7'
+            start = time.perf_counter()
+            for n in range(count):
+                await func(conn, n * 7 % rows)
+            latency = (time.perf_counter() - start) / count
+
+            start = time.perf_counter()
+            for n in range(0, count, burst):
+                await asyncio.gather(*(func(conn, key) for key in range(n, n + burst)))
+            rate = count / (time.perf_counter() - start)
+
+            tracemalloc.start()
+            await asyncio.gather(*(func(conn, key) for key in range(burst)))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f'{func.__name__:>16}: sequential {latency * 1e6:.1f}us per lookup, '
+                  f'concurrent {rate:,.0f} lookups/s, peak memory {peak // burst:,d} bytes '
+                  'per lookup')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,44 @@
+# Copyright (c) 2024 Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''Dequeue throughput of asqlite3.queue.TaskQueue as the backlog grows.'''
+
+import asyncio
+import os
+import tempfile
+import time
+
+import asqlite3
+from asqlite3.queue import TaskQueue
+
+
+async def consume(tasks, count, consumers):
+    async def consumer():
+        for _ in range(count // consumers):
+            await tasks.ack(await tasks.get())
+
+    await asyncio.gather(*(consumer() for _ in range(consumers)))
+
+
+async def main(count=2_000):
+    with tempfile.TemporaryDirectory() as dirname:
+        for backlog in (1_000, 100_000, 1_000_000):
+            filename = os.path.join(dirname, f'queue{backlog}.sqlite')
+            async with asqlite3.connect(filename) as conn:
+                tasks = TaskQueue(conn)
+                await tasks.put_many(range(backlog))
+                for priority in (0, 1):
+                    await tasks.put_many(range(count // 2), priority=priority)
+                start = time.perf_counter()
+                await consume(tasks, count, 20)
+                elapsed = time.perf_counter() - start
+                print(f'backlog {backlog:>9,d}: {count:,d} get+ack in {elapsed:.2f}s '
+                      f'({count / elapsed:,.0f}/s)')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -5,8 +5,12 @@
 # See the file "LICENCE" for information about the copyright
 # and warranty status of this software.
 
+import array
 import asyncio
+import contextvars
+import json
 import os
+import random
 import sqlite3
 import sys
 import threading
@@ -17,7 +21,7 @@ import pytest
 import asqlite3
 
 from asqlite3 import (
-    connect, Connection, Cursor, Row,
+    connect, Connection, Cursor, Row, OverloadedError, WorkerPool, DatabaseManager,
     ProgrammingError, OperationalError, DatabaseError,
     SQLITE_OK, SQLITE_DENY, SQLITE_CREATE_TABLE, asqlite3_version, asqlite3_version_str,
 )
@@ -102,6 +106,25 @@ class TestCursor:
 
         asyncio.run(test())
 
+    def test_executemany_stream(self):
+        async def rows(count):
+            for n in range(count):
+                await asyncio.sleep(0)
+                yield (n, )
+
+        async def test():
+            async with connect(':memory:') as conn:
+                cursor = await conn.cursor()
+                await cursor.execute('CREATE TABLE T(x);')
+                sql = 'INSERT INTO T VALUES(?)'
+                assert await cursor.executemany_stream(sql, rows(25), chunk_size=10) is cursor
+                assert cursor.rowcount == 5
+                assert conn.in_transaction
+                await cursor.execute('SELECT SUM(x) FROM T')
+                assert await cursor.fetchall() == [(300, )]
+
+        asyncio.run(test())
+
     def test_executescript(self):
         with sqlite3.connect(':memory:') as conn:
             cursor = conn.cursor()
@@ -316,6 +339,85 @@ class TestConnection:
 
         asyncio.run(test())
 
+    def test_max_queue_size(self):
+        async def test():
+            async with connect(':memory:', max_queue_size=2) as conn:
+                futures = [conn.schedule(time.sleep, 0.01) for _ in range(4)]
+                assert conn.queue_depth == 4
+                assert conn._jobs.qsize() <= 2
+                # At most max_queue_size jobs wait for space
+                with pytest.raises(OverloadedError):
+                    conn.schedule(time.sleep, 0)
+                assert conn.rejected_count == 1
+                await asyncio.gather(*futures)
+                assert conn.queue_depth == 0
+
+        asyncio.run(test())
+
+    def test_wait_for_space(self):
+        async def test():
+            async with connect(':memory:', max_queue_size=2) as conn:
+                depths = []
+                futures = []
+                for _ in range(20):
+                    await conn.wait_for_space()
+                    depths.append(conn.queue_depth)
+                    futures.append(conn.schedule(time.sleep, 0.002))
+                assert max(depths) < 2
+                assert conn.rejected_count == 0
+                await asyncio.gather(*futures)
+
+                # Cancelled waiters are skipped
+                futures = [conn.schedule(time.sleep, 0.01) for _ in range(2)]
+                cancelled = asyncio.ensure_future(conn.wait_for_space())
+                waiter = asyncio.ensure_future(conn.wait_for_space())
+                await asyncio.sleep(0)
+                cancelled.cancel()
+                await asyncio.wait_for(waiter, 1)
+                await asyncio.gather(*futures)
+
+                # Waiters return when the connection closes
+                futures = [conn.schedule(time.sleep, 0.01) for _ in range(2)]
+                waiter = asyncio.ensure_future(conn.wait_for_space())
+                await asyncio.sleep(0)
+            await asyncio.wait_for(waiter, 1)
+
+        asyncio.run(test())
+
+    def test_max_queue_size_close(self):
+        async def test():
+            async with connect(':memory:', max_queue_size=1) as conn:
+                futures = [conn.schedule(time.sleep, 0.01) for _ in range(2)]
+            assert conn._jobs.empty()
+            assert await asyncio.gather(*futures) == [None, None]
+
+        asyncio.run(test())
+
+    def test_max_queue_wait_shed(self):
+        async def test():
+            async with connect(':memory:', max_queue_wait=0.02) as conn:
+                first = conn.schedule(time.sleep, 0.05)
+                second = conn.schedule(time.sleep, 0)
+                await first
+                with pytest.raises(OverloadedError):
+                    await second
+                assert conn.shed_count == 1
+
+        asyncio.run(test())
+
+    def test_max_queue_wait_reject(self):
+        async def test():
+            async with connect(':memory:', max_queue_wait=0.1) as conn:
+                conn._job_time = 0.06
+                first = conn.schedule(time.sleep, 0)
+                second = conn.schedule(time.sleep, 0)
+                with pytest.raises(OverloadedError):
+                    conn.schedule(time.sleep, 0)
+                assert conn.rejected_count == 1
+                await asyncio.gather(first, second)
+
+        asyncio.run(test())
+
     def test_cursor(self):
 
         class MyCursor(Cursor):
@@ -373,6 +475,28 @@ class TestConnection:
 
         asyncio.run(test())
 
+    def test_clone_to(self, tmpdir):
+        filename = os.path.join(tmpdir, 'clone.sqlite')
+
+        async def test():
+            async with connect(':memory:') as conn:
+                await conn.execute('CREATE TABLE T(x)')
+                await conn.executemany('INSERT INTO T VALUES(?)', ((n, ) for n in range(10)))
+                await conn.commit()
+                async with connect(':memory:') as target:
+                    await conn.clone_to(target)
+                    cursor = await target.execute('SELECT COUNT(*) FROM T')
+                    assert await cursor.fetchone() == (10, )
+                await conn.clone_to(filename)
+                for name in (':memory:', ''):
+                    with pytest.raises(ValueError):
+                        await conn.clone_to(name)
+            async with connect(filename) as target:
+                cursor = await target.execute('SELECT COUNT(*) FROM T')
+                assert await cursor.fetchone() == (10, )
+
+        asyncio.run(test())
+
     def test_interrupt(self):
         conn = None
         from threading import Thread, Event
@@ -440,6 +564,231 @@ class TestConnection:
 
         asyncio.run(test())
 
+    def test_executemany_sliced(self):
+        async def test():
+            async with connect(':memory:', slice_time=0.001) as conn:
+                await conn.execute('CREATE TABLE T(x);')
+                await conn.commit()
+                count = 100_000
+                insert = asyncio.ensure_future(conn.executemany(
+                    'INSERT INTO T VALUES(?)', ((n, ) for n in range(count))))
+                await asyncio.sleep(0.001)
+                # A point query is not held up until the insert completes
+                cursor = await conn.execute('SELECT 1')
+                assert await cursor.fetchone() == (1, )
+                assert not insert.done()
+                cursor = await insert
+                assert isinstance(cursor, Cursor)
+                assert conn.in_transaction
+                cursor = await conn.execute('SELECT COUNT(*) FROM T')
+                assert await cursor.fetchone() == (count, )
+                await conn.rollback()
+                cursor = await conn.execute('SELECT COUNT(*) FROM T')
+                assert await cursor.fetchone() == (0, )
+                assert conn._slice_rows != 256
+
+        asyncio.run(test())
+
+    def test_executemany_sliced_atomic(self):
+        def rows(count):
+            for n in range(count):
+                yield (n, )
+            yield (0, )
+
+        async def test():
+            async with connect(':memory:', slice_time=0.001) as conn:
+                await conn.execute('CREATE TABLE T(x PRIMARY KEY);')
+                await conn.execute('INSERT INTO T VALUES(-1)')
+                conn._slice_rows = 100
+                with pytest.raises(sqlite3.IntegrityError):
+                    await conn.executemany('INSERT INTO T VALUES(?)', rows(1000))
+                cursor = await conn.execute('SELECT * FROM T')
+                assert await cursor.fetchall() == [(-1, )]
+                # A small executemany runs in a single job
+                await conn.executemany('INSERT INTO T VALUES(?)', ((n, ) for n in range(5)))
+                cursor = await conn.execute('SELECT COUNT(*) FROM T')
+                assert await cursor.fetchone() == (6, )
+
+        asyncio.run(test())
+
+    def test_executemany_sliced_interleaved_write(self):
+        def rows(count):
+            for n in range(count):
+                yield (n, )
+            yield (0, )
+
+        async def test():
+            async with connect(':memory:', slice_time=0.001) as conn:
+                await conn.execute('CREATE TABLE T(x PRIMARY KEY)')
+                await conn.execute('CREATE TABLE U(x)')
+                await conn.commit()
+                insert = asyncio.ensure_future(conn.executemany('INSERT INTO T VALUES(?)',
+                                                                rows(100_000)))
+                await asyncio.sleep(0.001)
+                # Reads run between slices; the write is held back until they finish
+                assert await conn.fetch_value('SELECT COUNT(*) FROM U') == 0
+                write = asyncio.ensure_future(conn.execute('INSERT INTO U VALUES(1)'))
+                await asyncio.sleep(0.001)
+                assert not insert.done() and not write.done()
+                with pytest.raises(sqlite3.IntegrityError):
+                    await insert
+                await write
+                # The failed executemany did not discard the other write
+                assert await conn.fetch_all('SELECT * FROM U') == [(1, )]
+                assert await conn.fetch_value('SELECT COUNT(*) FROM T') == 0
+
+        asyncio.run(test())
+
+    def test_executemany_sliced_interleaved_commit(self):
+        async def test():
+            async with connect(':memory:', slice_time=0.001) as conn:
+                await conn.execute('CREATE TABLE T(x)')
+                await conn.commit()
+                authorized = []
+
+                def authorizer(action, *args):
+                    authorized.append(action)
+                    return SQLITE_OK
+
+                await conn.set_authorizer(authorizer)
+                count = 100_000
+                insert = asyncio.ensure_future(conn.executemany(
+                    'INSERT INTO T VALUES(?)', ((n, ) for n in range(count))))
+                await asyncio.sleep(0.001)
+                commit = asyncio.ensure_future(conn.commit())
+                await asyncio.sleep(0.001)
+                assert not insert.done() and not commit.done()
+                await insert
+                await commit
+                assert not conn.in_transaction
+                assert await conn.fetch_value('SELECT COUNT(*) FROM T') == count
+                # The user's authorizer was chained, and is restored
+                assert sqlite3.SQLITE_INSERT in authorized
+                authorized.clear()
+                await conn.execute('SELECT 1')
+                assert authorized
+
+        asyncio.run(test())
+
+    def test_executemany_sliced_held_order(self):
+        async def test():
+            async with connect(':memory:', slice_time=0.001) as conn:
+                await conn.execute('CREATE TABLE T(x)')
+                await conn.execute('CREATE TABLE U(x)')
+                await conn.commit()
+                # Pieces are not a whole number of chunks
+                store = asqlite3.BlobStore(conn, chunk_size=300)
+                await store.put('empty', b'')
+
+                async def pieces():
+                    for n in range(20):
+                        yield bytes([n]) * 1000
+                        await asyncio.sleep(0)
+
+                insert = asyncio.ensure_future(conn.executemany(
+                    'INSERT INTO T VALUES(?)', ((n, ) for n in range(100_000))))
+                await asyncio.sleep(0.001)
+                # A job that writes before it executes anything is held back before it starts,
+                # not run twice
+                put = asyncio.ensure_future(store.put('f', pieces()))
+                # Held jobs keep their order, so a read sees an earlier held write
+                results = await asyncio.gather(conn.execute('INSERT INTO U VALUES(1)'),
+                                               conn.fetch_all('SELECT * FROM U'))
+                assert results[1] == [(1, )]
+                await insert
+                assert await put == 20_000
+                assert await store.get('f') == b''.join(bytes([n]) * 1000 for n in range(20))
+
+        asyncio.run(test())
+
+    def test_executescript_sliced_transaction(self):
+        async def test():
+            async with connect(':memory:', slice_time=0) as conn:
+                await conn.execute('CREATE TABLE T(x)')
+                await conn.commit()
+                inserts = ''.join(f'INSERT INTO T VALUES({n});' for n in range(50))
+                script = asyncio.ensure_future(
+                    conn.executescript(f'BEGIN; {inserts} ROLLBACK;'))
+                await asyncio.sleep(0.001)
+                # Jobs that write or end the transaction wait for the script's transaction
+                assert not script.done()
+                await conn.execute('INSERT INTO T VALUES(-1)')
+                await conn.commit()
+                assert script.done()
+                await script
+                assert await conn.fetch_all('SELECT * FROM T') == [(-1, )]
+
+        asyncio.run(test())
+
+    def test_executescript_sliced(self):
+        async def test():
+            async with connect(':memory:', slice_time=0) as conn:
+                await conn.execute('CREATE TABLE U(x)')
+                await conn.execute('INSERT INTO U VALUES(1)')
+                assert conn.in_transaction
+                script = '''
+                    CREATE TABLE T(x);
+                    CREATE TABLE Log(x);
+                    CREATE TRIGGER TT AFTER INSERT ON T BEGIN INSERT INTO Log VALUES(new.x); END;
+                    BEGIN;
+                    INSERT INTO T VALUES(';');
+                    INSERT INTO T VALUES(2);
+                    COMMIT;
+                    -- trailing comment
+                '''
+                cursor = await conn.executescript(script)
+                assert isinstance(cursor, Cursor)
+                assert not conn.in_transaction
+                cursor = await conn.execute('SELECT * FROM Log')
+                assert await cursor.fetchall() == [(';', ), (2, )]
+                cursor = await conn.execute('SELECT * FROM U')
+                assert await cursor.fetchall() == [(1, )]
+                with pytest.raises(OperationalError):
+                    await conn.executescript('SELECT 1; SELECT')
+
+        asyncio.run(test())
+
+    def test_executemany_stream_commit(self, tmpdir):
+        filename = os.path.join(tmpdir, 'test.sqlite')
+        commits = []
+
+        async def rows(count):
+            for n in range(count):
+                yield (n, )
+
+        async def test():
+            async with connect(filename) as conn:
+                await conn.execute('CREATE TABLE T(x);')
+                await conn.set_trace_callback(commits.append)
+                cursor = await conn.executemany_stream('INSERT INTO T VALUES(?)', rows(95),
+                                                       chunk_size=10, commit_every=25)
+                assert isinstance(cursor, Cursor)
+                assert not conn.in_transaction
+                await conn.set_trace_callback(None)
+            async with connect(filename) as conn:
+                cursor = await conn.execute('SELECT COUNT(*) FROM T')
+                assert await cursor.fetchone() == (95, )
+
+        asyncio.run(test())
+        assert commits.count('COMMIT') == 4
+
+    def test_executemany_stream_producer_error(self):
+        async def rows():
+            for n in range(15):
+                yield (n, )
+            raise ValueError
+
+        async def test():
+            async with connect(':memory:') as conn:
+                await conn.execute('CREATE TABLE T(x);')
+                with pytest.raises(ValueError):
+                    await conn.executemany_stream('INSERT INTO T VALUES(?)', rows(),
+                                                  chunk_size=10)
+                cursor = await conn.execute('SELECT COUNT(*) FROM T')
+                assert await cursor.fetchone() == (10, )
+
+        asyncio.run(test())
+
     def test_executescript(self):
         with sqlite3.connect(':memory:') as conn:
             with pytest.raises(TypeError):
@@ -458,6 +807,157 @@ class TestConnection:
 
         asyncio.run(test())
 
+    def test_bulk_load(self, tmpdir):
+        filename = os.path.join(tmpdir, 'test.sqlite')
+
+        async def schema(conn):
+            cursor = await conn.execute("SELECT type, name FROM sqlite_master ORDER BY name")
+            return await cursor.fetchall()
+
+        async def test():
+            async with connect(filename) as conn:
+                await conn.executescript('''
+                    CREATE TABLE T(x PRIMARY KEY, y);
+                    CREATE INDEX TY ON T(y);
+                    CREATE TABLE Log(x);
+                    CREATE TRIGGER TT AFTER INSERT ON T BEGIN INSERT INTO Log VALUES(new.x); END;
+                ''')
+                before = await schema(conn)
+                count = await conn.bulk_load('T', ((n, -n) for n in range(1000)),
+                                             batch_size=100)
+                assert count == 1000
+                assert not conn.in_transaction
+                assert await schema(conn) == before
+                cursor = await conn.execute('SELECT COUNT(*) FROM Log')
+                assert await cursor.fetchone() == (0, )
+                cursor = await conn.execute('PRAGMA synchronous')
+                assert await cursor.fetchone() == (2, )
+                cursor = await conn.execute('SELECT x FROM T WHERE y = -5')
+                assert await cursor.fetchall() == [(5, )]
+
+                assert await conn.bulk_load('T', [(2000, )], columns=['x']) == 1
+                with pytest.raises(OperationalError):
+                    await conn.bulk_load('Z', [(1, )])
+
+        asyncio.run(test())
+
+    def test_bulk_load_failure(self):
+        async def test():
+            async with connect(':memory:') as conn:
+                await conn.executescript('''
+                    CREATE TABLE T(x, y);
+                    CREATE UNIQUE INDEX TY ON T(y);
+                    INSERT INTO T VALUES(0, 0);
+                ''')
+                await conn.execute('INSERT INTO T VALUES(1, 1)')
+                assert conn.in_transaction
+                # The duplicate is only detected when the index is rebuilt
+                with pytest.raises(sqlite3.IntegrityError):
+                    await conn.bulk_load('T', [(2, 2), (3, 0)])
+                assert conn.in_transaction
+                cursor = await conn.execute('SELECT * FROM T')
+                assert await cursor.fetchall() == [(0, 0), (1, 1)]
+                cursor = await conn.execute("SELECT name FROM sqlite_master WHERE type='index'")
+                assert await cursor.fetchall() == [('TY', )]
+                cursor = await conn.execute('PRAGMA cache_size')
+                assert await cursor.fetchone() == (-2000, )
+
+        asyncio.run(test())
+
+    def test_insert_columns(self):
+        async def test():
+            async with connect(':memory:') as conn:
+                await conn.execute('CREATE TABLE T(i INTEGER, f REAL, s TEXT, b)')
+                columns = {
+                    'i': array.array('q', range(5)),
+                    'f': memoryview(array.array('d', (n / 2 for n in range(5)))),
+                    's': [str(n) for n in range(5)],
+                    'b': [bytes([n]) for n in range(5)],
+                }
+                assert await conn.insert_columns('T', columns) == 5
+                cursor = await conn.execute('SELECT * FROM T')
+                assert await cursor.fetchall() == [(n, n / 2, str(n), bytes([n]))
+                                                   for n in range(5)]
+                with pytest.raises(ValueError):
+                    await conn.insert_columns('T', {'i': [1], 'f': [1.0, 2.0]})
+                with pytest.raises(ValueError):
+                    await conn.insert_columns('T', {})
+
+        asyncio.run(test())
+
+    def test_insert_columns_numpy(self):
+        np = pytest.importorskip('numpy')
+
+        async def test():
+            async with connect(':memory:') as conn:
+                await conn.execute('CREATE TABLE T(i, f, b)')
+                columns = {'i': np.arange(10)[::2], 'f': np.linspace(0, 1, 5),
+                           'b': np.array([True, False] * 2 + [True])}
+                assert await conn.insert_columns('T', columns) == 5
+                cursor = await conn.execute('SELECT SUM(i), SUM(f), SUM(b) FROM T')
+                assert await cursor.fetchone() == (20, 2.5, 3)
+
+        asyncio.run(test())
+
+    def test_fetch_shared(self):
+        async def test():
+            async with connect(':memory:') as conn:
+                await conn.execute('CREATE TABLE T(x)')
+                await conn.executemany('INSERT INTO T VALUES(?)', ((n, ) for n in range(10)))
+                # Hold up the worker so the reads are all queued together
+                conn.schedule(time.sleep, 0.02)
+                sql = 'SELECT x FROM T WHERE x < ?'
+                results = await asyncio.gather(*(conn.fetch_shared(sql, (n % 2 + 3, ))
+                                                 for n in range(10)))
+                assert results[0] == ((0, ), (1, ), (2, ))
+                assert results[1] == ((0, ), (1, ), (2, ), (3, ))
+                assert all(result is results[n % 2] for n, result in enumerate(results))
+                assert conn.shared_read_count == 2
+                assert conn.deduplicated_read_count == 8
+                assert not conn._in_flight
+                # Once complete, the query runs again
+                assert await conn.fetch_shared(sql, [3]) == results[0]
+                assert conn.shared_read_count == 3
+                assert await conn.fetch_shared('SELECT :a', {'a': 1}) == ((1, ), )
+
+                # Equal parameters of different types are not shared
+                conn.schedule(time.sleep, 0.02)
+                sql = 'SELECT typeof(?)'
+                results = await asyncio.gather(*(conn.fetch_shared(sql, (value, ))
+                                                 for value in (1, 1.0, True, 1)))
+                assert results == [(('integer', ), ), (('real', ), ), (('integer', ), ),
+                                   (('integer', ), )]
+                assert results[0] is results[3]
+                results = await asyncio.gather(conn.fetch_shared('SELECT typeof(:a)', {'a': 1}),
+                                               conn.fetch_shared('SELECT typeof(:a)', {'a': 1.0}))
+                assert results == [(('integer', ), ), (('real', ), )]
+
+        asyncio.run(test())
+
+    def test_fetch_shared_error(self):
+        async def test():
+            async with connect(':memory:') as conn:
+                conn.schedule(time.sleep, 0.01)
+                results = await asyncio.gather(conn.fetch_shared('SELECT * FROM Z'),
+                                               conn.fetch_shared('SELECT * FROM Z'),
+                                               return_exceptions=True)
+                assert all(isinstance(result, OperationalError) for result in results)
+                assert conn.shared_read_count == 1
+
+        asyncio.run(test())
+
+    def test_fetch_shared_cancel(self):
+        async def test():
+            async with connect(':memory:') as conn:
+                conn.schedule(time.sleep, 0.02)
+                first = asyncio.ensure_future(conn.fetch_shared('SELECT 1'))
+                second = asyncio.ensure_future(conn.fetch_shared('SELECT 1'))
+                await asyncio.sleep(0)
+                first.cancel()
+                assert await second == ((1, ), )
+
+        asyncio.run(test())
+
     def test_create_function(self):
         def myfunc(x):
             return x * 8
@@ -482,6 +982,152 @@ class TestConnection:
 
         asyncio.run(test())
 
+    def test_create_function_memoize(self):
+        calls = []
+
+        def myfunc(x):
+            calls.append(x)
+            return x * 8
+
+        async def test():
+            async with connect(':memory:') as conn:
+                with pytest.raises(ValueError):
+                    await conn.create_function('mf', 1, myfunc, memoize=2)
+                await conn.create_function('mf', 1, myfunc, deterministic=True, memoize=2)
+                await conn.execute('CREATE TABLE T(x)')
+                await conn.executemany('INSERT INTO T VALUES(?)', ((n % 3, ) for n in range(30)))
+                await conn.execute('INSERT INTO T VALUES(1.0)')
+                cursor = await conn.execute('SELECT SUM(mf(x)) FROM T')
+                assert await cursor.fetchone() == (248.0, )
+                stats = conn.memoize_stats()[('mf', 1)]
+                assert stats['hits'] + stats['misses'] == 31
+                assert stats['size'] == 2
+                # The int 1 and the float 1.0 are cached separately
+                assert 1 in calls and 1.0 in [x for x in calls if isinstance(x, float)]
+
+                calls.clear()
+                cursor = await conn.execute('SELECT mf(0), mf(0), mf(0)')
+                assert await cursor.fetchone() == (0, 0, 0)
+                assert len(calls) <= 1
+
+                # Re-registration discards the cache
+                await conn.create_function('MF', 1, myfunc, deterministic=True)
+                assert conn.memoize_stats() == {}
+
+        asyncio.run(test())
+
+    def test_callback_stats(self):
+        class MySum:
+            def __init__(self):
+                self.total = 0
+
+            def step(self, value):
+                self.total += value
+
+            def finalize(self):
+                return self.total
+
+        def authorizer(*args):
+            return SQLITE_OK
+
+        async def test():
+            async with connect(':memory:') as conn:
+                with pytest.raises(RuntimeError):
+                    await conn.callback_stats()
+
+            async with connect(':memory:', callback_stats=True) as conn:
+                await conn.create_function('double', 1, lambda x: x * 2)
+                await conn.create_aggregate('mysum', 1, MySum)
+                await conn.create_collation('rev', lambda a, b: (a < b) - (a > b))
+                await conn.set_authorizer(authorizer)
+                await conn.set_trace_callback(lambda sql: None)
+                await conn.execute('CREATE TABLE T(x)')
+                await conn.executemany('INSERT INTO T VALUES(?)', ((n, ) for n in range(10)))
+                sql = 'SELECT mysum(double(x)) FROM T'
+                cursor = await conn.execute(sql)
+                assert await cursor.fetchone() == (90, )
+                sql2 = 'SELECT x FROM T ORDER BY CAST(x AS TEXT) COLLATE rev'
+                cursor = await conn.cursor()
+                await cursor.execute(sql2)
+                assert (await cursor.fetchall())[0] == (9, )
+
+                stats = await conn.callback_stats()
+                assert stats['function:double']['calls'] == 10
+                assert list(stats['function:double']['statements']) == [sql]
+                # step() ten times, __init__ and finalize()
+                assert stats['aggregate:mysum']['statements'][sql]['calls'] == 12
+                assert list(stats['collation:rev']['statements']) == [sql2]
+                assert stats['collation:rev']['calls'] > 0
+                assert stats['authorizer']['calls'] > 0
+                assert stats['trace']['calls'] > 0
+                for value in stats.values():
+                    assert 0 < value['max_time'] <= value['total_time']
+                await conn.reset_callback_stats()
+                stats = await conn.callback_stats()
+                assert stats == {}
+
+        asyncio.run(test())
+
+    def test_step_metering(self):
+        async def test():
+            async with connect(':memory:') as conn:
+                with pytest.raises(RuntimeError):
+                    await conn.step_stats()
+
+            async with connect(':memory:', meter_steps=10) as conn:
+                await conn.execute('CREATE TABLE T(x)')
+                await conn.executemany('INSERT INTO T VALUES(?)', ((n, ) for n in range(1000)))
+                for n in range(3):
+                    cursor = await conn.execute(f'SELECT * FROM T WHERE x >  {n}')
+                    async for row in cursor:
+                        pass
+                await (await conn.execute('SELECT 1')).fetchall()
+                stats = await conn.step_stats()
+                assert stats[0]['sql'] == 'SELECT * FROM T WHERE x > ?'
+                assert stats[0]['executions'] == 3
+                assert stats[0]['steps'] > 3000
+                assert stats[0]['max_steps'] * 3 >= stats[0]['steps']
+                assert stats[0]['aborted'] == 0
+                assert len(await conn.step_stats(top=1)) == 1
+                await conn.reset_step_stats()
+                assert await conn.step_stats() == []
+
+        asyncio.run(test())
+
+    def test_step_budget(self):
+        calls = []
+
+        def handler():
+            calls.append(1)
+            return 0
+
+        async def test():
+            async with connect(':memory:', meter_steps=10) as conn:
+                await conn.set_progress_handler(handler, 100)
+                await conn.execute('CREATE TABLE T(x)')
+                await conn.executemany('INSERT INTO T VALUES(?)', ((n, ) for n in range(1000)))
+                await conn.set_step_budget(500, sql='SELECT * FROM T WHERE x > 5')
+                # The budget applies across fetches from the cursor
+                cursor = await conn.execute('SELECT * FROM T WHERE x > 1')
+                await cursor.fetchmany(10)
+                with pytest.raises(OperationalError):
+                    await cursor.fetchall()
+                # Other statements are unaffected
+                cursor = await conn.execute('SELECT COUNT(*) FROM T')
+                assert await cursor.fetchone() == (1000, )
+                await conn.set_step_budget(500)
+                with pytest.raises(OperationalError):
+                    await conn.execute('SELECT SUM(x) FROM T')
+                await conn.set_step_budget(None)
+                await conn.set_step_budget(None, sql='SELECT * FROM T WHERE x > 0')
+                cursor = await conn.execute('SELECT * FROM T WHERE x > 1')
+                assert len(await cursor.fetchall()) == 998
+                stats = await conn.step_stats()
+                assert sum(item['aborted'] for item in stats) == 2
+            assert calls
+
+        asyncio.run(test())
+
     def test_create_aggregate(self):
         class MySum:
             def __init__(self):
@@ -693,6 +1339,505 @@ class TestConnection:
 
         asyncio.run(test())
 
+    def test_fetch_budget(self):
+        async def test():
+            async with connect(':memory:') as conn:
+                await conn.execute('CREATE TABLE T(x)')
+                await conn.executemany('INSERT INTO T VALUES(?)',
+                                       [('a' * 1000, ) for _ in range(100)])
+                cursor = await conn.execute('SELECT x FROM T')
+                with pytest.raises(asqlite3.FetchBudgetError) as e:
+                    await cursor.fetchall(max_bytes=20000)
+                assert 15 < len(e.value.rows) < 25
+                assert e.value.size > 20000
+                assert conn.fetch_budget_exceeded_count == 1
+                fetched = len(e.value.rows)
+
+                rows = await cursor.fetchmany(10, max_bytes=20000)
+                assert len(rows) == 10 and not cursor.truncated
+                fetched += 10
+                while True:
+                    rows = await cursor.fetchall(max_bytes=20000, partial=True)
+                    fetched += len(rows)
+                    if not cursor.truncated:
+                        break
+                    assert len(rows) < 25
+                assert fetched == 100
+                assert conn.fetch_budget_exceeded_count > 2
+                assert 15 < conn.fetch_high_water_rows < 25
+                assert 20000 < conn.fetch_high_water_bytes < 25000
+
+                # A budget of zero returns one row at a time
+                cursor = await conn.execute('SELECT x FROM T')
+                assert len(await cursor.fetchmany(5, max_bytes=0, partial=True)) == 1
+                assert cursor.truncated
+
+                # Truncation is only reported if a row remains
+                cursor = await conn.execute('SELECT x FROM T LIMIT 2')
+                assert len(await cursor.fetchall(max_bytes=1500, partial=True)) == 1
+                assert cursor.truncated
+                assert len(await cursor.fetchall(max_bytes=1500, partial=True)) == 1
+                assert not cursor.truncated
+                # The unread row is returned by any later fetch
+                for fetch in (lambda cursor: cursor.fetchone(),
+                              lambda cursor: cursor.fetchmany(1),
+                              lambda cursor: cursor.fetchmany(3),
+                              lambda cursor: cursor.fetchall()):
+                    cursor = await conn.execute('SELECT rowid FROM T WHERE rowid <= 3')
+                    await cursor.fetchmany(5, max_bytes=0, partial=True)
+                    rows = await fetch(cursor)
+                    assert rows == (2, ) or rows[0] == (2, )
+                cursor = await conn.execute('SELECT rowid FROM T WHERE rowid <= 3')
+                await cursor.fetchmany(5, max_bytes=0, partial=True)
+                assert [row async for row in cursor] == [(2, ), (3, )]
+
+        asyncio.run(test())
+
+    def test_max_fetch_bytes(self):
+        async def test():
+            async with connect(':memory:', max_fetch_bytes=1000) as conn:
+                conn.row_factory = Row
+                cursor = await conn.execute("SELECT 'a' UNION ALL SELECT zeroblob(2000)")
+                assert [row[0] for row in await cursor.fetchmany(1)] == ['a']
+                with pytest.raises(asqlite3.FetchBudgetError):
+                    await cursor.fetchall()
+                assert conn.fetch_budget_exceeded_count == 1
+                cursor = await conn.execute("SELECT 1")
+                # An explicit budget overrides the connection's
+                assert [tuple(row) for row in await cursor.fetchall(max_bytes=10**6)] == [(1, )]
+
+                # Iteration fetches batches within the budget
+                conn.row_factory = None
+                await conn.execute('CREATE TABLE T(x)')
+                await conn.executemany('INSERT INTO T VALUES(?)', [('a' * 300, )] * 10)
+                cursor = await conn.execute('SELECT x FROM T')
+                cursor.arraysize = 10
+                assert len([row async for row in cursor]) == 10
+                assert conn.fetch_high_water_rows == 2
+
+                # One-hop and shared fetches are budgeted too
+                exceeded_count = conn.fetch_budget_exceeded_count
+                with pytest.raises(asqlite3.FetchBudgetError):
+                    await conn.fetch_all('SELECT x FROM T')
+                with pytest.raises(asqlite3.FetchBudgetError):
+                    await conn.fetch_column('SELECT x FROM T')
+                with pytest.raises(asqlite3.FetchBudgetError):
+                    await conn.fetch_shared('SELECT x FROM T')
+                assert conn.fetch_budget_exceeded_count == exceeded_count + 3
+                assert await conn.fetch_all('SELECT x FROM T LIMIT 2') == [('a' * 300, )] * 2
+                assert await conn.fetch_column('SELECT x FROM T LIMIT 1') == ['a' * 300]
+                assert conn.fetch_high_water_rows == 3
+
+        asyncio.run(test())
+
+    def test_fetch_slice_rows(self):
+        async def test():
+            async with connect(':memory:', fetch_slice_rows=3) as conn:
+                await conn.execute('CREATE TABLE T(x)')
+                await conn.executemany('INSERT INTO T VALUES(?)', [(n, ) for n in range(10)])
+                cursor = await conn.execute('SELECT x FROM T')
+                assert await cursor.fetchmany(2) == [(0, ), (1, )]
+                assert await cursor.fetchmany(7) == [(n, ) for n in range(2, 9)]
+                assert await cursor.fetchall() == [(9, )]
+                assert await cursor.fetchall() == []
+                cursor = await conn.execute('SELECT x FROM T')
+                assert await cursor.fetchall() == [(n, ) for n in range(10)]
+                cursor = await conn.execute('SELECT x FROM T WHERE x < 6')
+                assert await cursor.fetchall() == [(n, ) for n in range(6)]
+                assert await conn.fetch_all('SELECT x FROM T') == [(n, ) for n in range(10)]
+                assert await conn.fetch_column('SELECT x FROM T') == list(range(10))
+                assert await conn.fetch_shared('SELECT x FROM T') == tuple(
+                    (n, ) for n in range(10))
+
+        asyncio.run(test())
+
+    def test_context_propagation(self):
+        request_id = contextvars.ContextVar('request_id', default=None)
+
+        async def test():
+            async with connect(':memory:') as conn:
+                async def handle(value):
+                    request_id.set(value)
+                    return await conn.schedule(request_id.get)
+
+                assert await asyncio.gather(handle(1), handle(2)) == [1, 2]
+                assert await conn.schedule(request_id.get) is None
+                await conn.create_function('request_id', 0, request_id.get)
+                request_id.set('r')
+                cursor = await conn.execute('SELECT request_id()')
+                assert await cursor.fetchall() == [('r', )]
+
+        asyncio.run(test())
+
+    def test_span_hook(self):
+        class Hook(asqlite3.SpanHook):
+            def __init__(self):
+                self.spans = []
+
+            def start_span(self, sql, queue_wait):
+                assert queue_wait >= 0
+                return [sql]
+
+            def end_span(self, span, elapsed, rows, exc):
+                assert elapsed >= 0
+                self.spans.append((span[0], rows, type(exc)))
+
+        async def test():
+            hook = Hook()
+            async with connect(':memory:', span_hook=hook) as conn:
+                await conn.execute('CREATE TABLE T(x)')
+                await conn.executemany('INSERT INTO T VALUES(?)', [(1, ), (2, )])
+                cursor = await conn.execute('SELECT x FROM T')
+                await cursor.fetchall()
+                with pytest.raises(OperationalError):
+                    await conn.execute('SELECT y FROM T')
+                assert hook.spans[1:] == [
+                    ('CREATE TABLE T(x)', None, type(None)),
+                    ('INSERT INTO T VALUES(?)', 2, type(None)),
+                    ('SELECT x FROM T', None, type(None)),
+                    (None, 2, type(None)),
+                    ('SELECT y FROM T', None, OperationalError),
+                ]
+                conn.span_hook = None
+                await conn.execute('SELECT 1')
+                assert len(hook.spans) == 6
+
+        asyncio.run(test())
+
+    def test_span_hook_errors(self, caplog):
+        class Hook(asqlite3.SpanHook):
+            def __init__(self, fail_start):
+                self.fail_start = fail_start
+
+            def start_span(self, sql, queue_wait):
+                if self.fail_start:
+                    raise ValueError('start failed')
+
+            def end_span(self, span, elapsed, rows, exc):
+                raise ValueError('end failed')
+
+        async def test():
+            async with connect(':memory:', span_hook=Hook(True)) as conn:
+                await conn.execute('CREATE TABLE T(x)')
+                conn.span_hook = Hook(False)
+                await conn.execute('INSERT INTO T VALUES(1)')
+                await conn.commit()
+                with pytest.raises(OperationalError):
+                    await conn.execute('SELECT y FROM T')
+                conn.span_hook = None
+                assert await conn.fetch_all('SELECT x FROM T') == [(1, )]
+
+        asyncio.run(test())
+        assert 'start failed' in caplog.text
+        assert 'end failed' in caplog.text
+
+    def test_stall_watchdog(self):
+        async def test():
+            reports = []
+            async with connect(':memory:', stall_timeout=0.05, on_stall=reports.append) as conn:
+                assert conn.health()['healthy']
+                await conn.create_function('slow', 0, lambda: time.sleep(0.3))
+                task = asyncio.ensure_future(conn.execute('SELECT slow()'))
+                await asyncio.sleep(0.15)
+                health = conn.health()
+                assert not health['healthy'] and health['stalled']
+                assert health['running_sql'] == 'SELECT slow()'
+                assert health['running_time'] >= 0.05
+                await task
+                assert conn.health()['healthy']
+                # Reported once
+                report, = reports
+                assert report.sql == 'SELECT slow()'
+                assert report.elapsed >= 0.05
+                assert report.queue_depth == 1
+                assert 'time.sleep' in report.stack
+                assert conn.stall_count == 1
+            assert conn.health()['closed'] and not conn.health()['healthy']
+
+        asyncio.run(test())
+
+    def test_stall_callback_error(self, caplog):
+        async def test():
+            reports = []
+
+            def on_stall(report):
+                reports.append(report)
+                raise ValueError('callback failed')
+
+            async with connect(':memory:', stall_timeout=0.02, on_stall=on_stall) as conn:
+                await conn.schedule(time.sleep, 0.08)
+                # The watchdog keeps running
+                await conn.schedule(time.sleep, 0.08)
+                assert len(reports) == 2
+                assert conn.stall_count == 2
+                assert not conn._watchdog.done()
+
+        asyncio.run(test())
+        assert 'callback failed' in caplog.text
+
+    def test_stall_interrupt(self):
+        async def test():
+            async with connect(':memory:', stall_timeout=0.05, interrupt_stalled=True) as conn:
+                with pytest.raises(OperationalError):
+                    await conn.execute('WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL '
+                                       'SELECT x + 1 FROM c) SELECT COUNT(*) FROM c')
+                assert conn.stall_count == 1
+                cursor = await conn.execute('SELECT 1')
+                assert await cursor.fetchall() == [(1, )]
+
+        asyncio.run(test())
+
+    @pytest.mark.parametrize('sqlite_json', [False, True])
+    def test_fetch_json(self, sqlite_json, monkeypatch):
+        monkeypatch.setattr(asqlite3.asqlite3, '_SQLITE_JSON', sqlite_json)
+        # Before 3.43 SQLite writes REALs with 15 significant digits
+        exact = not sqlite_json or sqlite3.sqlite_version_info >= (3, 43)
+
+        async def test():
+            async with connect(':memory:') as conn:
+                await conn.execute('CREATE TABLE T(id, "na""me", v)')
+                rows = [(n, f'x{n}', (0.1 + 0.2 if exact else 0.5) * n if n % 3 else None)
+                        for n in range(10)]
+                if exact:
+                    rows[1] = (1, 'x1', 1 / 3)
+                await conn.executemany('INSERT INTO T VALUES(?, ?, ?)', rows)
+                sql = 'SELECT id, "na""me", v AS "it\'s" FROM T WHERE id >= ? ORDER BY id DESC;'
+                expected = [{'id': n, 'na"me': name, "it's": v} for n, name, v in rows
+                            if n >= 1][::-1]
+                assert json.loads(await conn.fetch_json(sql, (1, ))) == expected
+                result = await conn.fetch_json(sql, (1, ), as_bytes=True)
+                assert isinstance(result, bytes) and json.loads(result) == expected
+                assert await conn.fetch_json('SELECT * FROM T WHERE id < 0') == '[]'
+
+                chunks = [chunk async for chunk in conn.fetch_json_stream(
+                    sql, (1, ), batch_size=3)]
+                assert len(chunks) == 4
+                assert json.loads(''.join(chunks)) == expected
+                chunks = [chunk async for chunk in conn.fetch_json_stream(
+                    'SELECT id FROM T WHERE id > ?', (7, ), as_bytes=True)]
+                assert chunks == [b'[{"id":8},{"id":9}', b']']
+                chunks = [chunk async for chunk in conn.fetch_json_stream(
+                    'SELECT id FROM T WHERE id > ?', (70, ))]
+                assert chunks == ['[]']
+
+                # Column names must be distinct
+                with pytest.raises(ValueError):
+                    await conn.fetch_json('SELECT id, v AS id FROM T')
+                with pytest.raises(ValueError):
+                    async for chunk in conn.fetch_json_stream('SELECT id, id FROM T'):
+                        pass
+
+        asyncio.run(test())
+
+    def test_submit_write(self):
+        async def test():
+            errors = []
+            async with connect(':memory:', write_behind_interval=0.02, write_behind_rows=5,
+                               on_write_error=lambda exc, count: errors.append((exc, count))
+                               ) as conn:
+                await conn.execute('CREATE TABLE T(x UNIQUE)')
+                await conn.commit()
+                for n in range(3):
+                    conn.submit_write('INSERT INTO T VALUES(?)', (n, ))
+                conn.submit_write('UPDATE T SET x = x + 10 WHERE x = ?', (0, ))
+                assert conn.buffered_writes == 4
+                await asyncio.sleep(0)
+                assert conn.flushed_write_count == 0
+                while conn.flushed_write_count < 4:
+                    await asyncio.sleep(0.005)
+                assert conn.buffered_writes == 0
+                assert conn.flushed_write_count == 4 and conn.write_flush_count == 1
+                assert 0.02 <= conn.last_flush_lag == conn.max_flush_lag
+                cursor = await conn.execute('SELECT x FROM T ORDER BY x')
+                assert await cursor.fetchall() == [(1, ), (2, ), (10, )]
+                assert not conn.in_transaction
+
+                # Reaching write_behind_rows flushes immediately
+                for n in range(3, 8):
+                    conn.submit_write('INSERT INTO T VALUES(?)', (n, ))
+                assert conn.buffered_writes == 0
+                cursor = await conn.execute('SELECT COUNT(*) FROM T')
+                assert await cursor.fetchone() == (8, )
+
+                # A failed flush writes nothing and reports the error
+                conn.submit_write('INSERT INTO T VALUES(?)', (100, ))
+                conn.submit_write('INSERT INTO T VALUES(?)', (1, ))
+                await conn.flush_writes()
+                (exc, count), = errors
+                assert isinstance(exc, sqlite3.IntegrityError) and count == 2
+                assert conn.write_error_count == 2
+                cursor = await conn.execute('SELECT COUNT(*) FROM T WHERE x = 100')
+                assert await cursor.fetchone() == (0, )
+
+                conn.submit_write('INSERT INTO T VALUES(?)', (200, ))
+            # Written on close
+            assert conn.flushed_write_count == 10
+            with pytest.raises(RuntimeError):
+                conn.submit_write('INSERT INTO T VALUES(?)', (300, ))
+
+        asyncio.run(test())
+
+    def test_submit_write_transaction(self):
+        async def test():
+            errors = []
+            async with connect(':memory:',
+                               on_write_error=lambda exc, count: errors.append((exc, count))
+                               ) as conn:
+                await conn.execute('CREATE TABLE T(x UNIQUE)')
+                await conn.commit()
+
+                # Writes joining an open transaction are lost if it rolls back
+                await conn.execute('INSERT INTO T VALUES(0)')
+                conn.submit_write('INSERT INTO T VALUES(?)', (1, ))
+                conn.submit_write('INSERT INTO T VALUES(?)', (2, ))
+                await conn.flush_writes()
+                assert conn.flushed_write_count == 0 and conn.in_transaction
+                await conn.rollback()
+                (exc, count), = errors
+                assert isinstance(exc, RuntimeError) and count == 2
+                assert conn.flushed_write_count == 0 and conn.write_error_count == 2
+
+                # and are counted once it commits
+                await conn.execute('INSERT INTO T VALUES(0)')
+                conn.submit_write('INSERT INTO T VALUES(?)', (1, ))
+                conn.submit_write('INSERT INTO T VALUES(?)', (2, ))
+                await conn.flush_writes()
+                assert conn.flushed_write_count == 0
+                await conn.commit()
+                assert conn.flushed_write_count == 2 and conn.write_flush_count == 1
+                assert len(errors) == 1 and not conn.in_transaction
+
+                # A failed flush leaves the transaction it joined as it was
+                await conn.execute('INSERT INTO T VALUES(3)')
+                conn.submit_write('INSERT INTO T VALUES(?)', (4, ))
+                conn.submit_write('INSERT INTO T VALUES(?)', (1, ))
+                await conn.flush_writes()
+                exc, count = errors[1]
+                assert isinstance(exc, sqlite3.IntegrityError) and count == 2
+                assert conn.in_transaction
+                await conn.commit()
+                cursor = await conn.execute('SELECT x FROM T ORDER BY x')
+                assert await cursor.fetchall() == [(0, ), (1, ), (2, ), (3, )]
+                assert conn.flushed_write_count == 2 and conn.write_error_count == 4
+
+                await conn.execute('INSERT INTO T VALUES(5)')
+                conn.submit_write('INSERT INTO T VALUES(?)', (6, ))
+            # Closing rolls back the open transaction
+            await asyncio.sleep(0)
+            assert conn.write_error_count == 5 and len(errors) == 3
+
+        asyncio.run(test())
+
+    def test_one_hop_fetches(self):
+        async def test():
+            async with connect(':memory:') as conn:
+                await conn.execute('CREATE TABLE T(a, b)')
+                await conn.executemany('INSERT INTO T VALUES(?, ?)', [(1, 'x'), (2, 'y')])
+                jobs = []
+                schedule = conn.schedule
+
+                def counting_schedule(func, *args):
+                    jobs.append(func)
+                    return schedule(func, *args)
+
+                conn.schedule = counting_schedule
+                assert await conn.fetch_all('SELECT * FROM T ORDER BY a') == [(1, 'x'), (2, 'y')]
+                assert await conn.fetch_all('SELECT * FROM T WHERE a > ?', (5, )) == []
+                assert await conn.fetch_one('SELECT b FROM T WHERE a = ?', (2, )) == ('y', )
+                assert await conn.fetch_one('SELECT b FROM T WHERE a = 3') is None
+                assert await conn.fetch_value('SELECT COUNT(*) FROM T') == 2
+                assert await conn.fetch_value('SELECT b FROM T WHERE a = 3', (), 'z') == 'z'
+                assert await conn.fetch_column('SELECT b FROM T ORDER BY a DESC') == ['y', 'x']
+                assert await conn.exists('SELECT 1 FROM T WHERE b = :b', {'b': 'x'})
+                assert not await conn.exists('SELECT 1 FROM T WHERE b = ?', ('w', ))
+                assert len(jobs) == 9
+                del conn.schedule
+                with pytest.raises(OperationalError):
+                    await conn.fetch_one('SELECT c FROM T')
+
+        asyncio.run(test())
+
+    def test_prepare(self):
+        async def test():
+            async with connect(':memory:') as conn:
+                await conn.execute('CREATE TABLE T(a, b)')
+                await conn.commit()
+                compiles = []
+
+                def authorizer(action, *args):
+                    # Ignore the BEGIN statements of implicit transactions
+                    if action != asqlite3.SQLITE_TRANSACTION:
+                        compiles.append(action)
+                    return SQLITE_OK
+
+                await conn.set_authorizer(authorizer)
+                insert = await conn.prepare('INSERT INTO T VALUES(?, ?)')
+                select = await conn.prepare('SELECT b FROM T WHERE a = ?')
+                assert not conn.in_transaction
+                assert compiles
+                compiles.clear()
+                await insert.executemany([(1, 'x'), (2, 'y')])
+                await insert.execute((3, 'z'))
+                assert await select.fetch_one((2, )) == ('y', )
+                assert await select.fetch_value((3, )) == 'z'
+                assert await select.fetch_value((4, ), 'w') == 'w'
+                assert await select.exists((1, ))
+                assert await select.fetch_all((1, )) == [('x', )]
+                assert await select.fetch_column((2, )) == ['y']
+                # Executions reused the compiled statements
+                assert not compiles
+                assert await conn.prepare('SELECT b FROM T WHERE a = ?') is select
+                assert insert.execution_count == 2
+                assert conn.statement_stats() == {insert.sql: 2, select.sql: 6}
+                assert conn.hot_statements() == [select.sql, insert.sql]
+                assert conn.hot_statements(1) == [select.sql]
+                with pytest.raises(OperationalError):
+                    await conn.prepare('SELEC b FROM T')
+                with pytest.raises(OperationalError):
+                    await conn.prepare('SELECT c FROM T')
+                assert len(conn.statement_stats()) == 2
+
+            warm = ['SELECT 1', 'PRAGMA user_version', 'CREATE TABLE IF NOT EXISTS U(a)']
+            async with connect(':memory:', warm_statements=warm) as conn:
+                assert list(conn.statement_stats()) == warm
+                assert not conn.in_transaction
+                assert await (await conn.prepare('SELECT 1')).fetch_value() == 1
+                assert conn.hot_statements(1) == ['SELECT 1']
+            with pytest.raises(OperationalError):
+                async with connect(':memory:', warm_statements=['SELECT * FROM missing']):
+                    pass
+
+        asyncio.run(test())
+
+    def test_paginate(self):
+        async def test():
+            async with connect(':memory:') as conn:
+                await conn.execute('CREATE TABLE T(a, b, c)')
+                rows = [(a, b, a * 10 + b) for a in range(5) for b in range(4)]
+                await conn.executemany('INSERT INTO T VALUES(?, ?, ?)', reversed(rows))
+
+                pages = [page async for page in conn.paginate('SELECT * FROM T', 'c', 6)]
+                assert [len(page) for page in pages] == [6, 6, 6, 2]
+                assert sum(pages, []) == sorted(rows, key=lambda row: row[2])
+
+                # Composite keys, descending, with parameters
+                sql = 'SELECT c, b, a FROM T WHERE a > ?'
+                pages = [page async for page in conn.paginate(sql, ['a', 'b'], 4,
+                                                              parameters=(0, ),
+                                                              descending=True)]
+                assert [len(page) for page in pages] == [4, 4, 4, 4]
+                expected = sorted(((c, b, a) for a, b, c in rows if a > 0), reverse=True)
+                assert sum(pages, []) == expected
+
+                sql = 'SELECT * FROM T WHERE a = :a'
+                pages = [page async for page in conn.paginate(sql, ('b', ), 2,
+                                                              parameters={'a': 3})]
+                assert sum(pages, []) == [row for row in rows if row[0] == 3]
+                assert [page async for page in conn.paginate(sql, 'b', parameters={'a': 9})] \
+                    == []
+
+        asyncio.run(test())
+
     def test_iterdump(self):
         lines = []
 
@@ -921,6 +2066,695 @@ class TestConnection:
         asyncio.run(test())
 
 
+class TestWorkerPool:
+
+    def test_connect(self):
+        async def test():
+            pool = WorkerPool(2)
+            count = threading.active_count()
+            async with connect(':memory:', pool=pool) as conn:
+                assert threading.active_count() == count
+                await conn.execute('CREATE TABLE T(x)')
+                await conn.executemany('INSERT INTO T VALUES(?)', ((n, ) for n in range(10)))
+                cursor = await conn.execute('SELECT COUNT(*) FROM T')
+                assert await cursor.fetchone() == (10, )
+            assert conn._closed
+            pool.close()
+            assert threading.active_count() == count - 2
+
+        asyncio.run(test())
+
+    def test_job_order(self):
+        async def test():
+            pool = WorkerPool(4)
+            async with connect(':memory:', pool=pool) as conn1:
+                async with connect(':memory:', pool=pool) as conn2:
+                    results = []
+                    futures = [conn.schedule(results.append, (n, conn))
+                               for n in range(50) for conn in (conn1, conn2)]
+                    await asyncio.gather(*futures)
+                    for conn in (conn1, conn2):
+                        assert [n for n, c in results if c is conn] == list(range(50))
+            pool.close()
+
+        asyncio.run(test())
+
+
+class TestDatabaseManager:
+
+    def test_lazy_open(self, tmpdir):
+        async def test():
+            async with DatabaseManager() as manager:
+                assert manager.open_databases == []
+                for n in range(3):
+                    path = os.path.join(tmpdir, f'{n}.sqlite')
+                    async with manager.connection(path) as conn:
+                        await conn.execute('CREATE TABLE T(x)')
+                assert len(manager.open_databases) == 3
+                assert manager.open_count == 3
+                async with manager.connection(path) as conn2:
+                    assert conn2 is conn
+
+        asyncio.run(test())
+
+    def test_lru_eviction(self, tmpdir):
+        async def test():
+            async with DatabaseManager(max_connections=10, max_fds=6) as manager:
+                assert manager.max_open == 2
+                paths = [os.path.join(tmpdir, f'{n}.sqlite') for n in range(3)]
+                for path in paths:
+                    async with manager.connection(path):
+                        pass
+                assert manager.open_databases == paths[1:]
+                assert manager.evicted_count == 1
+                async with manager.connection(paths[0]) as conn:
+                    await conn.execute('SELECT 1')
+                assert manager.open_databases == [paths[2], paths[0]]
+
+        asyncio.run(test())
+
+    def test_wait_for_release(self, tmpdir):
+        async def test():
+            async with DatabaseManager(max_connections=1) as manager:
+                paths = [os.path.join(tmpdir, f'{n}.sqlite') for n in range(2)]
+                order = []
+
+                async def use(path, delay):
+                    async with manager.connection(path) as conn:
+                        order.append(path)
+                        await asyncio.sleep(delay)
+                        await conn.execute('SELECT 1')
+
+                await asyncio.gather(use(paths[0], 0.02), use(paths[1], 0))
+                assert order == paths
+                assert manager.open_databases == paths[1:]
+
+        asyncio.run(test())
+
+    def test_idle_reaping(self, tmpdir):
+        async def test():
+            async with DatabaseManager(idle_timeout=0.02) as manager:
+                path = os.path.join(tmpdir, 'test.sqlite')
+                async with manager.connection(path) as conn:
+                    await conn.execute('CREATE TABLE T(x)')
+                    await asyncio.sleep(0.05)
+                    assert manager.open_databases == [path]
+                await asyncio.sleep(0.05)
+                assert manager.open_databases == []
+                assert manager.reaped_count == 1
+                assert conn._closed
+                async with manager.connection(path) as conn:
+                    cursor = await conn.execute('SELECT COUNT(*) FROM T')
+                    assert await cursor.fetchone() == (0, )
+
+        asyncio.run(test())
+
+    def test_open_failure(self, tmpdir):
+        async def test():
+            async with DatabaseManager() as manager:
+                path = os.path.join(tmpdir, 'missing', 'test.sqlite')
+                with pytest.raises(OperationalError):
+                    async with manager.connection(path):
+                        pass
+                assert manager.open_databases == []
+
+        asyncio.run(test())
+
+    def test_open_failure_frees_slot(self, tmpdir):
+        async def test():
+            async with DatabaseManager(max_connections=1) as manager:
+                bad_path = os.path.join(tmpdir, 'missing', 'test.sqlite')
+                path = os.path.join(tmpdir, 'test.sqlite')
+
+                async def use(path):
+                    async with manager.connection(path) as conn:
+                        await conn.execute('SELECT 1')
+
+                results = await asyncio.wait_for(asyncio.gather(
+                    use(bad_path), use(path), return_exceptions=True), 1)
+                assert isinstance(results[0], OperationalError)
+                assert results[1] is None
+                assert manager.open_databases == [path]
+
+        asyncio.run(test())
+
+    def test_reap_close_error(self, tmpdir, caplog):
+        async def test():
+            async with DatabaseManager(idle_timeout=0.02) as manager:
+                paths = [os.path.join(tmpdir, f'{n}.sqlite') for n in range(2)]
+                async with manager.connection(paths[0]) as conn:
+                    close = conn.close
+
+                    async def failing_close():
+                        await close()
+                        raise RuntimeError('close failed')
+
+                    conn.close = failing_close
+                await asyncio.sleep(0.05)
+                assert manager.open_databases == []
+                # The reaper keeps running
+                async with manager.connection(paths[1]):
+                    pass
+                await asyncio.sleep(0.05)
+                assert manager.open_databases == []
+                assert manager.reaped_count == 2
+
+        asyncio.run(test())
+        assert 'close failed' in caplog.text
+
+    def test_closed(self):
+        async def test():
+            async with DatabaseManager() as manager:
+                pass
+            with pytest.raises(RuntimeError):
+                async with manager.connection(':memory:'):
+                    pass
+
+        asyncio.run(test())
+
+
+@pytest.mark.skipif(sys.version_info < (3, 11), reason='requires Python 3.11')
+class TestTemplateCache:
+
+    @staticmethod
+    def cache():
+        builds = []
+
+        async def build(conn):
+            builds.append(conn)
+            await conn.executescript('CREATE TABLE T(x); CREATE INDEX TX ON T(x);')
+            await conn.executemany('INSERT INTO T VALUES(?)', ((n, ) for n in range(10)))
+
+        cache = asqlite3.TemplateCache()
+        cache.add('tenant', build)
+        return cache, builds
+
+    def test_clone_to_connection(self):
+        async def test():
+            cache, builds = self.cache()
+            for _ in range(3):
+                async with connect(':memory:') as conn:
+                    await cache.clone_to('tenant', conn)
+                    cursor = await conn.execute('SELECT SUM(x) FROM T')
+                    assert await cursor.fetchone() == (45, )
+            assert len(builds) == 1
+
+        asyncio.run(test())
+
+    def test_clone_to_file(self, tmpdir):
+        async def test():
+            cache, builds = self.cache()
+            filenames = [os.path.join(tmpdir, f'{n}.sqlite') for n in range(3)]
+            await asyncio.gather(*(cache.clone_to('tenant', filename)
+                                   for filename in filenames))
+            assert len(builds) == 1
+            for filename in filenames:
+                async with connect(filename) as conn:
+                    sql = "SELECT name FROM sqlite_master WHERE type='index'"
+                    cursor = await conn.execute(sql)
+                    assert await cursor.fetchall() == [('TX', )]
+            with pytest.raises(ValueError):
+                await cache.clone_to('tenant', ':memory:')
+
+        asyncio.run(test())
+
+    def test_build_failure(self):
+        async def test():
+            cache = asqlite3.TemplateCache()
+
+            async def build(conn):
+                await conn.execute('CREATE TABLE')
+
+            cache.add('bad', build)
+            for _ in range(2):
+                with pytest.raises(OperationalError):
+                    await cache.image('bad')
+            with pytest.raises(KeyError):
+                await cache.image('missing')
+
+        asyncio.run(test())
+
+
+class TestChangeFeed:
+
+    @pytest.mark.parametrize('autocommit', [None, False])
+    def test_changes(self, autocommit):
+        if autocommit is not None and sys.version_info < (3, 12):
+            pytest.skip('requires Python 3.12')
+
+        async def test():
+            # With autocommit False a transaction is always open
+            async with connect(':memory:', autocommit=autocommit) as conn:
+                await conn.execute('CREATE TABLE T(x)')
+                feed = asqlite3.ChangeFeed(conn)
+                await feed.watch('T')
+                await feed.watch('T')
+                received = []
+
+                async def subscribe():
+                    async for change in feed.changes():
+                        received.append(change)
+
+                task = asyncio.ensure_future(subscribe())
+                await asyncio.sleep(0.01)
+                await conn.execute('INSERT INTO T VALUES(1)')
+                await conn.execute('INSERT INTO T VALUES(2)')
+                await asyncio.sleep(0.01)
+                # Uncommitted changes are not delivered
+                assert received == []
+                await conn.commit()
+                await conn.execute('UPDATE T SET x = 3 WHERE x = 1')
+                await conn.execute('DELETE FROM T WHERE x = 2')
+                await conn.rollback()
+                await conn.execute('DELETE FROM T WHERE x = 2')
+                await conn.commit()
+                await asyncio.sleep(0.01)
+                assert [(c.table, c.op, c.rowid) for c in received] == [
+                    ('T', 'I', 1), ('T', 'I', 2), ('T', 'D', 2)]
+                # Sequence numbers of rolled back changes are reused
+                assert [c.seq for c in received] == [1, 2, 3]
+                feed.close()
+                await task
+
+                await feed.unwatch('T')
+                await conn.execute('INSERT INTO T VALUES(5)')
+                await conn.commit()
+                assert [c.seq async for c in feed.changes(since=0)] == []
+
+        asyncio.run(test())
+
+    def test_named_cursor_and_prune(self, tmpdir):
+        filename = os.path.join(tmpdir, 'test.sqlite')
+
+        async def consume(feed, count, since=None):
+            result = []
+            async for change in feed.changes('reports', since=since, batch_size=2):
+                result.append(change.seq)
+                if len(result) == count:
+                    break
+            return result
+
+        async def test():
+            async with connect(filename) as conn:
+                await conn.execute('CREATE TABLE T(x)')
+                feed = asqlite3.ChangeFeed(conn)
+                await feed.watch('T')
+                await conn.executemany('INSERT INTO T VALUES(?)', ((n, ) for n in range(5)))
+                await conn.commit()
+                assert await consume(feed, 5, since=0) == [1, 2, 3, 4, 5]
+                assert await feed.cursors() == {'reports': 4}
+                feed.close()
+
+            async with connect(filename) as conn:
+                feed = asqlite3.ChangeFeed(conn)
+                # The cursor advanced after the first two batches; the third is redelivered
+                assert await consume(feed, 1) == [5]
+                assert await feed.prune() == 4
+                cursor = await conn.execute('SELECT COUNT(*) FROM asqlite3_changes')
+                assert await cursor.fetchone() == (1, )
+                assert await feed.prune(max_age=0) == 1
+                feed.close()
+
+        asyncio.run(test())
+
+
+class TestIndexAdvisor:
+
+    def test_analyze(self):
+        async def test():
+            async with connect(':memory:') as conn:
+                await conn.execute('CREATE TABLE T(a, b, c)')
+                await conn.executemany('INSERT INTO T VALUES(?, ?, ?)',
+                                       [(n % 50, n, n % 7) for n in range(2000)])
+                await conn.execute('CREATE TABLE S(x)')
+                await conn.commit()
+                async with asqlite3.IndexAdvisor(conn) as advisor:
+                    for n in range(5):
+                        cursor = await conn.execute(
+                            'SELECT * FROM T AS z WHERE z.a = ? AND b > ? ORDER BY c', (n, 10))
+                        await cursor.fetchall()
+                    await conn.fetch_shared('SELECT * FROM S WHERE x = 1')
+                    await conn.execute('SELECT c FROM T WHERE rowid = 3')
+                # Not recorded once stopped, and statements are no longer tracked
+                await conn.execute('SELECT * FROM T WHERE c = 1')
+                assert conn._tracker is None
+
+                stats = await advisor.stats()
+                assert [item['count'] for item in stats] == [5, 1, 1]
+                assert stats[0]['sql'] == 'SELECT * FROM T AS z WHERE z.a = ? AND b > ? ORDER BY c'
+                assert stats[0]['mean_time'] == stats[0]['total_time'] / 5
+                assert len(await advisor.stats(top=1)) == 1
+
+                # S is too small to matter and T is searched by rowid
+                advice = await advisor.analyze(verify=True)
+                assert len(advice) == 1
+                advice = advice[0]
+                assert advice.count == 5
+                assert advice.issues == ['SCAN z', 'USE TEMP B-TREE FOR ORDER BY']
+                index, = advice.indexes
+                assert index.table == 'T'
+                assert index.columns == ['a', 'b', 'c']
+                assert index.create_sql == 'CREATE INDEX "idx_T_a_b_c" ON "T"("a", "b", "c")'
+                assert index.before_time > 0 and index.after_time > 0
+                # Verification uses a copy
+                cursor = await conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE "
+                                            "type = 'index'")
+                assert await cursor.fetchone() == (0, )
+
+                assert await advisor.analyze(min_rows=5000) == [
+                    advice._replace(issues=['USE TEMP B-TREE FOR ORDER BY'], indexes=[
+                        index._replace(columns=['c'], create_sql='CREATE INDEX "idx_T_c" '
+                                       'ON "T"("c")', before_time=None, after_time=None)])]
+
+        asyncio.run(test())
+
+    def test_automatic_index(self):
+        async def test():
+            async with connect(':memory:') as conn:
+                await conn.execute('CREATE TABLE T(a, b)')
+                await conn.execute('CREATE TABLE U(a)')
+                advisor = asqlite3.IndexAdvisor(conn)
+                await advisor.start()
+                await conn.execute('SELECT * FROM U JOIN T ON T.a = U.a')
+                await advisor.stop()
+                assert conn._tracker is None
+                advice, = await advisor.analyze()
+                assert any('AUTOMATIC' in issue for issue in advice.issues)
+                assert [(index.table, index.columns) for index in advice.indexes] == [
+                    ('T', ['a'])]
+
+        asyncio.run(test())
+
+    def test_stop_keeps_step_meter(self):
+        async def test():
+            async with connect(':memory:', meter_steps=10) as conn:
+                async with asqlite3.IndexAdvisor(conn):
+                    await conn.execute('SELECT 1')
+                assert conn._tracker.listeners == [conn._step_meter]
+                await conn.execute('SELECT 1')
+                stats = await conn.step_stats()
+                assert stats[0]['executions'] == 2
+
+        asyncio.run(test())
+
+
+class TestKVStore:
+
+    def test_get_set(self):
+        async def test():
+            async with connect(':memory:') as conn:
+                async with asqlite3.kv.KVStore(conn, cache_size=2) as store:
+                    assert await store.get('a') is None
+                    assert await store.get('a', 5) == 5
+                    await store.set('a', 1)
+                    await store.set('b', b'blob')
+                    assert await store.get('a') == 1
+                    await store.set_many({'c': 'x', 'd': None})
+                    await store.set_many([('e', 2.5)])
+                    assert await store.get_many(['a', 'b', 'c', 'd', 'e', 'f']) == {
+                        'a': 1, 'b': b'blob', 'c': 'x', 'd': None, 'e': 2.5}
+                    await store.delete('a')
+                    await store.delete('f')
+                    assert await store.get('a') is None
+                    assert len(store._cache) == 2
+
+                    # Writes are durable; a new store reads them from the table
+                    store2 = asqlite3.KVStore(conn, sweep_interval=None)
+                    assert await store2.get_many(['a', 'b', 'e']) == {'b': b'blob', 'e': 2.5}
+                    assert store2.cache_misses == 3
+                    assert await store2.get('b') == b'blob'
+                    assert store2.cache_hits == 1
+                    await store2.close()
+                    assert not conn.in_transaction
+
+        asyncio.run(test())
+
+    def test_coalesced_writes(self):
+        async def test():
+            async with connect(':memory:') as conn:
+                async with asqlite3.KVStore(conn) as store:
+                    jobs = []
+                    schedule = conn.schedule
+
+                    def counting_schedule(func, *args):
+                        jobs.append(func)
+                        return schedule(func, *args)
+
+                    conn.schedule = counting_schedule
+                    await asyncio.gather(*(store.set(f'k{n}', n) for n in range(100)),
+                                         store.delete('k5'))
+                    # Written in one batch
+                    assert len(jobs) == 1
+                    assert await store.get('k99') == 99 and await store.get('k5') is None
+                    del conn.schedule
+
+                    # A failed batch fails its writes and is not cached
+                    await conn.execute('CREATE TRIGGER fail BEFORE INSERT ON asqlite3_kv '
+                                       "WHEN NEW.key = 'bad' BEGIN SELECT RAISE(ABORT, 'no'); END")
+                    with pytest.raises(sqlite3.IntegrityError):
+                        await asyncio.gather(store.set('bad', 1), store.set('good', 2))
+                    store._cache.clear()
+                    assert await store.get_many(['bad', 'good']) == {}
+
+        asyncio.run(test())
+
+    def test_ttl_and_scan(self):
+        async def test():
+            async with connect(':memory:') as conn:
+                async with asqlite3.KVStore(conn, sweep_interval=0.05) as store:
+                    await store.set_many({'user:1': 'a', 'user:2': 'b', 'users': 'c',
+                                          'user;': 'd', 'x': 'e'})
+                    await store.set('user:3', 'f', ttl=0.02)
+                    assert await store.get('user:3') == 'f'
+                    assert [row async for row in store.scan('user:', batch_size=1)] == [
+                        ('user:1', 'a'), ('user:2', 'b'), ('user:3', 'f')]
+                    await asyncio.sleep(0.03)
+                    assert await store.get('user:3') is None
+                    assert [key async for key, _ in store.scan('user:')] == [
+                        'user:1', 'user:2']
+                    assert len([row async for row in store.scan()]) == 5
+                    await asyncio.sleep(0.1)
+                    assert store.expired_count == 1
+                    assert await store.expire() == 0
+
+        asyncio.run(test())
+
+    def test_sweeper_stops(self, caplog):
+        async def test():
+            async with connect(':memory:') as conn:
+                store = asqlite3.KVStore(conn, sweep_interval=0.01)
+                await store.set('a', 1, ttl=10)
+                await store.flush()
+                # Errors are logged and sweeping continues
+                await conn.execute(f'DROP TABLE {store.table}')
+                await asyncio.sleep(0.03)
+                assert 'error sweeping' in caplog.text
+                sweeper = store._sweeper
+                assert not sweeper.done()
+            # The connection was closed without closing the store
+            await asyncio.wait_for(sweeper, 1)
+            assert store._sweeper is None
+
+        asyncio.run(test())
+
+
+class TestTaskQueue:
+
+    def test_put_get_ack(self):
+        async def test():
+            async with connect(':memory:') as conn:
+                tasks = asqlite3.queue.TaskQueue(conn)
+                assert await tasks.put('a') == 1
+                assert await tasks.put_many(['b', 'c']) == 2
+                await tasks.put('urgent', priority=5)
+                assert await tasks.qsize() == 4
+                messages = [await tasks.get() for _ in range(4)]
+                assert [message.payload for message in messages] == ['urgent', 'a', 'b', 'c']
+                assert messages[0] == asqlite3.Message(4, 'urgent', 5, 1)
+                assert await tasks.get(timeout=0.01) is None
+                await asyncio.gather(*(tasks.ack(message) for message in messages[:3]))
+                assert tasks.ack_count == 3
+                await tasks.nack(messages[3])
+                message = await tasks.get()
+                assert message == asqlite3.Message(3, 'c', 0, 2)
+                # A stale message is ignored
+                await tasks.nack(messages[3])
+                await tasks.ack(messages[3])
+                assert tasks.nack_count == 1 and tasks.ack_count == 3
+                await tasks.ack(message)
+                assert await tasks.qsize() == 0
+                assert not conn.in_transaction
+
+        asyncio.run(test())
+
+    def test_wakeup_and_visibility(self):
+        async def test():
+            async with connect(':memory:') as conn:
+                tasks = asqlite3.TaskQueue(conn)
+                consumers = [asyncio.ensure_future(tasks.get(visibility_timeout=0.05))
+                             for _ in range(2)]
+                await asyncio.sleep(0.02)
+                assert not any(consumer.done() for consumer in consumers)
+                await tasks.put_many([1, 2])
+                first, second = await asyncio.gather(*consumers)
+                assert {first.payload, second.payload} == {1, 2}
+                await tasks.ack(first)
+
+                # The unacknowledged message becomes available when its claim expires
+                start = time.monotonic()
+                message = await tasks.get(timeout=1)
+                assert time.monotonic() - start >= 0.03
+                assert message.id == second.id and message.attempts == 2
+                # Its original claimant can no longer acknowledge it
+                await tasks.ack(second)
+                assert await tasks.qsize() == 1
+
+        asyncio.run(test())
+
+
+class TestBlobStore:
+
+    def test_put_get(self):
+        async def test():
+            async with connect(':memory:') as conn:
+                store = asqlite3.blobstore.BlobStore(conn, chunk_size=100)
+                data = bytes(range(256)) * 4
+                assert await store.put('a', data) == 1024
+                assert await store.get('a') == data
+                assert await store.size('a') == 1024
+                assert await store.size('b') is None
+                with pytest.raises(KeyError):
+                    await store.get('b')
+                for offset, size in ((0, 10), (95, 10), (100, 100), (150, 500), (1000, 100),
+                                     (1024, 5), (2000, None), (3, 0)):
+                    expected = data[offset: None if size is None else offset + size]
+                    assert await store.get('a', offset, size) == expected
+                pieces = [piece async for piece in store.stream('a', 50)]
+                assert [len(piece) for piece in pieces] == [50] + [100] * 9 + [24]
+
+                # Identical chunks are stored once
+                await store.put('copy', data)
+                await store.put('empty', b'')
+                assert await store.get('empty') == b''
+                usage = await store.usage()
+                assert usage == asqlite3.BlobUsage(3, 2048, 11, 1024)
+                # Replacing a file keeps chunks still referenced
+                await store.put('a', data[:500])
+                assert await store.get('copy') == data
+                assert await store.delete('copy')
+                assert not await store.delete('copy')
+                assert await store.usage() == asqlite3.BlobUsage(2, 500, 5, 500)
+                assert await store.get('a') == data[:500]
+                assert not conn.in_transaction
+
+        asyncio.run(test())
+
+    def test_streaming_put(self):
+        async def test():
+            async with connect(':memory:') as conn:
+                store = asqlite3.BlobStore(conn, chunk_size=64)
+
+                async def pieces():
+                    for n in range(10):
+                        yield bytes([n]) * 30
+
+                assert await store.put('f', pieces()) == 300
+                assert await store.get('f') == b''.join(bytes([n]) * 30 for n in range(10))
+
+                async def failing():
+                    yield b'x' * 200
+                    raise ValueError
+
+                with pytest.raises(ValueError):
+                    await store.put('f', failing())
+                # The existing file is untouched and no chunks leak
+                assert (await store.usage()).files == 1
+                assert await store.get('f', 0, 30) == bytes(30)
+                assert (await store.usage()).chunks == 5
+
+        asyncio.run(test())
+
+    def test_content_defined(self, tmpdir):
+        async def test():
+            rand = random.Random(0)
+            data = bytes(rand.getrandbits(8) for _ in range(200_000))
+            edited = data[:1000] + b'inserted' + data[1000:]
+            database = os.path.join(tmpdir, 'blobs.sqlite')
+            async with connect(database) as conn, connect(database) as reader:
+                store = asqlite3.BlobStore(conn, chunk_size=4096, content_defined=True,
+                                           readers=[reader], max_parallel=3)
+                await store.put('a', data)
+                chunks = (await store.usage()).chunks
+                assert 20 < chunks < 100
+                await store.put('b', edited)
+                # Only the chunks near the insertion differ
+                usage = await store.usage()
+                assert usage.chunks <= chunks + 2
+                assert await store.get('b') == edited
+                assert await store.get('b', 5000, 10000) == edited[5000:15000]
+
+                # Fixed-size chunks are all shifted by the insertion
+                store = asqlite3.BlobStore(conn, prefix='fixed', chunk_size=4096)
+                await store.put('a', data)
+                await store.put('b', edited)
+                assert (await store.usage()).chunks > 90
+
+        asyncio.run(test())
+
+    def test_changed_while_streaming(self):
+        async def test():
+            async with connect(':memory:') as conn:
+                store = asqlite3.BlobStore(conn, chunk_size=10, max_parallel=1)
+                await store.put('a', bytes(range(100)))
+                pieces = store.stream('a')
+                assert await pieces.__anext__() == bytes(range(10))
+                # The chunks are deleted and their IDs reused for other content
+                await store.delete('a')
+                await store.put('b', b'x' * 100)
+                with pytest.raises(RuntimeError):
+                    await pieces.__anext__()
+                assert not conn.in_transaction
+
+        asyncio.run(test())
+
+    @pytest.mark.skipif(sys.version_info < (3, 12), reason='requires Python 3.12')
+    def test_autocommit_read(self):
+        async def test():
+            async with connect(':memory:', autocommit=True) as conn:
+                store = asqlite3.BlobStore(conn, chunk_size=10)
+                await store.put('a', bytes(range(30)))
+                assert await store.get('a') == bytes(range(30))
+                assert not conn.in_transaction
+
+        asyncio.run(test())
+
+    def test_stale_staging(self):
+        async def test():
+            async with connect(':memory:') as conn:
+                store = asqlite3.BlobStore(conn, chunk_size=10)
+                await store.put('a', b'a' * 20)
+
+                # Simulate puts interrupted by a crash, one long ago and one just now
+                async def staged(name, offset, chunk_id):
+                    await conn.execute('INSERT INTO asqlite3_blob_map VALUES(?, ?, ?, 10)',
+                                       (name, offset, chunk_id))
+                    await conn.execute('UPDATE asqlite3_blob_chunks SET refs = refs + 1 '
+                                       'WHERE id = ?', (chunk_id, ))
+
+                old = f'\0staging:{int(time.time()) - 100_000:012d}:x'
+                recent = f'\0staging:{int(time.time()):012d}:y'
+                await staged(old, 0, 1)
+                await staged(recent, 0, 1)
+                await conn.commit()
+                store = asqlite3.BlobStore(conn, chunk_size=10)
+                await store.delete('a')
+                names = await conn.fetch_column('SELECT DISTINCT name FROM asqlite3_blob_map')
+                assert names == [recent]
+                assert await conn.fetch_value('SELECT refs FROM asqlite3_blob_chunks') == 1
+
+        asyncio.run(test())
+
+
 def test_module_constants():
     from asqlite3 import (
         complete_statement, enable_callback_tracebacks, register_adapter,